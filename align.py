@@ -0,0 +1,191 @@
+"""
+Alignment of wind samples to the drone timeline
+
+The wind and drone logs are sampled by different clocks, so wind samples
+are matched to drone samples with a tolerance, optionally interpolating
+between the two surrounding wind samples. Wind direction is interpolated
+along the shortest way around the circle.
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.15
+"""
+
+import numpy as np
+import pandas as pd
+
+
+def to_ns(times):
+    """Convert an array or series of datetimes to int64 nanoseconds"""
+    return np.asarray(times).astype("datetime64[ns]").view(np.int64)
+
+
+def asof_indices(times, sample_times, tolerance_ns):
+    """
+    Find the nearest sample for each time
+
+    Args:
+        times: int64 array of times to match, in any order.
+        sample_times: Sorted int64 array of sample times.
+        tolerance_ns: Maximum distance to the nearest sample.
+
+    Returns:
+        (before, after, nearest, matched): Indices of the samples at or
+        before and at or after each time, of the nearest one of those, and
+        a boolean array telling which times have a sample within tolerance.
+    """
+    last = len(sample_times) - 1
+    after = np.searchsorted(sample_times, times, side="left")
+    before = np.clip(after - 1, 0, last)
+    after = np.clip(after, 0, last)
+    # Exact matches are found by searchsorted as "after"
+    before = np.where(sample_times[after] == times, after, before)
+
+    distance_before = np.abs(times - sample_times[before])
+    distance_after = np.abs(sample_times[after] - times)
+    nearest = np.where(distance_after < distance_before, after, before)
+    matched = np.minimum(distance_before, distance_after) <= tolerance_ns
+    return before, after, nearest, matched
+
+
+def interpolate(times, sample_times, values, tolerance_ns, method="linear",
+                circular=False):
+    """
+    Estimate sampled values at the given times
+
+    Args:
+        times: int64 array of times to estimate values at.
+        sample_times: Sorted int64 array of sample times.
+        values: Array of sample values.
+        tolerance_ns: Times further than this from any sample get NaN.
+        method: "nearest" to use the nearest sample, or "linear" to
+            interpolate between the samples before and after.
+        circular: The values are angles in degrees.
+
+    Returns:
+        estimates: A float64 array with a value for each time.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    estimates = np.full(len(times), np.nan)
+    if len(sample_times) == 0:
+        return estimates
+    before, after, nearest, matched = asof_indices(times, sample_times,
+                                                   tolerance_ns)
+    if method == "nearest":
+        estimates[matched] = values[nearest[matched]]
+        return estimates
+
+    span = (sample_times[after] - sample_times[before]).astype(np.float64)
+    weight = np.divide((times - sample_times[before]).astype(np.float64),
+                       span, out=np.zeros(len(times)), where=span > 0)
+    weight = np.clip(weight, 0, 1)
+    if circular:
+        radians = np.radians(values)
+        x = _lerp(np.cos(radians), before, after, weight)
+        y = _lerp(np.sin(radians), before, after, weight)
+        estimated = np.degrees(np.arctan2(y, x)) % 360
+        # -1e-15 % 360 rounds to 360
+        estimated[estimated == 360] = 0
+    else:
+        estimated = _lerp(values, before, after, weight)
+    estimates[matched] = estimated[matched]
+    return estimates
+
+
+def _lerp(values, before, after, weight):
+    return values[before] + weight * (values[after] - values[before])
+
+
+def align_wind(drone_data, wind_data, tolerance=0.05, method="linear"):
+    """
+    Join wind samples onto drone samples
+
+    Args:
+        drone_data: A dataframe with drone samples, see read_drone_csv.
+        wind_data: A dataframe with wind samples, see read_wind_csv.
+        tolerance: Maximum number of seconds between a drone sample and the
+            nearest wind sample for it to get wind data.
+        method: "nearest" to use the nearest wind sample, or "linear" to
+            interpolate speed linearly and direction around the circle.
+
+    Returns:
+        merged_data: drone_data with the time, speed and direction of the
+        wind, NaN where there is no wind sample within tolerance.
+    """
+    order = np.argsort(to_ns(wind_data["INCREMENTED.time"]), kind="mergesort")
+    wind_times = to_ns(wind_data["INCREMENTED.time"])[order]
+    times = to_ns(drone_data["CUSTOM.updateTime"])
+    tolerance_ns = int(tolerance * 10**9)
+
+    merged_data = drone_data.copy()
+    _, _, nearest, matched = asof_indices(times, wind_times, tolerance_ns)
+    nearest_times = np.where(matched, wind_times[nearest],
+                             np.iinfo(np.int64).min)
+    merged_data["INCREMENTED.time"] = nearest_times.view("datetime64[ns]")
+    merged_data["RANDOM.windSpeed"] = interpolate(
+        times, wind_times, wind_data["RANDOM.windSpeed"].to_numpy()[order],
+        tolerance_ns, method)
+    merged_data["RANDOM.direction"] = interpolate(
+        times, wind_times, wind_data["RANDOM.direction"].to_numpy()[order],
+        tolerance_ns, method, circular=True)
+    return merged_data
+
+
+def wind_at(times, wind_data, tolerance=0.05, method="linear"):
+    """
+    Estimate the wind at the given times, like align_wind without copying
+    any drone data
+
+    Args:
+        times: int64 array of nanoseconds since the epoch.
+        wind_data, tolerance, method: See align_wind
+
+    Returns:
+        (speed, direction): float64 arrays, NaN where there is no wind
+        sample within tolerance.
+    """
+    order = np.argsort(to_ns(wind_data["INCREMENTED.time"]), kind="mergesort")
+    wind_times = to_ns(wind_data["INCREMENTED.time"])[order]
+    tolerance_ns = int(tolerance * 10**9)
+    speed = interpolate(
+        times, wind_times, wind_data["RANDOM.windSpeed"].to_numpy()[order],
+        tolerance_ns, method)
+    direction = interpolate(
+        times, wind_times, wind_data["RANDOM.direction"].to_numpy()[order],
+        tolerance_ns, method, circular=True)
+    return speed, direction
+
+
+def resample_wind(wind_data, rate, start=None, end=None, tolerance=None):
+    """
+    Resample wind samples to a fixed rate
+
+    Args:
+        wind_data: A dataframe with wind samples, see read_wind_csv.
+        rate: Number of samples per second of the result.
+        start, end: Time range of the result, the range of wind_data by
+            default.
+        tolerance: Maximum number of seconds to the nearest wind sample,
+            by default any gap is interpolated.
+
+    Returns:
+        resampled: A dataframe with the same columns as wind_data.
+    """
+    order = np.argsort(to_ns(wind_data["INCREMENTED.time"]), kind="mergesort")
+    wind_times = to_ns(wind_data["INCREMENTED.time"])[order]
+    start = wind_times[0] if start is None else to_ns([start])[0]
+    end = wind_times[-1] if end is None else to_ns([end])[0]
+    times = np.arange(start, end + 1, int(round(10**9 / rate)),
+                      dtype=np.int64)
+    tolerance_ns = np.iinfo(np.int64).max if tolerance is None \
+        else int(tolerance * 10**9)
+
+    return pd.DataFrame({
+        "INCREMENTED.time": times.view("datetime64[ns]"),
+        "RANDOM.windSpeed": interpolate(
+            times, wind_times,
+            wind_data["RANDOM.windSpeed"].to_numpy()[order], tolerance_ns),
+        "RANDOM.direction": interpolate(
+            times, wind_times,
+            wind_data["RANDOM.direction"].to_numpy()[order], tolerance_ns,
+            circular=True),
+    })
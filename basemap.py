@@ -0,0 +1,330 @@
+"""
+Offline cache of the OpenStreetMap layers drawn under the drone data
+
+Fetched roads, buildings, parks and area polygons are stored on disk per
+bounding box. Any later request for a bounding box inside a stored one is
+served from disk without touching the network.
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.12
+"""
+
+import hashlib
+import io
+import json
+import os
+import pickle
+import tempfile
+from flightcache import DEFAULT_CACHE_DIR
+
+
+LAYERS = ["area", "edges", "buildings", "parks"]
+DEFAULT_STORE_DIR = os.path.join(DEFAULT_CACHE_DIR, "basemap")
+DEFAULT_PLACE = "Åkersberga, Sweden"
+
+
+class OsmProvider():
+    """
+    Fetches map layers from OpenStreetMap through osmnx
+    """
+
+    def __init__(self, place=DEFAULT_PLACE):
+        self.place = place
+
+    def fetch(self, north, south, east, west):
+        """
+        Fetch the map layers within a bounding box
+
+        Returns:
+            layers: A dict with a GeoDataFrame (or None) for each of LAYERS.
+        """
+        import osmnx as ox
+        # FOR HELP INSTALLING OSMNX, SEE THIS LINK:
+        # https://stackoverflow.com/questions/45901732/could-not-find-or-load-spatialindex-c-dll-in-windows/45970431
+        graph = ox.graph_from_bbox(north, south, east, west)
+        _, edges = ox.graph_to_gdfs(graph)
+        layers = {
+            "area": ox.gdf_from_place(self.place),
+            "edges": edges,
+            "buildings": ox.create_footprints_gdf(
+                "shapely Polygon", north, south, east, west),
+            "parks": None,
+        }
+        try:
+            leisure = ox.create_footprints_gdf(
+                "shapely Polygon", north, south, east, west, "leisure")
+            layers["parks"] = leisure[
+                leisure["leisure"].isin(["park", "playground"])]
+        except Exception:
+            print("No parks within bbox")
+        return layers
+
+
+class StaticProvider():
+    """
+    Stand-in provider that serves fixed layers without any network access
+
+    Without any layers, nothing fetched from it is stored, see
+    Basemap.get_layers.
+
+    Args:
+        layers: A dict with some of LAYERS, missing layers are left empty.
+    """
+
+    def __init__(self, layers=None):
+        self.layers = layers or {}
+        self.calls = 0
+
+    def fetch(self, north, south, east, west):
+        self.calls += 1
+        return {name: self.layers.get(name) for name in LAYERS}
+
+
+def is_empty(layers):
+    """Check if no layer holds any map data, e.g. after a failed fetch"""
+    return layers is None or all(layers.get(name) is None for name in LAYERS)
+
+
+def bbox_key(bbox, zoom=None):
+    """Return a file name safe key for a (north, south, east, west) bbox"""
+    text = ",".join("{0:.6f}".format(value) for value in bbox)
+    if zoom is not None:
+        text += ",z{0}".format(zoom)
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:20]
+
+
+def contains(outer, inner):
+    """Check if bbox outer contains bbox inner"""
+    return (outer[0] >= inner[0] and outer[1] <= inner[1]
+            and outer[2] >= inner[2] and outer[3] <= inner[3])
+
+
+def overlap_area(a, b):
+    """Return the overlapping area of two bboxes, zero if they don't overlap"""
+    height = min(a[0], b[0]) - max(a[1], b[1])
+    width = min(a[2], b[2]) - max(a[3], b[3])
+    return max(height, 0) * max(width, 0)
+
+
+def union(boxes):
+    """Return the smallest bbox containing all of boxes"""
+    return (max(box[0] for box in boxes), min(box[1] for box in boxes),
+            max(box[2] for box in boxes), min(box[3] for box in boxes))
+
+
+class BasemapStore():
+    """
+    Directory of pickled map layers, and optional rasters, per bbox
+    """
+
+    def __init__(self, store_dir=DEFAULT_STORE_DIR):
+        self.store_dir = store_dir
+        os.makedirs(store_dir, exist_ok=True)
+        self.index = {}
+        self.reload()
+
+    def reload(self):
+        """Add entries written by other processes sharing the store"""
+        try:
+            with open(os.path.join(self.store_dir, "index.json")) as index:
+                stored = json.load(index)
+        except (OSError, ValueError):
+            return
+        for key, bbox in stored.items():
+            self.index.setdefault(key, bbox)
+
+    def find(self, bbox):
+        """Return the key of a stored bbox containing bbox, or None"""
+        for _ in range(2):
+            for key, stored in self.index.items():
+                if contains(stored, bbox):
+                    return key
+            self.reload()
+        return None
+
+    def overlapping(self, bbox):
+        """Return the keys of stored bboxes overlapping bbox, most first"""
+        keys = [key for key, stored in self.index.items()
+                if overlap_area(stored, bbox) > 0]
+        return sorted(keys, key=lambda key: -overlap_area(self.index[key],
+                                                          bbox))
+
+    def lookup(self, bbox):
+        """
+        Get the stored layers covering bbox the most, without fetching or
+        changing the store
+
+        Returns:
+            layers: The layers of a stored bbox containing bbox, or else of
+            the stored bbox overlapping it the most, or else empty layers.
+        """
+        key = self.find(bbox)
+        if key is None:
+            overlapping = self.overlapping(bbox)
+            if not overlapping:
+                return {name: None for name in LAYERS}
+            key = overlapping[0]
+        return self.load(key)
+
+    def load(self, key):
+        """Load the layers stored under key"""
+        with open(os.path.join(self.store_dir, key + ".pickle"), "rb") as f:
+            return pickle.load(f)
+
+    def save(self, bbox, layers):
+        """Store layers for bbox, returning the key"""
+        key = bbox_key(bbox)
+        self._write(key + ".pickle", pickle.dumps(layers))
+        self.reload()
+        self.index[key] = list(bbox)
+        self._write_index()
+        return key
+
+    def remove(self, key):
+        """Remove the layers stored under key"""
+        self.index.pop(key, None)
+        self._write_index()
+        try:
+            os.remove(os.path.join(self.store_dir, key + ".pickle"))
+        except OSError:
+            pass
+
+    def load_raster(self, bbox, zoom):
+        """Load the rendered png of bbox at zoom as an image array, or None"""
+        import matplotlib.image as mpimg
+        path = os.path.join(self.store_dir, self._raster_name(bbox, zoom))
+        if not os.path.exists(path):
+            return None
+        return mpimg.imread(path)
+
+    def save_raster(self, bbox, zoom, png):
+        """Store png bytes rendered for bbox at zoom"""
+        self._write(self._raster_name(bbox, zoom), png)
+
+    def _raster_name(self, bbox, zoom):
+        return "raster-{0}.png".format(bbox_key(bbox, zoom))
+
+    def _write(self, name, content):
+        handle, tmp_path = tempfile.mkstemp(dir=self.store_dir)
+        with os.fdopen(handle, "wb") as f:
+            f.write(content)
+        os.replace(tmp_path, os.path.join(self.store_dir, name))
+
+    def _write_index(self):
+        self._write("index.json", json.dumps(self.index).encode("utf-8"))
+
+
+class Basemap():
+    """
+    Serves map layers from the store, fetching from the provider on a miss
+
+    Args:
+        provider: Where to fetch missing layers, OsmProvider by default.
+        store: The BasemapStore to use, the default store if None.
+    """
+
+    def __init__(self, provider=None, store=None):
+        self.provider = provider if provider is not None else OsmProvider()
+        self.store = store if store is not None else BasemapStore()
+
+    def get_layers(self, north, south, east, west):
+        """
+        Get the map layers covering a bounding box
+
+        A stored bbox containing the requested one is used as is. Otherwise
+        the union of the requested bbox and all overlapping stored ones is
+        fetched and replaces them. If fetching fails, e.g. when offline, or
+        returns no layers at all, the store is left as it is and the stored
+        bbox overlapping the most is used, or empty layers.
+
+        Returns:
+            layers: A dict with a GeoDataFrame (or None) for each of LAYERS.
+        """
+        bbox = (north, south, east, west)
+        key = self.store.find(bbox)
+        if key is not None:
+            return self.store.load(key)
+
+        overlapping = self.store.overlapping(bbox)
+        fetch_bbox = union([bbox] + [self.store.index[key]
+                                     for key in overlapping])
+        try:
+            layers = self.provider.fetch(*fetch_bbox)
+        except Exception as error:
+            print("Could not fetch map data: " + str(error))
+            layers = None
+        # Empty layers must not replace stored ones, nor be found later as
+        # the layers of the bbox
+        if is_empty(layers):
+            if overlapping:
+                return self.store.load(overlapping[0])
+            return {name: None for name in LAYERS}
+
+        for key in overlapping:
+            self.store.remove(key)
+        self.store.save(fetch_bbox, layers)
+        return layers
+
+    def get_raster(self, north, south, east, west, zoom=2):
+        """
+        Get a pre-rendered image of the layers covering a bounding box
+
+        Args:
+            zoom: The image is 256 * 2**zoom pixels wide.
+
+        An image of empty layers, e.g. when offline, is not stored, so the
+        layers are fetched again the next time.
+
+        Returns:
+            image: An image array for imshow with
+            extent=(west, east, south, north).
+        """
+        bbox = (north, south, east, west)
+        image = self.store.load_raster(bbox, zoom)
+        if image is None:
+            layers = self.get_layers(*bbox)
+            png = self.render(bbox, zoom, layers)
+            if is_empty(layers):
+                import matplotlib.image as mpimg
+                return mpimg.imread(io.BytesIO(png), format="png")
+            self.store.save_raster(bbox, zoom, png)
+            image = self.store.load_raster(bbox, zoom)
+        return image
+
+    def render(self, bbox, zoom, layers=None):
+        """
+        Render the layers covering bbox to png bytes
+
+        Args:
+            layers: The layers to render, see get_layers, those covering
+                bbox by default.
+        """
+        if layers is None:
+            layers = self.get_layers(*bbox)
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        north, south, east, west = bbox
+        width = 256 * 2**zoom
+        height = max(int(width * (north - south) / (east - west)), 1)
+        fig = Figure(figsize=(width / 100, height / 100), dpi=100)
+        FigureCanvasAgg(fig)
+        ax = fig.add_axes([0, 0, 1, 1])
+        plot_layers(ax, layers)
+        ax.set_xlim(west, east)
+        ax.set_ylim(south, north)
+        ax.set_axis_off()
+        png = io.BytesIO()
+        fig.savefig(png, format="png", dpi=100)
+        return png.getvalue()
+
+
+def plot_layers(ax, layers):
+    """Plot the map layers onto matplotlib axes ax"""
+    if layers.get("area") is not None:
+        layers["area"].plot(ax=ax, facecolor='black')
+    if layers.get("edges") is not None:
+        layers["edges"].plot(ax=ax, linewidth=1, edgecolor='#BC8F8F')
+    if layers.get("buildings") is not None:
+        layers["buildings"].plot(ax=ax, facecolor='khaki', alpha=0.7)
+    if layers.get("parks") is not None and len(layers["parks"]):
+        layers["parks"].plot(ax=ax, facecolor='limegreen')
@@ -0,0 +1,246 @@
+"""
+Headless batch processing of drone flight logs
+
+Every flight is loaded, aligned with its wind log (if any), binned and
+rendered to an image, next to a JSON summary with per-stage timings. The
+flights are processed in a pool of worker processes, which share the flight
+cache and the basemap store on disk.
+
+Usage:
+    python batch.py "logs/*.csv" --wind winds/ --out out/ --workers 4
+
+A wind log belongs to the flight log with the same name, or with the same
+name followed by "_wind".
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.18
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+from align import align_wind
+from basemap import Basemap, BasemapStore, OsmProvider, plot_layers
+from binning import bin_latest
+from mapdraw import GRID_SIZE, flight_bbox, read_drone_csv, read_wind_csv
+
+
+def find_logs(pattern):
+    """Return the .csv logs in a directory, or matching a glob pattern"""
+    if os.path.isdir(pattern):
+        pattern = os.path.join(pattern, "*.csv")
+    return sorted(glob.glob(pattern))
+
+
+def find_wind_log(flight_path, wind_logs):
+    """Return the wind log belonging to a flight log, or None"""
+    name = os.path.splitext(os.path.basename(flight_path))[0]
+    by_name = {os.path.splitext(os.path.basename(path))[0]: path
+               for path in wind_logs}
+    return by_name.get(name, by_name.get(name + "_wind"))
+
+
+class Timer():
+    """Collects the wall time of named stages"""
+
+    def __init__(self):
+        self.timings = {}
+
+    def stage(self, name):
+        return _Stage(self.timings, name)
+
+
+class _Stage():
+    def __init__(self, timings, name):
+        self.timings = timings
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timings[self.name] = self.timings.get(self.name, 0) \
+            + time.perf_counter() - self.start
+
+
+def load_bbox(flight_path):
+    """Worker task: parse a flight (filling the flight cache), get its bbox"""
+    timer = Timer()
+    with timer.stage("load"):
+        drone_data = read_drone_csv(flight_path)
+    return flight_bbox(drone_data), timer.timings
+
+
+def render(merged_data, layers, bbox, out_path):
+    """
+    Draw the map layers, the binned points and the wind onto an image file
+
+    Args:
+        merged_data: The binned points, sorted by time.
+        layers: The map layers, see basemap.Basemap.get_layers.
+        bbox: The (north, south, east, west) bbox to show.
+        out_path: The image file, the format is given by its extension.
+    """
+    north, south, east, west = bbox
+    fig = Figure(figsize=(10, 7))
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(1, 1, 1)
+    plot_layers(ax, layers)
+    ax.set_aspect("equal", adjustable="box")
+    ax.set_xlim(west, east)
+    ax.set_ylim(north, south)
+
+    longitudes = merged_data["OSD.longitude"].to_numpy()
+    latitudes = merged_data["OSD.latitude"].to_numpy()
+    ax.plot(longitudes[:-1], latitudes[:-1], 'co')
+    ax.plot(longitudes[-1:], latitudes[-1:], 'ro', markersize=7)
+    if "RANDOM.windSpeed" in merged_data.columns:
+        speed = merged_data["RANDOM.windSpeed"].to_numpy()
+        radians = np.radians(merged_data["RANDOM.direction"].to_numpy())
+        arrow_size_mod = 0.006 * (east - west)
+        ax.quiver(longitudes, latitudes, np.cos(radians) * speed,
+                  np.sin(radians) * speed, speed, cmap="viridis",
+                  angles="xy", scale_units="xy", units="xy",
+                  scale=1 / arrow_size_mod, width=arrow_size_mod)
+    fig.tight_layout()
+    fig.savefig(out_path)
+
+
+def process_flight(flight_path, wind_path, out_dir, image_format, offline,
+                   tolerance=0.05):
+    """
+    Worker task: load, align, bin and render one flight
+
+    Returns:
+        summary: A dict that is also written as JSON next to the image.
+    """
+    timer = Timer()
+    with timer.stage("load"):
+        drone_data = read_drone_csv(flight_path)
+        wind_data = None
+        if wind_path is not None:
+            wind_data = read_wind_csv(wind_path,
+                                      drone_data["CUSTOM.updateTime"].iloc[0])
+    with timer.stage("align"):
+        merged_data = drone_data
+        if wind_data is not None:
+            merged_data = align_wind(drone_data, wind_data, tolerance)
+    with timer.stage("bin"):
+        latest = bin_latest(merged_data["OSD.longitude"].to_numpy(),
+                            merged_data["OSD.latitude"].to_numpy(),
+                            merged_data["CUSTOM.updateTime"].to_numpy(),
+                            GRID_SIZE)
+        binned_data = merged_data.iloc[latest].sort_values(
+            "CUSTOM.updateTime", kind="mergesort")
+    with timer.stage("basemap"):
+        bbox = flight_bbox(drone_data)
+        if offline:
+            layers = BasemapStore().lookup(bbox)
+        else:
+            layers = Basemap(OsmProvider(), BasemapStore()).get_layers(*bbox)
+    name = os.path.splitext(os.path.basename(flight_path))[0]
+    image_path = os.path.join(out_dir, name + "." + image_format)
+    with timer.stage("render"):
+        render(binned_data, layers, bbox, image_path)
+
+    times = drone_data["CUSTOM.updateTime"]
+    summary = {
+        "flight": os.path.abspath(flight_path),
+        "wind": os.path.abspath(wind_path) if wind_path else None,
+        "image": os.path.abspath(image_path),
+        "rows": len(drone_data),
+        "bins": len(binned_data),
+        "start": str(times.min()),
+        "end": str(times.max()),
+        "duration_s": (times.max() - times.min()).total_seconds(),
+        "bbox": {"north": bbox[0], "south": bbox[1],
+                 "east": bbox[2], "west": bbox[3]},
+        "max_height_m": float(drone_data["OSD.height [m]"].max()),
+        "max_speed_ms": float(drone_data["CALC.hSpeed [m/s]"].max()),
+        "timings_s": timer.timings,
+    }
+    if wind_data is not None:
+        speed = merged_data["RANDOM.windSpeed"]
+        summary["wind_matched_rows"] = int(speed.notna().sum())
+        summary["mean_wind_speed_ms"] = float(speed.mean())
+    with open(os.path.join(out_dir, name + ".json"), "w") as out:
+        json.dump(summary, out, indent=2)
+    return summary
+
+
+def run(flight_logs, wind_logs, out_dir, workers=None, image_format="png",
+        offline=False):
+    """
+    Process flight logs in a pool of worker processes
+
+    The flights are first parsed in the pool to find their bboxes, and the
+    map layers are fetched once per bbox, so that the workers rendering the
+    flights find them in the shared basemap store. Offline, the store is
+    only read.
+
+    Returns:
+        (summaries, timings): The summary of each flight, in the order of
+        flight_logs, and the summed time of the first pass stages.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    timer = Timer()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        loaded = list(pool.map(load_bbox, flight_logs))
+        with timer.stage("basemap prefetch"):
+            if not offline:
+                basemap = Basemap(OsmProvider())
+                for bbox, _ in loaded:
+                    basemap.get_layers(*bbox)
+
+        futures = [pool.submit(process_flight, path,
+                               find_wind_log(path, wind_logs), out_dir,
+                               image_format, offline)
+                   for path in flight_logs]
+        summaries = [future.result() for future in futures]
+
+    timer.timings["parse"] = sum(timings["load"] for _, timings in loaded)
+    return summaries, timer.timings
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1])
+    parser.add_argument("flights",
+                        help="directory or glob pattern of drone csv logs")
+    parser.add_argument("--wind", help="directory or glob pattern of wind "
+                        "csv logs, matched to flights by name")
+    parser.add_argument("--out", default="out",
+                        help="directory for images and summaries")
+    parser.add_argument("--workers", type=int, default=None,
+                        help="number of worker processes, default all cores")
+    parser.add_argument("--format", choices=["png", "svg"], default="png")
+    parser.add_argument("--offline", action="store_true",
+                        help="only use map data already in the basemap store")
+    args = parser.parse_args(argv)
+
+    flight_logs = find_logs(args.flights)
+    wind_logs = find_logs(args.wind) if args.wind else []
+    start = time.perf_counter()
+    summaries, totals = run(flight_logs, wind_logs, args.out, args.workers,
+                            args.format, args.offline)
+    elapsed = time.perf_counter() - start
+
+    for summary in summaries:
+        for stage, seconds in summary["timings_s"].items():
+            totals[stage] = totals.get(stage, 0) + seconds
+    for stage, seconds in totals.items():
+        print("{0:<18} {1:9.3f} s".format(stage, seconds))
+    rows = sum(summary["rows"] for summary in summaries)
+    print("{0} flights, {1} rows in {2:.3f} s ({3:,.0f} rows/s)".format(
+        len(summaries), rows, elapsed, rows / elapsed if elapsed else 0))
+
+
+if __name__ == "__main__":
+    main()
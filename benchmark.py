@@ -0,0 +1,1126 @@
+"""
+Benchmarks for the data processing and drawing hot paths.
+
+Run with `python benchmark.py` to time each hot path on synthetic flight
+logs of 1k to 10M rows, or e.g. `python benchmark.py 1000 10000` for other
+sizes. Wall time, peak memory and rows/s are printed for every hot path.
+Use `--json results.json` to store the results and `--compare old.json` to
+list the hot paths that got slower than in an earlier run.
+
+The benchmarks run without a display (Agg backend) and without network: map
+data is never fetched, the map is drawn without layers.
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.19
+"""
+
+import argparse
+import datetime
+import gc
+import heapq
+import itertools
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from types import SimpleNamespace
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+import pandas as pd
+import perf
+
+# Nothing may fetch map data, importing osmnx raises ImportError
+sys.modules["osmnx"] = None
+# Keep the benchmark logs out of the user's flight cache
+os.environ["DRONEMAP_CACHE"] = tempfile.mkdtemp(prefix="dronemap-bench-")
+
+
+SIZES = [1000, 10000, 100000, 1000000, 10000000]
+# The legacy loader is too slow for larger logs
+LEGACY_MAX_ROWS = 100000
+DEFAULT_LOG = "Data/attitutf.csv"
+FLIGHT_START = datetime.datetime(2020, 2, 28, 13, 55, 1, 500000)
+NUM_FRAMES = 50
+NUM_CLICKS = 200
+SESSION_ROWS = 100000
+# One hour at 10 Hz
+PLAYBACK_ROWS = 36000
+SCRUB_ROWS = 100000
+PARALLEL_ROWS = 1000000
+# The startup of the GUI up to its first frame of a flight, without Tk: run
+# in a new interpreter, so that nothing has been imported yet
+STARTUP_SCRIPT = """
+import json, sys
+sys.modules["osmnx"] = None
+import perf
+import guimain
+perf.mark("modules imported")
+import matplotlib
+matplotlib.use("Agg")
+from mapdraw import DroneMap
+from loader import Loader
+perf.mark("map modules imported")
+drone_map = DroneMap(csv_path=None)
+loader = Loader(drone_map)
+drone_map.redraw()
+perf.mark("empty map shown")
+loader.load_flight(sys.argv[1], fetch_map=False)
+flight = None
+while flight is None:
+    for job, event, data in loader.poll():
+        if event == "flight":
+            flight = data
+        elif event == "error":
+            raise data
+drone_map.show_view(flight["bbox"])
+drone_map.show_flight(flight["drone_data"], flight["points"], flight["bins"])
+perf.mark("first flight frame")
+loader.close()
+print(json.dumps(perf.MARKS))
+"""
+# Ingesting a log out of core, in a new interpreter to find its peak memory
+INGEST_SCRIPT = """
+import json, resource, sys, time
+sys.modules["osmnx"] = None
+from outofcore import ingest
+start = time.perf_counter()
+summary = ingest(sys.argv[1], sys.argv[2])
+elapsed = time.perf_counter() - start
+# Kilobytes on Linux
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+print(json.dumps({"seconds": elapsed, "peak_rss": peak,
+                  "cells": summary["num_cells"]}))
+"""
+
+
+def dji_columns(source=DEFAULT_LOG):
+    """Return the column names of a DJI flight log"""
+    with open(source, encoding="utf-8") as log:
+        return log.readline().strip().split(",")
+
+
+def time_fields(deciseconds):
+    """Format times as "MM:SS.f" like the CUSTOM.updateTime of DJI logs"""
+    digits = [(deciseconds // 6000) % 6, (deciseconds // 600) % 10,
+              (deciseconds // 100) % 6, (deciseconds // 10) % 10,
+              deciseconds % 10]
+    chars = np.empty((len(deciseconds), 7), dtype=np.uint8)
+    for i, column in enumerate([0, 1, 3, 4, 6]):
+        chars[:, column] = ord("0") + digits[i]
+    chars[:, 2] = ord(":")
+    chars[:, 5] = ord(".")
+    return chars
+
+
+def synthetic_log(path, num_rows, seed=0, full_schema=False,
+                  chunk_size=60000):
+    """
+    Write a DJI flight log with num_rows rows of a random flight at 10 Hz
+
+    The flight is a random walk around the area of the default log. As in
+    the DJI logs, the times only hold minutes and seconds, and a row with
+    the date and hour follows every chunk_size rows.
+
+    Args:
+        path: Where to write the log.
+        num_rows: Number of time rows.
+        seed: Seed for the random generator.
+        full_schema: Write all columns of a DJI log, the ones not read by
+            read_drone_csv are left empty. Otherwise only the columns read
+            by read_drone_csv are written, in the same order.
+        chunk_size: Number of rows generated at once.
+    """
+    from mapdraw import DRONE_COLUMNS
+    from wind_rnd import format_fixed, join_fields, reflect
+    columns = dji_columns()
+    if not full_schema:
+        columns = [column for column in columns if column in DRONE_COLUMNS]
+    rng = np.random.default_rng(seed)
+    start = (FLIGHT_START.minute * 60 + FLIGHT_START.second) * 10 \
+        + FLIGHT_START.microsecond // 100000
+    last = {"OSD.longitude": 18.2761, "OSD.latitude": 59.4851,
+            "OSD.height [m]": 20.0, "OSD.yaw": 0.0}
+
+    with open(path, "wb") as log:
+        log.write((",".join(columns) + "\n").encode("utf-8"))
+        for first in range(0, num_rows, chunk_size):
+            size = min(chunk_size, num_rows - first)
+            walk = {
+                "OSD.longitude": rng.normal(0, 0.000002, size),
+                "OSD.latitude": rng.normal(0, 0.000001, size),
+                "OSD.height [m]": rng.normal(0, 0.1, size),
+                "OSD.yaw": rng.normal(0, 2, size),
+            }
+            for column, steps in walk.items():
+                walk[column] = last[column] + np.cumsum(steps)
+                last[column] = walk[column][-1]
+            values = {
+                "OSD.latitude": (walk["OSD.latitude"], 6),
+                "OSD.longitude": (walk["OSD.longitude"], 6),
+                "OSD.height [m]": (reflect(walk["OSD.height [m]"], 0, 120),
+                                   1),
+                "OSD.pitch": (rng.uniform(-15, 15, size), 1),
+                "OSD.roll": (rng.uniform(-15, 15, size), 1),
+                "OSD.yaw": ((walk["OSD.yaw"] + 180) % 360 - 180, 1),
+                "CALC.hSpeed [m/s]": (rng.uniform(0, 15, size), 2),
+            }
+            deciseconds = start + np.arange(first, first + size)
+            fields = []
+            for column in columns:
+                if column == "CUSTOM.updateTime":
+                    fields.append(time_fields(deciseconds))
+                elif column in values:
+                    fields.append(format_fixed(*values[column]))
+                else:
+                    fields.append(np.zeros((size, 0), dtype=np.uint8))
+            log.write(join_fields(fields))
+
+            date = FLIGHT_START + datetime.timedelta(
+                seconds=(deciseconds[-1] - start) / 10)
+            log.write((date.strftime("%d/%m/%Y %H:%M")
+                       + "," * (len(columns) - 1) + "\n").encode("utf-8"))
+
+
+def synthetic_wind(path, num_rows, seed=0):
+    """Write a wind log covering a synthetic flight of num_rows rows"""
+    from wind_rnd import generate_wind_data
+    generate_wind_data(os.path.splitext(path)[0], num_rows, seed=seed)
+
+
+def legacy_read_drone_csv(csv_path):
+    """The read_drone_csv implementation from version 2020.05.01"""
+    data = pd.read_csv(csv_path, delimiter=",", encoding="utf-8")
+    data = data[["CUSTOM.updateTime", "OSD.latitude", "OSD.longitude",
+                 "OSD.pitch", "OSD.yaw", "OSD.roll", "OSD.height [m]",
+                 "CALC.hSpeed [m/s]"]]
+    dates = pd.to_datetime(data["CUSTOM.updateTime"], errors="coerce",
+                           format="%d/%m/%Y %H:%M")
+    date = dates.dropna().iloc[0]
+    data["CUSTOM.updateTime"] = pd.to_datetime(data["CUSTOM.updateTime"],
+                                               errors="coerce",
+                                               format="%M:%S.%f")
+    data = data.dropna()
+    data["CUSTOM.updateTime"] = data["CUSTOM.updateTime"].apply(
+        lambda x: x.replace(year=date.year, month=date.month, day=date.day,
+                            hour=date.hour))
+    return data
+
+
+def measure(function, *args):
+    """
+    Call function and measure wall time and peak traced memory
+
+    The function is called twice, the time is taken without tracing
+    memory, since tracing slows down code allocating many python objects.
+
+    Returns:
+        (elapsed, peak, result): Seconds, peak bytes and the return value.
+    """
+    start = time.perf_counter()
+    result = function(*args)
+    elapsed = time.perf_counter() - start
+    del result
+    tracemalloc.start()
+    result = function(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak, result
+
+
+def measure_repeated(function, arguments):
+    """
+    Call function once per argument tuple
+
+    Returns:
+        (elapsed, peak): Seconds per call and peak bytes of one call.
+    """
+    start = time.perf_counter()
+    for args in arguments:
+        function(*args)
+    elapsed = (time.perf_counter() - start) / len(arguments)
+    tracemalloc.start()
+    function(*arguments[0])
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def collections_per_call(function, arguments):
+    """
+    Call function once per argument tuple
+
+    Returns:
+        collections: The number of garbage collections, of any generation,
+        per call.
+    """
+    gc.collect()
+    before = sum(stats["collections"] for stats in gc.get_stats())
+    for args in arguments:
+        function(*args)
+    after = sum(stats["collections"] for stats in gc.get_stats())
+    return (after - before) / len(arguments)
+
+
+def result(name, flight_rows, rows, elapsed, peak, **extra):
+    """Return one benchmark result, rows is the number of rows handled"""
+    return dict(name=name, flight_rows=flight_rows, rows=rows,
+                seconds=elapsed, peak_bytes=peak,
+                rows_per_s=rows / elapsed if elapsed else None, **extra)
+
+
+def bench_flight(num_rows, full_schema=False):
+    """
+    Time the hot paths of showing a synthetic flight of num_rows rows
+
+    Covers reading the log (with and without the flight cache, and with
+    the legacy loader for small logs), binning, computing the metrics,
+    drawing a frame, scrubbing back, drawing wind and picking a clicked
+    point and looking up its metrics. MapFrame.onpick needs Tk, so the
+    pick benchmark times DroneMap.pick, which does the work of onpick.
+
+    Returns:
+        results: A list of results, see result.
+    """
+    from basemap import Basemap, BasemapStore, StaticProvider
+    from flightcache import FlightCache
+    from mapdraw import DroneMap, bin_flight, read_drone_csv
+    from metrics import flight_metrics
+    import matplotlib.pyplot as plt
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "flight.csv")
+    wind_path = os.path.join(tmp_dir, "wind.csv")
+    results = []
+    try:
+        synthetic_log(path, num_rows, full_schema=full_schema)
+        synthetic_wind(wind_path, num_rows)
+
+        elapsed, peak, _ = measure(read_drone_csv, path, False)
+        results.append(result("read_drone_csv", num_rows, num_rows,
+                              elapsed, peak))
+        if num_rows <= LEGACY_MAX_ROWS:
+            elapsed, peak, _ = measure(legacy_read_drone_csv, path)
+            results.append(result("read_drone_csv legacy", num_rows,
+                                  num_rows, elapsed, peak))
+        cache = FlightCache(os.path.join(tmp_dir, "cache"))
+        read_drone_csv(path, cache)
+        elapsed, peak, _ = measure(read_drone_csv, path, cache)
+        results.append(result("read_drone_csv cached", num_rows, num_rows,
+                              elapsed, peak))
+
+        basemap = Basemap(StaticProvider(),
+                          BasemapStore(os.path.join(tmp_dir, "basemap")))
+        results.append(bench_load(path, num_rows, basemap))
+        drone_map = DroneMap(path, basemap)
+        elapsed, peak, binned = measure(drone_map.grid_bin_data,
+                                        drone_map.drone_data)
+        results.append(result("grid_bin_data", num_rows, num_rows, elapsed,
+                              peak, cells=len(binned)))
+        del binned
+        elapsed, peak, (_, bins) = measure(bin_flight, drone_map.drone_data)
+        results.append(result("bin_flight", num_rows, num_rows, elapsed,
+                              peak, cells=bins.num_cells))
+        del bins
+        elapsed, peak, _ = measure(flight_metrics, drone_map.points)
+        results.append(result("flight_metrics", num_rows,
+                              len(drone_map.points), elapsed, peak))
+
+        # Frames at increasing flight percent, with and without history
+        drone_map.fig.canvas.draw()
+        frames = [(percent, span) for percent in
+                  np.linspace(0.02, 1, NUM_FRAMES) for span in (0, 10)]
+        elapsed, peak = measure_repeated(drone_map.draw_drone, frames)
+        results.append(result(
+            "draw_drone", num_rows, len(drone_map.points), elapsed, peak,
+            gc_per_frame=collections_per_call(drone_map.draw_drone, frames)))
+        # Scrubbing back through the whole history, which rebins it
+        frames_back = [(percent, 0) for percent in
+                       np.linspace(1, 0.02, NUM_FRAMES)]
+        elapsed, peak = measure_repeated(drone_map.draw_drone, frames_back)
+        results.append(result("draw_drone back", num_rows,
+                              len(drone_map.points), elapsed, peak))
+
+        elapsed, peak, _ = measure(drone_map.draw_wind, wind_path)
+        results.append(result("draw_wind", num_rows, num_rows, elapsed,
+                              peak))
+        drone_map.fig.canvas.draw()
+        elapsed, peak = measure_repeated(drone_map.draw_drone, frames)
+        results.append(result(
+            "draw_drone wind", num_rows, len(drone_map.points), elapsed,
+            peak,
+            gc_per_frame=collections_per_call(drone_map.draw_drone, frames),
+            points_bytes=drone_map.points.nbytes()))
+
+        # Clicks on drawn points, in display coordinates
+        drone_map.draw_drone(1, 0)
+        clicks = np.random.default_rng(1).integers(
+            0, len(drone_map.points), NUM_CLICKS)
+        pixels = drone_map.ax.transData.transform(np.column_stack(
+            [drone_map.longitudes[clicks], drone_map.latitudes[clicks]]))
+        events = [(SimpleNamespace(x=x, y=y),) for x, y in pixels]
+        elapsed, peak = measure_repeated(drone_map.pick, events)
+        results.append(result("pick", num_rows, len(drone_map.points),
+                              elapsed, peak))
+        rows = [(int(row),) for row in clicks]
+        elapsed, peak = measure_repeated(drone_map.metrics_at, rows)
+        results.append(result("metrics_at wind", num_rows,
+                              len(drone_map.points), elapsed, peak))
+        plt.close(drone_map.fig)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def bench_load(path, num_rows, basemap, tick=0.01):
+    """
+    Time loading a flight in the background, see loader.Loader
+
+    The main thread does tick seconds of work at a time, like callbacks
+    of the Tk event loop, while the flight is read, binned and its map
+    fetched. The longest time between two ticks is how long the GUI would
+    freeze.
+
+    Returns:
+        result: The time of the load, with the longest stall in stall_ms.
+    """
+    from loader import Loader
+    from mapdraw import DroneMap
+    import matplotlib.pyplot as plt
+    drone_map = DroneMap(None, basemap)
+    loader = Loader(drone_map)
+    start = last = time.perf_counter()
+    stall = 0
+    loader.load_flight(path)
+    while loader.busy():
+        while time.perf_counter() - last < tick:
+            pass
+        now = time.perf_counter()
+        stall = max(stall, now - last - tick)
+        last = now
+    elapsed = time.perf_counter() - start
+    loader.poll()
+    loader.close()
+    plt.close(drone_map.fig)
+    return result("load background", num_rows, num_rows, elapsed, 0,
+                  stall_ms=stall * 1000)
+
+
+def bench_history(num_points, zooms=(1, 10, 100, 1000)):
+    """
+    Time drawing a history of num_points points at increasing zoom
+
+    The points of a random walk are set as the binned points of a DroneMap
+    and the whole history is shown, zoomed in around the latest point.
+
+    Returns:
+        results: For every zoom, the time of a full draw of the map after
+        zooming, which chooses the drawn points for the new view, and the
+        time of a blitted frame.
+    """
+    import mapdraw
+    from basemap import Basemap, BasemapStore, StaticProvider
+    import matplotlib.pyplot as plt
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "flight.csv")
+    results = []
+    try:
+        synthetic_log(path, 1000)
+        drone_map = mapdraw.DroneMap(path, Basemap(
+            StaticProvider(), BasemapStore(os.path.join(tmp_dir, "basemap"))))
+        rng = np.random.default_rng(3)
+        start = np.datetime64("2020-02-28T13:55", "ns")
+        drone_map.set_merged_data(pd.DataFrame({
+            "CUSTOM.updateTime": start + (np.arange(num_points) * 100000000)
+            .astype("timedelta64[ns]"),
+            "OSD.longitude": 18.2761 + np.cumsum(
+                rng.normal(0, 0.000002, num_points)),
+            "OSD.latitude": 59.4851 + np.cumsum(
+                rng.normal(0, 0.000001, num_points)),
+        }))
+        drone_map.ax.set_xlim(drone_map.longitudes.min(),
+                              drone_map.longitudes.max())
+        drone_map.ax.set_ylim(drone_map.latitudes.max(),
+                              drone_map.latitudes.min())
+        canvas = drone_map.fig.canvas
+        elapsed, peak, _ = measure(drone_map.draw_drone, 1, 0)
+        results.append(result("draw history build", num_points, num_points,
+                              elapsed, peak))
+
+        def redraw_history():
+            # The same window, which draw_drone would skip
+            drone_map.invalidate()
+            drone_map.draw_drone(1, 0)
+
+        x = drone_map.longitudes[-1]
+        y = drone_map.latitudes[-1]
+        (x0, x1), (y0, y1) = drone_map.ax.get_xlim(), drone_map.ax.get_ylim()
+        for zoom in zooms:
+            drone_map.ax.set_xlim(x - (x1 - x0) / zoom / 2,
+                                  x + (x1 - x0) / zoom / 2)
+            drone_map.ax.set_ylim(y - (y1 - y0) / zoom / 2,
+                                  y + (y1 - y0) / zoom / 2)
+            drone_map.detail_views.clear()
+            elapsed, peak, _ = measure(canvas.draw)
+            frame, _ = measure_repeated(redraw_history, [()] * 10)
+            results.append(result(
+                "draw history x{0}".format(zoom), num_points, num_points,
+                elapsed, peak, frame_ms=frame * 1000,
+                drawn=len(drone_map.drone_points[0].get_xdata())))
+        plt.close(drone_map.fig)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def bench_stream(seconds=10, rate=50, poll_interval=0.02, port=5099):
+    """
+    Stream a synthetic flight over UDP into a live DroneMap
+
+    A ReplayServer plays back a 10 Hz log at rate / 10 times the speed for
+    the given number of seconds, and the rows are read, appended and drawn
+    every poll_interval seconds, like the Tk loop of the GUI does.
+
+    Returns:
+        results: One result, with the ingest rate, the time per map update
+        and the latency from sending a row to having drawn it.
+    """
+    from basemap import Basemap, BasemapStore, StaticProvider
+    from mapdraw import DroneMap
+    from stream import LiveFlight, ReplayServer, SocketSource
+    import matplotlib.pyplot as plt
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "flight.csv")
+    try:
+        synthetic_log(path, seconds * rate)
+        drone_map = DroneMap(path, Basemap(
+            StaticProvider(), BasemapStore(os.path.join(tmp_dir, "basemap"))))
+        drone_map.fig.canvas.draw()
+        source = SocketSource("127.0.0.1", port)
+        server = ReplayServer(path, ("127.0.0.1", port), "udp",
+                              speed=rate / 10).start()
+        live = LiveFlight()
+        started = time.perf_counter()
+        latencies = []
+        updates = []
+        while server.thread.is_alive() or live.total < len(server.sent_times):
+            start = time.perf_counter()
+            num_rows = live.extend(source.read_lines())
+            if num_rows:
+                drone_map.show_live(live)
+                done = time.perf_counter()
+                updates.append(done - start)
+                latencies.extend(done - np.array(
+                    server.sent_times[live.total - num_rows:live.total]))
+            time.sleep(max(poll_interval - (time.perf_counter() - start), 0))
+        elapsed = time.perf_counter() - started
+        server.stop()
+        source.close()
+        tracemalloc.start()
+        drone_map.show_live(live)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        plt.close(drone_map.fig)
+    finally:
+        shutil.rmtree(tmp_dir)
+    latencies = np.array(latencies) * 1000
+    return [result("stream {0} Hz".format(rate), live.total, live.total,
+                   elapsed, peak, update_ms=float(np.mean(updates) * 1000),
+                   latency_p50_ms=float(np.percentile(latencies, 50)),
+                   latency_p99_ms=float(np.percentile(latencies, 99)),
+                   latency_max_ms=float(latencies.max()))]
+
+
+def bench_playback(seconds=10, speed=64, num_rows=PLAYBACK_ROWS):
+    """
+    Play a synthetic 10 Hz flight on a DroneMap in real time
+
+    Frames are drawn like MapFrame.play_frame does, with the history
+    shown, sleeping until the next frame is due. When the end of the
+    flight is reached it is played again from the start.
+
+    Returns:
+        results: One result, with the frames per second, the dropped
+        frames, the 99th percentile of the frame time, and the seconds of
+        flight played per second divided by the speed, 1 when playback
+        keeps up with real time.
+    """
+    from basemap import Basemap, BasemapStore, StaticProvider
+    from mapdraw import DroneMap
+    from playback import Playback
+    import matplotlib.pyplot as plt
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "flight.csv")
+    try:
+        synthetic_log(path, num_rows)
+        drone_map = DroneMap(path, Basemap(
+            StaticProvider(), BasemapStore(os.path.join(tmp_dir, "basemap"))))
+        drone_map.fig.canvas.draw()
+        playback = Playback(*drone_map.timeline(), speed=speed)
+        playback.play()
+        frame_times = []
+        played = 0
+        last = playback.position()
+        started = time.perf_counter()
+        while time.perf_counter() - started < seconds:
+            position, delay = playback.tick()
+            start = time.perf_counter()
+            drone_map.draw_drone(time_span=0, time_end=position)
+            frame_times.append(time.perf_counter() - start)
+            played += position - last
+            last = position
+            if delay is None:
+                playback.play()
+                last = playback.position()
+                continue
+            time.sleep(delay)
+        elapsed = time.perf_counter() - started
+        tracemalloc.start()
+        drone_map.draw_drone(time_span=0, time_end=last)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        plt.close(drone_map.fig)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return [result("playback {0:g}x".format(speed), num_rows,
+                   len(frame_times), elapsed, peak,
+                   fps=len(frame_times) / elapsed, dropped=playback.dropped,
+                   frame_p99_ms=float(np.percentile(frame_times, 99) * 1000),
+                   real_time=played / 10**9 / elapsed / speed)]
+
+
+class EventLoop():
+    """
+    Runs callbacks scheduled with after, like the Tk event loop, to drive
+    a scheduler.RenderScheduler without a display
+    """
+
+    def __init__(self):
+        self.timers = []
+        self.ids = itertools.count()
+
+    def after(self, ms, callback):
+        timer = next(self.ids)
+        heapq.heappush(self.timers,
+                       (time.perf_counter() + ms / 1000, timer, callback))
+        return timer
+
+    def after_cancel(self, timer):
+        self.timers = [entry for entry in self.timers if entry[1] != timer]
+        heapq.heapify(self.timers)
+
+    def run_until(self, end):
+        """Run the callbacks due before end, sleeping in between"""
+        while True:
+            now = time.perf_counter()
+            if self.timers and self.timers[0][0] <= now:
+                heapq.heappop(self.timers)[2]()
+            elif now >= end:
+                return
+            else:
+                time.sleep(min(self.timers[0][0] if self.timers else end,
+                               end) - now)
+
+
+def bench_scrub(seconds=2, rate=1000, num_rows=SCRUB_ROWS):
+    """
+    Scrub through a synthetic flight with slider events at rate Hz
+
+    The slider moves from the start to the end of the flight in the given
+    number of seconds. Every event is either drawn at once, like the GUI
+    did before, or requested from a RenderScheduler, like MapFrame does.
+
+    Returns:
+        results: For both ways, the time to handle all events, with the
+        number of renders and the CPU seconds used per second.
+    """
+    from basemap import Basemap, BasemapStore, StaticProvider
+    from mapdraw import DroneMap
+    from scheduler import RenderScheduler
+    import matplotlib.pyplot as plt
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "flight.csv")
+    results = []
+    try:
+        synthetic_log(path, num_rows)
+        drone_map = DroneMap(path, Basemap(
+            StaticProvider(), BasemapStore(os.path.join(tmp_dir, "basemap"))))
+        drone_map.fig.canvas.draw()
+        num_events = seconds * rate
+        for mode in ("immediate", "coalesced"):
+            state = {"percent": 0}
+            loop = EventLoop()
+            draws = [0]
+
+            def render():
+                draws[0] += 1
+                drone_map.draw_drone(state["percent"], 10)
+
+            renderer = RenderScheduler(loop, render)
+            drone_map.draw_drone(0, 10)
+            started = time.perf_counter()
+            cpu = time.process_time()
+            for event in range(1, num_events + 1):
+                loop.run_until(started + event / rate)
+                state["percent"] = event / num_events
+                if mode == "immediate":
+                    render()
+                else:
+                    renderer.request()
+            while loop.timers:
+                loop.run_until(loop.timers[0][0])
+            elapsed = time.perf_counter() - started
+            cpu = time.process_time() - cpu
+            results.append(result(
+                "scrub " + mode, num_rows, num_events, elapsed, 0,
+                renders=draws[0], cpu_per_s=cpu / elapsed))
+        plt.close(drone_map.fig)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def bench_startup(path=DEFAULT_LOG, runs=3):
+    """
+    Time the startup of the GUI, up to the first frame of the default flight
+
+    Every run is a new interpreter doing what guimain does, without a
+    window: import guimain, then the map modules, show an empty map and
+    load and draw the flight. The first run reads the flight log, the
+    later runs find it in the flight cache.
+
+    Returns:
+        results: The cold and the warm start, each with the milliseconds
+        until each stage of perf.startup_report was reached.
+    """
+    here = os.path.dirname(os.path.abspath(__file__))
+    num_rows = len(pd.read_csv(path, usecols=[0]))
+    runs_marks = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", STARTUP_SCRIPT, path], cwd=here,
+            check=True, stdout=subprocess.PIPE, universal_newlines=True,
+            env=dict(os.environ, PYTHONPATH=here)).stdout
+        runs_marks.append(dict(json.loads(output.splitlines()[-1])))
+    results = []
+    for name, marks in (("startup cold", runs_marks[0]),
+                        ("startup warm", runs_marks[-1])):
+        results.append(result(
+            name, num_rows, num_rows, marks["first flight frame"], 0,
+            **{stage.replace(" ", "_") + "_ms": seconds * 1000
+               for stage, seconds in marks.items()}))
+    return results
+
+
+def bench_out_of_core(num_rows):
+    """
+    Time a synthetic flight of num_rows rows loaded out of core
+
+    The log is ingested by a new interpreter, whose peak resident memory
+    is reported, then drawn from the memory-mapped files: frames forward
+    and back, with and without history, and the wind joined on disk.
+
+    Returns:
+        results: A list of results, see result.
+    """
+    from basemap import Basemap, BasemapStore, StaticProvider
+    from mapdraw import DroneMap
+    from outofcore import MappedFlight
+    import matplotlib.pyplot as plt
+    here = os.path.dirname(os.path.abspath(__file__))
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "flight.csv")
+    wind_path = os.path.join(tmp_dir, "wind.csv")
+    directory = os.path.join(tmp_dir, "mapped")
+    os.mkdir(directory)
+    results = []
+    try:
+        synthetic_log(path, num_rows)
+        # A wind sample per second
+        synthetic_wind(wind_path, num_rows // 10)
+        output = subprocess.run(
+            [sys.executable, "-c", INGEST_SCRIPT, path, directory],
+            cwd=here, check=True, stdout=subprocess.PIPE,
+            universal_newlines=True,
+            env=dict(os.environ, PYTHONPATH=here)).stdout
+        ingested = json.loads(output.splitlines()[-1])
+        results.append(result(
+            "ingest", num_rows, num_rows, ingested["seconds"], 0,
+            peak_rss=ingested["peak_rss"], cells=ingested["cells"],
+            log_bytes=os.path.getsize(path)))
+
+        start = time.perf_counter()
+        mapped = MappedFlight(directory)
+        points, bins = mapped.flight(), mapped.bins()
+        drone_map = DroneMap(None, Basemap(
+            StaticProvider(), BasemapStore(os.path.join(tmp_dir, "basemap"))))
+        drone_map.show_view(mapped.bbox())
+        drone_map.show_flight(mapped.frame(), points, bins, mapped)
+        results.append(result("open mapped", num_rows, num_rows,
+                              time.perf_counter() - start, 0))
+
+        drone_map.fig.canvas.draw()
+        frames = [(percent, span) for percent in
+                  np.linspace(0.02, 1, NUM_FRAMES) for span in (0, 10)]
+        elapsed, peak = measure_repeated(drone_map.draw_drone, frames)
+        results.append(result("draw_drone mapped", num_rows, num_rows,
+                              elapsed, peak))
+        frames_back = [(percent, 0) for percent in
+                       np.linspace(1, 0.02, NUM_FRAMES)]
+        elapsed, peak = measure_repeated(drone_map.draw_drone, frames_back)
+        results.append(result("draw_drone mapped back", num_rows, num_rows,
+                              elapsed, peak))
+
+        start = time.perf_counter()
+        tracemalloc.start()
+        drone_map.draw_wind(wind_path)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        results.append(result("draw_wind mapped", num_rows, num_rows,
+                              time.perf_counter() - start, peak))
+        plt.close(drone_map.fig)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def bench_session(num_flights, num_rows=SESSION_ROWS):
+    """
+    Add num_flights flights of num_rows rows to a session and show it
+
+    The flights are the same synthetic log moved in time and space.
+
+    Returns:
+        results: The time and memory of adding the flights, with the
+        memory per flight and the size of the columns of a flight, and the
+        time of showing the session and of a frame.
+    """
+    from basemap import Basemap, BasemapStore, StaticProvider
+    from mapdraw import DroneMap, read_drone_csv
+    from session import Session, flight_bins
+    import matplotlib.pyplot as plt
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "flight.csv")
+    try:
+        synthetic_log(path, num_rows)
+        drone_data = read_drone_csv(path, False)
+        flights = []
+        for i in range(num_flights):
+            flight = drone_data.copy()
+            flight["CUSTOM.updateTime"] += np.timedelta64(i * 600, "s")
+            flight["OSD.longitude"] += i * 0.0005
+            flights.append((str(i),) + flight_bins(flight))
+        raw_bytes = int(drone_data.memory_usage(index=False).sum())
+
+        def add_flights():
+            session = Session()
+            session.store.reserve(num_flights * num_rows)
+            for name, flight, bins in flights:
+                session.add(name, flight, bins)
+            return session
+
+        elapsed, peak, session = measure(add_flights)
+        results = [result("session add", num_flights * num_rows,
+                          num_flights * num_rows, elapsed, peak,
+                          flights=num_flights,
+                          bytes_per_flight=peak / num_flights,
+                          raw_bytes_per_flight=raw_bytes)]
+
+        drone_map = DroneMap(None, Basemap(
+            StaticProvider(), BasemapStore(os.path.join(tmp_dir, "basemap"))))
+        drone_map.show_basemap(drone_map.fetch_basemap(session.bbox()),
+                               session.bbox())
+        drone_map.fig.canvas.draw()
+        elapsed, peak, _ = measure(drone_map.show_session, session)
+        results.append(result("show_session", num_flights * num_rows,
+                              len(drone_map.points), elapsed, peak))
+        frames = [(percent, span) for percent in
+                  np.linspace(0.02, 1, NUM_FRAMES) for span in (0, 10)]
+        elapsed, peak = measure_repeated(drone_map.draw_drone, frames)
+        results.append(result("draw_drone session", num_flights * num_rows,
+                              len(drone_map.points), elapsed, peak))
+        plt.close(drone_map.fig)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def bench_parallel_parse(num_rows=PARALLEL_ROWS, full_schema=False,
+                         workers=None):
+    """
+    Compare parse_drone_csv with parse_drone_csv_parallel on a synthetic log
+
+    Args:
+        workers: The numbers of worker processes to time, by default 1, 2,
+            4, ... up to the number of cores.
+
+    Returns:
+        results: The serial parse, and the parallel parse with each number
+        of workers, with its speedup over the serial parse.
+    """
+    from mapdraw import parse_drone_csv
+    from parallelcsv import parse_drone_csv_parallel
+    cores = os.cpu_count() or 1
+    if workers is None:
+        workers = sorted({min(2**i, cores)
+                          for i in range(cores.bit_length() + 1)})
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, "flight.csv")
+    results = []
+    try:
+        synthetic_log(path, num_rows, full_schema=full_schema)
+        serial, peak, _ = measure(parse_drone_csv, path)
+        results.append(result("parse serial", num_rows, num_rows, serial,
+                              peak, log_bytes=os.path.getsize(path)))
+        for count in workers:
+            elapsed, peak, _ = measure(parse_drone_csv_parallel, path, count)
+            results.append(result(
+                "parse parallel {0}".format(count), num_rows, num_rows,
+                elapsed, peak, workers=count, speedup=serial / elapsed))
+    finally:
+        shutil.rmtree(tmp_dir)
+    return results
+
+
+def bench_align(num_points):
+    """Time aligning num_points wind samples onto as many drone samples"""
+    from align import align_wind
+    rng = np.random.default_rng(2)
+    start = np.datetime64("2020-02-28T13:55", "ns")
+    wind_data = pd.DataFrame({
+        "INCREMENTED.time": start + (np.arange(num_points) * 100000000)
+        .astype("timedelta64[ns]"),
+        "RANDOM.windSpeed": rng.uniform(5, 15, num_points),
+        "RANDOM.direction": rng.uniform(0, 360, num_points),
+    })
+    drone_data = pd.DataFrame({
+        "CUSTOM.updateTime": start + np.sort(rng.integers(
+            0, num_points * 100000000, num_points))
+        .astype("timedelta64[ns]"),
+    })
+    elapsed, peak, _ = measure(align_wind, drone_data, wind_data)
+    return [result("align_wind", num_points, num_points, elapsed, peak)]
+
+
+def environment():
+    """Describe the code and machine the benchmarks ran on"""
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+            text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+            check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+        "matplotlib": matplotlib.__version__,
+        "machine": platform.platform(),
+        "cpus": os.cpu_count(),
+    }
+
+
+def compare(results, baseline, threshold=1.2):
+    """
+    Find hot paths that got slower than in a baseline run
+
+    Args:
+        results: The results of this run.
+        baseline: The results of an earlier run.
+        threshold: Ratio of the times above which a hot path is reported.
+
+    Returns:
+        regressions: (result, baseline result) pairs that got slower.
+    """
+    earlier = {(old["name"], old["flight_rows"]): old for old in baseline}
+    regressions = []
+    for new in results:
+        old = earlier.get((new["name"], new["flight_rows"]))
+        if old is not None and new["seconds"] > threshold * old["seconds"]:
+            regressions.append((new, old))
+    return regressions
+
+
+def report(entry):
+    print("{0:<22} {1:>9} rows {2:>10.5f} s {3:>14,.0f} rows/s "
+          "{4:>9.1f} MB".format(entry["name"], entry["flight_rows"],
+                                entry["seconds"], entry["rows_per_s"] or 0,
+                                entry["peak_bytes"] / 2**20))
+
+
+def bench_spans(num_spans=100000):
+    """
+    Time perf.span, with tracing disabled and enabled, on a tracer of its
+    own so that the spans are not exported with --trace
+
+    Returns:
+        results: The time of num_spans spans in each mode, with the time
+        of one span in span_ns.
+    """
+    saved = perf.TRACER
+    perf.TRACER = perf.Tracer()
+    results = []
+    try:
+        for mode in ("disabled", "enabled"):
+            perf.TRACER.enabled = mode == "enabled"
+            start = time.perf_counter()
+            for _ in range(num_spans):
+                with perf.span("bench"):
+                    pass
+            elapsed = time.perf_counter() - start
+            results.append(result("perf.span " + mode, num_spans, num_spans,
+                                  elapsed, 0,
+                                  span_ns=elapsed / num_spans * 1e9))
+    finally:
+        perf.TRACER = saved
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the hot paths on synthetic flight logs")
+    parser.add_argument("sizes", nargs="*", type=int, default=SIZES,
+                        help="numbers of rows of the synthetic logs")
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare",
+                        help="list hot paths slower than in this results "
+                        "file, and exit with status 1 if there are any")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="slowdown ratio reported by --compare")
+    parser.add_argument("--full-schema", action="store_true",
+                        help="write all DJI columns in the synthetic logs")
+    parser.add_argument("--session-flights", type=int, default=24,
+                        help="number of flights of {0} rows in the session "
+                        "benchmark, 0 to skip it".format(SESSION_ROWS))
+    parser.add_argument("--stream-seconds", type=int, default=10,
+                        help="length of the live streaming benchmark, 0 to "
+                        "skip it")
+    parser.add_argument("--playback-seconds", type=int, default=10,
+                        help="length of the playback benchmark, 0 to skip "
+                        "it")
+    parser.add_argument("--scrub-seconds", type=int, default=2,
+                        help="length of the slider scrubbing benchmark, 0 "
+                        "to skip it")
+    parser.add_argument("--startup-runs", type=int, default=3,
+                        help="start the GUI this many times, without a "
+                        "window, 0 to skip")
+    parser.add_argument("--parallel-rows", type=int, default=PARALLEL_ROWS,
+                        help="rows of the log parsed by 1, 2, 4, ... worker "
+                        "processes, up to the number of cores, 0 to skip")
+    parser.add_argument("--out-of-core", type=int, nargs="*", default=[],
+                        metavar="ROWS",
+                        help="load logs of these numbers of rows out of "
+                        "core, e.g. 10000000 100000000")
+    parser.add_argument("--trace",
+                        help="record the stages of every hot path, and "
+                        "write them to this Chrome trace file")
+    args = parser.parse_args(argv)
+
+    if args.trace:
+        perf.enable()
+    results = []
+    try:
+        for entry in bench_spans():
+            report(entry)
+            print("{0:<22} {1:.0f} ns per span".format("", entry["span_ns"]))
+            results.append(entry)
+        for num_rows in args.sizes:
+            for entry in bench_flight(num_rows, args.full_schema) \
+                    + bench_history(num_rows) + bench_align(num_rows):
+                report(entry)
+                if "stall_ms" in entry:
+                    print("{0:<22} longest stall of the main thread "
+                          "{1:.1f} ms".format("", entry["stall_ms"]))
+                if "gc_per_frame" in entry:
+                    print("{0:<22} {1:.2f} garbage collections per "
+                          "frame".format("", entry["gc_per_frame"]))
+                if "points_bytes" in entry:
+                    print("{0:<22} drawn points with wind {1:.2f} "
+                          "MB".format("", entry["points_bytes"] / 2**20))
+                results.append(entry)
+        if args.startup_runs:
+            for entry in bench_startup(runs=args.startup_runs):
+                report(entry)
+                print("{0:<22} imports {1:.0f} ms, map modules {2:.0f} ms, "
+                      "empty map {3:.0f} ms".format(
+                          "", entry["modules_imported_ms"],
+                          entry["map_modules_imported_ms"],
+                          entry["empty_map_shown_ms"]))
+                results.append(entry)
+        if args.session_flights:
+            for entry in bench_session(args.session_flights):
+                report(entry)
+                if "bytes_per_flight" in entry:
+                    print("{0:<22} {1:.1f} MB per flight, columns of a "
+                          "flight {2:.1f} MB".format(
+                              "", entry["bytes_per_flight"] / 2**20,
+                              entry["raw_bytes_per_flight"] / 2**20))
+                results.append(entry)
+        if args.stream_seconds:
+            for entry in bench_stream(args.stream_seconds):
+                report(entry)
+                print("{0:<22} update {1:.1f} ms, latency p50 {2:.1f} ms, "
+                      "p99 {3:.1f} ms, max {4:.1f} ms".format(
+                          "", entry["update_ms"], entry["latency_p50_ms"],
+                          entry["latency_p99_ms"], entry["latency_max_ms"]))
+                results.append(entry)
+        if args.scrub_seconds:
+            for entry in bench_scrub(args.scrub_seconds):
+                report(entry)
+                print("{0:<22} {1} renders, {2:.2f} CPU s per s".format(
+                    "", entry["renders"], entry["cpu_per_s"]))
+                results.append(entry)
+        if args.parallel_rows:
+            for entry in bench_parallel_parse(args.parallel_rows,
+                                              args.full_schema):
+                report(entry)
+                if "speedup" in entry:
+                    print("{0:<22} {1:.2f} x the serial parse".format(
+                        "", entry["speedup"]))
+                results.append(entry)
+        for num_rows in args.out_of_core:
+            for entry in bench_out_of_core(num_rows):
+                report(entry)
+                if "peak_rss" in entry:
+                    print("{0:<22} peak resident memory {1:.0f} MB, log "
+                          "{2:.0f} MB".format("", entry["peak_rss"] / 2**20,
+                                               entry["log_bytes"] / 2**20))
+                results.append(entry)
+        if args.playback_seconds:
+            for entry in bench_playback(args.playback_seconds):
+                report(entry)
+                print("{0:<22} {1:.0f} fps, {2} frames dropped, frame p99 "
+                      "{3:.1f} ms, {4:.3f} x real time".format(
+                          "", entry["fps"], entry["dropped"],
+                          entry["frame_p99_ms"], entry["real_time"]))
+                results.append(entry)
+    finally:
+        shutil.rmtree(os.environ["DRONEMAP_CACHE"], ignore_errors=True)
+        if args.trace:
+            perf.export(args.trace)
+
+    if args.json:
+        with open(args.json, "w") as out:
+            json.dump(dict(environment(), full_schema=args.full_schema,
+                           results=results), out, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            regressions = compare(results, json.load(baseline)["results"],
+                                  args.threshold)
+        for new, old in regressions:
+            print("slower: {0} at {1} rows, {2:.5f} s -> {3:.5f} s".format(
+                new["name"], new["flight_rows"], old["seconds"],
+                new["seconds"]))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
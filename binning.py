@@ -0,0 +1,499 @@
+"""
+Vectorized grid binning of drone data points
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.08
+"""
+
+import math
+import numpy as np
+
+
+def cell_keys(x, y, grid_size):
+    """
+    Compute integer grid cell coordinates for every point in one pass
+
+    The grid starts at the rounded down minimum of the data and the cell
+    edges are generated with np.arange, exactly like the old per-cell loop,
+    so points lying on a cell edge end up in the same cell as before.
+
+    Args:
+        x: Array of x coordinates (longitude).
+        y: Array of y coordinates (latitude).
+        grid_size: The size of each grid square.
+
+    Returns:
+        (ix, iy): Two int64 arrays with the column and row of each point.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    return _axis_keys(x, grid_size), _axis_keys(y, grid_size)
+
+
+def _axis_start(values, grid_size):
+    return math.floor(values.min() / grid_size) * grid_size
+
+
+def _axis_keys(values, grid_size):
+    start = _axis_start(values, grid_size)
+    stop = math.ceil(values.max() / grid_size) * grid_size
+    edges = np.arange(start, stop, grid_size)
+    if len(edges) == 0:
+        edges = np.array([start])
+    keys = np.searchsorted(edges, values, side="right") - 1
+    return np.maximum(keys, 0).astype(np.int64)
+
+
+def bin_latest(x, y, t, grid_size):
+    """
+    Find the latest point in every occupied grid cell
+
+    The points are grouped by their integer cell key and the point with the
+    largest time in each group is picked. If several points share the
+    latest time they are all kept. Cells are returned ordered by column and
+    then by row, the same order the old per-cell loop produced.
+    Runs in O(n log n) for n points, independent of the bounding box size.
+
+    Args:
+        x: Array of x coordinates (longitude).
+        y: Array of y coordinates (latitude).
+        t: Array of sortable times (datetime64 or numbers).
+        grid_size: The size of each grid square.
+
+    Returns:
+        indices: Positional indices of the latest point(s) in each cell.
+    """
+    t = np.asarray(t)
+    if len(t) == 0:
+        return np.empty(0, dtype=np.int64)
+    ix, iy = cell_keys(x, y, grid_size)
+
+    # Group by cell, newest point last in each group
+    order = np.lexsort((t, iy, ix))
+    ix = ix[order]
+    iy = iy[order]
+    t = t[order]
+    new_cell = np.ones(len(order), dtype=bool)
+    new_cell[1:] = (ix[1:] != ix[:-1]) | (iy[1:] != iy[:-1])
+    group = np.cumsum(new_cell) - 1
+    last = np.append(np.flatnonzero(new_cell)[1:], len(order)) - 1
+    return order[t == t[last][group]]
+
+
+class TimeBins():
+    """
+    Latest point of every grid cell within a window of time
+
+    The points are sorted by time, so a window of time is a range of rows,
+    and binning the rows start:end keeps the latest row of every cell with
+    rows in the range. The rows of each cell are linked to the previous and
+    next row of the same cell, and are also sorted by cell and then by row
+    for binary searches:
+
+    - A window is binned from scratch with one binary search per occupied
+      cell, or by going through its rows if it has fewer rows than there
+      are cells, in O(cells log n) at most.
+    - Moving the window by a few rows, e.g. when the slider is dragged,
+      only updates the cells of the rows that entered or left the window.
+
+    The cells are those of bin_latest. Unlike bin_latest, only one row is
+    kept for a cell when several rows share the latest time, the last one.
+
+    Args:
+        x: Array of x coordinates (longitude), sorted by time.
+        y: Array of y coordinates (latitude), sorted by time.
+        grid_size: The size of each grid square.
+
+    Attributes:
+        num_cells: The number of occupied cells.
+        cell_x, cell_y: The center of every cell, to choose the points of
+            long histories, see select.
+        window: The (start, end) rows binned last.
+    """
+
+    def __init__(self, x, y, grid_size):
+        num_rows = len(x)
+        dtype = np.int32 if num_rows < 2**31 - 1 else np.int64
+        self.window = (0, 0)
+        if num_rows == 0:
+            self.num_cells = 0
+            self.cells = self.next = self.previous = np.empty(0, dtype=dtype)
+            self.keys = np.empty(0, dtype=np.int64)
+            self.cell_latest = np.empty(0, dtype=np.int64)
+            self.cell_x = self.cell_y = np.empty(0)
+            return
+        ix, iy = cell_keys(x, y, grid_size)
+        order = np.argsort(ix * (int(iy.max()) + 1) + iy, kind="stable")
+        key = ix[order] * (int(iy.max()) + 1) + iy[order]
+        same = key[1:] == key[:-1]
+        firsts = order[np.append(True, ~same)]
+        self.cell_x = _axis_start(x, grid_size) \
+            + (ix[firsts] + 0.5) * grid_size
+        self.cell_y = _axis_start(y, grid_size) \
+            + (iy[firsts] + 0.5) * grid_size
+        del ix, iy, key, firsts
+        sorted_cells = np.cumsum(np.append(True, ~same)) - 1
+        self.num_cells = int(sorted_cells[-1]) + 1
+        self.cells = np.empty(num_rows, dtype=dtype)
+        self.cells[order] = sorted_cells
+        # The rows sorted by cell, and by row within a cell
+        self.keys = sorted_cells * num_rows + order
+        del sorted_cells
+        # The next and previous row of the same cell, num_rows and -1 if
+        # there is none
+        self.next = np.full(num_rows, num_rows, dtype=dtype)
+        self.next[order[:-1][same]] = order[1:][same]
+        self.previous = np.full(num_rows, -1, dtype=dtype)
+        self.previous[order[1:][same]] = order[:-1][same]
+        # The latest row of every cell in the window, -1 if it has none
+        self.cell_latest = np.full(self.num_cells, -1, dtype=np.int64)
+
+    def move(self, start, end):
+        """
+        Bin the rows start:end, updating the bins of the last window
+
+        Args:
+            start, end: The rows of the window, sorted by time.
+        """
+        end = max(end, start)
+        old_start, old_end = self.window
+        if (start, end) == (old_start, old_end):
+            return
+        moved = abs(start - old_start) + abs(end - old_end)
+        if end <= old_start or start >= old_end or moved > self.num_cells:
+            self._bin(start, end)
+        else:
+            self._move_end(old_start, old_end, end)
+            self._move_start(old_start, start, end)
+        self.window = (start, end)
+
+    def rows(self):
+        """
+        Return the latest row of every cell in the window
+
+        Returns:
+            rows: The sorted rows.
+        """
+        start, end = self.window
+        if end - start <= self.num_cells:
+            rows = np.arange(start, end)
+            return rows[self.cell_latest[self.cells[start:end]] == rows]
+        rows = self.cell_latest[self.cell_latest >= 0]
+        rows.sort()
+        return rows
+
+    def latest_of(self, row):
+        """Return the latest row in the window of the cell of a row"""
+        return int(self.cell_latest[self.cells[row]])
+
+    def select(self, xlim, ylim, columns, rows, below):
+        """
+        Choose about one of the binned rows per screen bin, see
+        screen_bins, by the centers of their cells
+
+        Args:
+            xlim, ylim, columns, rows: The view and its bins.
+            below: Only rows before this one are chosen.
+
+        Returns:
+            chosen: The sorted rows.
+        """
+        latest = self.cell_latest
+        cells = np.flatnonzero((latest >= 0) & (latest < below))
+        chosen = latest[screen_bins(self.cell_x, self.cell_y, cells, xlim,
+                                    ylim, columns, rows)]
+        chosen.sort()
+        return chosen
+
+    def _bin(self, start, end):
+        self.cell_latest.fill(-1)
+        if end <= start:
+            return
+        if end - start <= self.num_cells:
+            rows = np.arange(start, end)
+            latest = rows[self.next[start:end] >= end]
+            self.cell_latest[self.cells[latest]] = latest
+            return
+        self._bin_cells(start, end)
+
+    def _bin_cells(self, start, end):
+        """Bin a window with one binary search per cell"""
+        num_rows = len(self.cells)
+        firsts = np.arange(self.num_cells, dtype=np.int64) * num_rows
+        found = np.searchsorted(self.keys, firsts + end) - 1
+        keys = self.keys[np.maximum(found, 0)]
+        inside = (found >= 0) & (keys >= firsts + start)
+        self.cell_latest[inside] = keys[inside] - firsts[inside]
+
+    def _move_end(self, start, end, new_end):
+        """Move the end of the window start:end to new_end"""
+        if new_end > end:
+            # The last row of each cell among the new rows is its latest
+            rows = np.arange(end, new_end)
+            latest = rows[self.next[end:new_end] >= new_end]
+            self.cell_latest[self.cells[latest]] = latest
+        elif new_end < end:
+            # The row before the first removed row of each cell is its
+            # latest, if it is still in the window
+            first = self.previous[new_end:end] < new_end
+            latest = self.previous[new_end:end][first].astype(np.int64)
+            latest[latest < start] = -1
+            self.cell_latest[self.cells[new_end:end][first]] = latest
+
+    def _move_start(self, start, new_start, end):
+        """Move the start of the window start:end to new_start"""
+        if new_start > start:
+            # Cells whose latest row is removed have no rows left
+            rows = np.arange(start, new_start)
+            cells = self.cells[start:new_start]
+            self.cell_latest[cells[self.cell_latest[cells] == rows]] = -1
+        elif new_start < start:
+            # The last added row of a cell without rows is its latest
+            rows = np.arange(new_start, start)
+            last = self.next[new_start:start] >= start
+            cells = self.cells[new_start:start][last]
+            empty = self.cell_latest[cells] < 0
+            self.cell_latest[cells[empty]] = rows[last][empty]
+
+
+class GridIndex():
+    """
+    Uniform grid over points, for finding the point nearest to a click
+
+    The point indices are sorted by grid cell, row by row, so the points of
+    a range of cells in one row are a contiguous slice found with a binary
+    search. The cell size gives on average about one point per cell.
+
+    Args:
+        x: Array of x coordinates (longitude).
+        y: Array of y coordinates (latitude).
+    """
+
+    def __init__(self, x, y):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        if len(self.x) == 0:
+            self.x0 = self.y0 = 0.0
+            self.cell_size = 1.0
+            self.num_columns = 1
+            self.keys = self.order = np.empty(0, dtype=np.int64)
+            return
+        self.x0 = self.x.min()
+        self.y0 = self.y.min()
+        extent = max(self.x.max() - self.x0, self.y.max() - self.y0)
+        self.cell_size = max(extent / math.sqrt(len(self.x)), 1e-12)
+        self.num_columns = int(extent / self.cell_size) + 2
+        keys = self._cells(self.y, self.y0) * self.num_columns \
+            + self._cells(self.x, self.x0)
+        self.order = np.argsort(keys, kind="mergesort")
+        self.keys = keys[self.order]
+
+    def _cells(self, values, origin):
+        cells = np.floor((values - origin) / self.cell_size)
+        return np.clip(cells, 0, self.num_columns - 1).astype(np.int64)
+
+    def nearest(self, x, y, x_scale, y_scale, radius, start=0, end=None):
+        """
+        Find the point nearest to (x, y) in screen space
+
+        Args:
+            x, y: The position to search from, in data coordinates.
+            x_scale, y_scale: Pixels per data unit along each axis.
+            radius: Maximum distance in pixels.
+            start, end: Only points with index start <= i < end are
+                considered, e.g. the points drawn for the current time span.
+
+        Returns:
+            index: The index of the nearest point, or None if no point is
+            within radius.
+        """
+        if end is None:
+            end = len(self.x)
+        rx = radius / x_scale
+        ry = radius / y_scale
+        columns = self._cells(np.array([x - rx, x + rx]), self.x0)
+        rows = self._cells(np.array([y - ry, y + ry]), self.y0)
+
+        # One contiguous slice of the sorted keys per row of cells
+        row_keys = np.arange(rows[0], rows[1] + 1) * self.num_columns
+        lows = np.searchsorted(self.keys, row_keys + columns[0], side="left")
+        highs = np.searchsorted(self.keys, row_keys + columns[1],
+                                side="right")
+        candidates = np.concatenate(
+            [self.order[low:high] for low, high in zip(lows, highs)])
+        candidates = candidates[(candidates >= start) & (candidates < end)]
+        return closest(self.x, self.y, candidates, x, y, x_scale, y_scale,
+                       radius)
+
+    def within(self, xmin, xmax, ymin, ymax):
+        """
+        Find the points inside a rectangle
+
+        Returns:
+            indices: The sorted indices of the points inside.
+        """
+        if len(self.x) == 0:
+            return np.empty(0, dtype=np.int64)
+        columns = self._cells(np.array([xmin, xmax]), self.x0)
+        rows = self._cells(np.array([ymin, ymax]), self.y0)
+        row_keys = np.arange(rows[0], rows[1] + 1) * self.num_columns
+        lows = np.searchsorted(self.keys, row_keys + columns[0], side="left")
+        highs = np.searchsorted(self.keys, row_keys + columns[1],
+                                side="right")
+        candidates = np.concatenate(
+            [self.order[low:high] for low, high in zip(lows, highs)])
+        inside = (self.x[candidates] >= xmin) & (self.x[candidates] <= xmax) \
+            & (self.y[candidates] >= ymin) & (self.y[candidates] <= ymax)
+        return np.sort(candidates[inside])
+
+
+def closest(x_values, y_values, candidates, x, y, x_scale, y_scale, radius):
+    """
+    Find the candidate point nearest to (x, y) in screen space
+
+    Args:
+        x_values, y_values: Arrays of all point coordinates.
+        candidates: The indices of the points to choose from.
+        x, y, x_scale, y_scale, radius: See GridIndex.nearest
+
+    Returns:
+        index: The index of the nearest point, or None if no point is
+        within radius.
+    """
+    if len(candidates) == 0:
+        return None
+    distances = np.hypot((x_values[candidates] - x) * x_scale,
+                         (y_values[candidates] - y) * y_scale)
+    nearest = np.argmin(distances)
+    if distances[nearest] > radius:
+        return None
+    return int(candidates[nearest])
+
+
+def screen_bins(x, y, indices, xlim, ylim, columns, rows):
+    """
+    Keep one point per occupied bin of a raster laid over the view
+
+    Args:
+        x, y: Arrays of all point coordinates.
+        indices: The indices of the points to choose from.
+        xlim, ylim: The limits of the view, in either direction.
+        columns, rows: The number of bins across the view.
+
+    Returns:
+        indices: The sorted indices of one point per occupied bin, points
+        outside the view are left out.
+    """
+    (xmin, xmax), (ymin, ymax) = sorted(xlim), sorted(ylim)
+    if len(indices) == 0 or xmax <= xmin or ymax <= ymin:
+        return np.empty(0, dtype=np.int64)
+    bx = np.floor((x[indices] - xmin) * (columns / (xmax - xmin)))
+    by = np.floor((y[indices] - ymin) * (rows / (ymax - ymin)))
+    inside = (bx >= 0) & (bx < columns) & (by >= 0) & (by < rows)
+    owner = np.full(columns * rows, -1, dtype=np.int64)
+    # Any point of a bin represents it, they are drawn on the same spot
+    owner[(by[inside] * columns + bx[inside]).astype(np.int64)] = \
+        indices[inside]
+    chosen = owner[owner >= 0]
+    chosen.sort()
+    return chosen
+
+
+class DetailPyramid():
+    """
+    Occupancy pyramid of points, to draw about one point per screen bin
+
+    Level L divides the square around all points into 2**L by 2**L cells,
+    and holds the index of the first point in each cell (len(x) for empty
+    cells). For a view and a time window starting at the first point, the
+    occupied cells of the level with cells just smaller than a screen bin
+    are read from the part of the level inside the view. The work is
+    bounded by the size of the screen, not by the number of points.
+
+    The finest level is built from the points the first time a level is
+    needed, the coarser ones from the level below them.
+
+    Args:
+        x: Array of x coordinates (longitude).
+        y: Array of y coordinates (latitude).
+        index: A GridIndex over the same points, used when zoomed in beyond
+            the finest level or for windows not starting at the first point.
+        max_level: The finest level, 11 has 2048 by 2048 cells.
+    """
+
+    def __init__(self, x, y, index=None, max_level=11):
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        self.index = index
+        self.max_level = max_level
+        self.levels = {}
+        if len(self.x) == 0:
+            self.x0 = self.y0 = 0.0
+            self.extent = 1.0
+            return
+        self.x0 = self.x.min()
+        self.y0 = self.y.min()
+        self.extent = max(self.x.max() - self.x0, self.y.max() - self.y0,
+                          1e-12)
+
+    def level(self, level):
+        """Return the first point index of every cell of a level"""
+        if level not in self.levels:
+            size = 2**level
+            if level == self.max_level:
+                dtype = np.int32 if len(self.x) < 2**31 - 1 else np.int64
+                first = np.full(size * size, len(self.x), dtype=dtype)
+                keys = self._cells(self.y, self.y0, size) * size \
+                    + self._cells(self.x, self.x0, size)
+                np.minimum.at(first, keys, np.arange(len(self.x), dtype=dtype))
+                self.levels[level] = first.reshape(size, size)
+            else:
+                finer = self.level(level + 1)
+                self.levels[level] = finer.reshape(size, 2, size, 2) \
+                    .min(axis=(1, 3))
+        return self.levels[level]
+
+    def _cells(self, values, origin, size):
+        cells = np.floor((values - origin) * (size / self.extent))
+        return np.clip(cells, 0, size - 1).astype(np.int64)
+
+    def select(self, xlim, ylim, columns, rows, start=0, end=None):
+        """
+        Choose about one point per screen bin to draw
+
+        Args:
+            xlim, ylim: The limits of the view, in either direction.
+            columns, rows: The number of bins across the view.
+            start, end: Only points with index start <= i < end are drawn.
+
+        Returns:
+            indices: The sorted indices of the points to draw.
+        """
+        if end is None:
+            end = len(self.x)
+        (xmin, xmax), (ymin, ymax) = sorted(xlim), sorted(ylim)
+        bin_size = min((xmax - xmin) / columns, (ymax - ymin) / rows)
+        if start == 0 and bin_size > 0 and len(self.x):
+            # Cells of at most half a bin, so every point is within a bin
+            # of a drawn point, or at most a bin at the finest level
+            level = max(int(math.ceil(math.log2(self.extent / bin_size))), 0)
+            level = min(level + 1, self.max_level)
+            if self.extent / 2**level <= bin_size:
+                size = 2**level
+                scale = size / self.extent
+                c0, c1, r0, r1 = np.clip(
+                    [math.floor((xmin - self.x0) * scale),
+                     math.floor((xmax - self.x0) * scale) + 1,
+                     math.floor((ymin - self.y0) * scale),
+                     math.floor((ymax - self.y0) * scale) + 1], 0, size)
+                block = self.level(level)[r0:r1, c0:c1]
+                candidates = block[block < end].astype(np.int64)
+                return screen_bins(self.x, self.y, candidates, xlim, ylim,
+                                   columns, rows)
+        if self.index is not None:
+            candidates = self.index.within(xmin, xmax, ymin, ymax)
+            candidates = candidates[(candidates >= start) & (candidates < end)]
+        else:
+            candidates = np.arange(start, end)
+        return screen_bins(self.x, self.y, candidates, xlim, ylim, columns,
+                           rows)
@@ -0,0 +1,232 @@
+"""
+Persistent cache of parsed flight and wind logs
+
+Parsed dataframes are stored as one .npy file per column in a cache
+directory and memory-mapped when the same log is opened again. Entries are
+keyed by the path, size and modification time of the log and by a hash of
+its content, so a copied or touched log is still found without parsing it.
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.10
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import numpy as np
+import pandas as pd
+
+
+DEFAULT_CACHE_DIR = os.environ.get(
+    "DRONEMAP_CACHE", os.path.join(os.path.expanduser("~"), ".cache",
+                                   "dronemap"))
+DEFAULT_MAX_BYTES = 1024 * 1024 * 1024
+# Bump when the parsed format of a log changes, to ignore old entries
+FORMAT_VERSION = 1
+INDEX_NAME = "index.json"
+
+
+def content_hash(path, chunk_size=1024 * 1024):
+    """Return a hex digest of the content of the file at path"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as log:
+        for chunk in iter(lambda: log.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class FlightCache():
+    """
+    Size bounded, least recently used cache of parsed logs on disk
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR,
+                 max_bytes=DEFAULT_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.index = self._read_index()
+
+    def load(self, csv_path, kind, parser):
+        """
+        Fetch a parsed log from the cache, parsing and storing it on a miss
+
+        Args:
+            csv_path: The path to the log.
+            kind: Name of the parser, e.g. "drone" or "wind".
+            parser: Function that parses csv_path into a dataframe.
+
+        Returns:
+            data: The parsed dataframe.
+        """
+        data = self.get(csv_path, kind)
+        if data is None:
+            data = parser(csv_path)
+            self.put(csv_path, kind, data)
+        return data
+
+    def get(self, csv_path, kind):
+        """
+        Fetch a parsed log from the cache
+
+        Returns:
+            data: A dataframe with memory-mapped columns, or None on a miss.
+        """
+        key = self._find(csv_path, kind)
+        if key is None:
+            return None
+        entry = self.index[key]
+        try:
+            columns = {}
+            for i, column in enumerate(entry["columns"]):
+                columns[column] = np.load(
+                    os.path.join(self.cache_dir, key, "{0}.npy".format(i)),
+                    mmap_mode="r")
+            row_labels = np.load(os.path.join(self.cache_dir, key,
+                                              "index.npy"))
+        except (OSError, ValueError):
+            self._remove(key)
+            self._write_index()
+            return None
+        entry["last_access"] = time.time()
+        self._write_index()
+        return pd.DataFrame(columns, index=row_labels, copy=False)
+
+    def put(self, csv_path, kind, data):
+        """
+        Store a parsed log in the cache
+
+        Dataframes with object columns are not cached, since those can not
+        be memory-mapped.
+        """
+        if any(dtype == object for dtype in data.dtypes):
+            return
+        stat = os.stat(csv_path)
+        digest = content_hash(csv_path)
+        key = "{0}-v{1}-{2}".format(kind, FORMAT_VERSION, digest)
+
+        # Write to a temporary directory first so readers never see a
+        # partly written entry
+        tmp_dir = tempfile.mkdtemp(dir=self.cache_dir)
+        for i, column in enumerate(data.columns):
+            np.save(os.path.join(tmp_dir, "{0}.npy".format(i)),
+                    np.ascontiguousarray(data[column].to_numpy()))
+        np.save(os.path.join(tmp_dir, "index.npy"), data.index.to_numpy())
+        num_bytes = sum(os.path.getsize(os.path.join(tmp_dir, name))
+                        for name in os.listdir(tmp_dir))
+        # Keep entries added by other processes sharing the cache
+        for other_key, entry in self._read_index().items():
+            self.index.setdefault(other_key, entry)
+        if key in self.index:
+            self._remove(key)
+        shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+        os.replace(tmp_dir, os.path.join(self.cache_dir, key))
+
+        self.index[key] = {
+            "path": os.path.abspath(csv_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "hash": digest,
+            "kind": kind,
+            "columns": [str(column) for column in data.columns],
+            "bytes": num_bytes,
+            "last_access": time.time(),
+        }
+        self._evict(keep=key)
+        self._write_index()
+
+    def invalidate(self, csv_path=None):
+        """
+        Remove cached entries
+
+        Args:
+            csv_path: Remove the entries of this log. If None, the whole
+                cache is cleared.
+        """
+        if csv_path is None:
+            keys = list(self.index)
+        else:
+            path = os.path.abspath(csv_path)
+            keys = [key for key, entry in self.index.items()
+                    if entry["path"] == path]
+        for key in keys:
+            self._remove(key)
+        self._write_index()
+
+    def size(self):
+        """Return the number of bytes used by the cached entries"""
+        return sum(entry["bytes"] for entry in self.index.values())
+
+    def _find(self, csv_path, kind):
+        """Find the key of the entry for csv_path, or None"""
+        try:
+            stat = os.stat(csv_path)
+        except OSError:
+            return None
+        path = os.path.abspath(csv_path)
+        suffix = "-v{0}-".format(FORMAT_VERSION)
+        # Other processes sharing the cache may have added the log
+        for key, entry in self._read_index().items():
+            self.index.setdefault(key, entry)
+        candidates = {key: entry for key, entry in self.index.items()
+                      if entry["kind"] == kind and suffix in key
+                      and entry["size"] == stat.st_size}
+        if not candidates:
+            return None
+
+        # Cheap check first: same file, unchanged since it was cached
+        for key, entry in candidates.items():
+            if entry["path"] == path and entry["mtime_ns"] == stat.st_mtime_ns:
+                return key
+
+        # Otherwise the file may be a copy, or touched without changing
+        digest = content_hash(csv_path)
+        for key, entry in candidates.items():
+            if entry["hash"] == digest:
+                entry["path"] = path
+                entry["mtime_ns"] = stat.st_mtime_ns
+                return key
+        return None
+
+    def _evict(self, keep=None):
+        """Remove least recently used entries until the cache fits"""
+        by_age = sorted(self.index, key=lambda k: self.index[k]["last_access"])
+        total = self.size()
+        for key in by_age:
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.index[key]["bytes"]
+            self._remove(key)
+
+    def _remove(self, key):
+        self.index.pop(key, None)
+        shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+
+    def _read_index(self):
+        try:
+            with open(os.path.join(self.cache_dir, INDEX_NAME)) as index:
+                return json.load(index)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self):
+        handle, tmp_path = tempfile.mkstemp(dir=self.cache_dir)
+        with os.fdopen(handle, "w") as index:
+            json.dump(self.index, index)
+        os.replace(tmp_path, os.path.join(self.cache_dir, INDEX_NAME))
+
+
+_default_cache = None
+
+
+def default_cache():
+    """Return the cache shared by read_drone_csv and read_wind_csv"""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = FlightCache()
+    return _default_cache
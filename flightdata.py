@@ -0,0 +1,174 @@
+"""
+Compact in-memory representation of drone flights
+
+DroneMap keeps the points it draws as a Flight, a set of NumPy arrays:
+times as int64 nanoseconds since the epoch, positions as float64 and the
+other values as float32. Dataframes are only used when reading logs and
+handing data to other code, and converting between the two shares the
+arrays instead of copying them where the types allow it.
+
+Positions stay float64, float32 would round them to about half a meter.
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.22
+"""
+
+import numpy as np
+import pandas as pd
+from align import wind_at
+
+
+# Attribute, dataframe column and type of every column of a Flight
+COLUMNS = [
+    ("times", "CUSTOM.updateTime", np.int64),
+    ("longitudes", "OSD.longitude", np.float64),
+    ("latitudes", "OSD.latitude", np.float64),
+    ("pitch", "OSD.pitch", np.float32),
+    ("yaw", "OSD.yaw", np.float32),
+    ("roll", "OSD.roll", np.float32),
+    ("height", "OSD.height [m]", np.float32),
+    ("speed", "CALC.hSpeed [m/s]", np.float32),
+    ("wind_speed", "RANDOM.windSpeed", np.float32),
+    ("wind_direction", "RANDOM.direction", np.float32),
+    ("wind_u", "WIND.u", np.float32),
+    ("wind_v", "WIND.v", np.float32),
+    ("flights", "SESSION.flight", np.int32),
+]
+REQUIRED = ("times", "longitudes", "latitudes")
+
+
+class Flight():
+    """
+    Columns of drone samples, each a NumPy array or None if not known
+
+    Attributes:
+        times: int64 nanoseconds since the epoch.
+        longitudes, latitudes: float64 degrees.
+        pitch, yaw, roll, height, speed: float32 attitude, height [m] and
+            horizontal speed [m/s].
+        wind_speed, wind_direction, wind_u, wind_v: float32 wind, see
+            join_wind.
+        flights: int32 number of the flight of each sample in a session.
+    """
+
+    __slots__ = tuple(attribute for attribute, _, _ in COLUMNS)
+
+    def __init__(self, **columns):
+        for attribute, _, _ in COLUMNS:
+            setattr(self, attribute, columns.get(attribute))
+
+    @classmethod
+    def empty(cls):
+        return cls(**{attribute: np.empty(0, dtype=dtype)
+                      for attribute, _, dtype in COLUMNS
+                      if attribute in REQUIRED})
+
+    @classmethod
+    def from_frame(cls, data):
+        """
+        Convert a dataframe, see read_drone_csv, sharing its arrays where
+        they have the right type
+
+        Columns missing from data are None.
+        """
+        columns = {}
+        for attribute, name, dtype in COLUMNS:
+            if name not in data.columns:
+                continue
+            values = data[name].to_numpy()
+            if attribute == "times":
+                values = values.astype("datetime64[ns]", copy=False) \
+                    .view(np.int64)
+            columns[attribute] = np.ascontiguousarray(values, dtype=dtype)
+        return cls(**columns)
+
+    def to_frame(self):
+        """Convert to a dataframe with the columns of the drone logs"""
+        columns = {}
+        for attribute, name, _ in COLUMNS:
+            values = getattr(self, attribute)
+            if values is None:
+                continue
+            if attribute == "times":
+                values = values.view("datetime64[ns]")
+            columns[name] = values
+        return pd.DataFrame(columns, copy=False)
+
+    def __len__(self):
+        return len(self.times)
+
+    def columns(self):
+        """Return the (attribute, values) of the known columns"""
+        return [(attribute, getattr(self, attribute))
+                for attribute in self.__slots__
+                if getattr(self, attribute) is not None]
+
+    def take(self, rows):
+        """Return a Flight with the given rows, a slice or an index array"""
+        return Flight(**{attribute: values[rows]
+                         for attribute, values in self.columns()})
+
+    def replace(self, **columns):
+        """Return a Flight sharing all but the given columns"""
+        return Flight(**dict(self.columns(), **columns))
+
+    def sorted_by_time(self):
+        """Return the flight sorted by time, itself if it already is"""
+        if np.all(self.times[1:] >= self.times[:-1]):
+            return self
+        return self.take(np.argsort(self.times, kind="mergesort"))
+
+    def row(self, index):
+        """
+        Return the values of one sample
+
+        Returns:
+            row: A dict from the column names of the drone logs to numbers,
+            with the known columns only.
+        """
+        return {name: getattr(self, attribute)[index].item()
+                for attribute, name, _ in COLUMNS
+                if getattr(self, attribute) is not None}
+
+    def has_wind(self):
+        return self.wind_speed is not None
+
+    def nbytes(self):
+        """Return the number of bytes of the arrays"""
+        return sum(values.nbytes for _, values in self.columns())
+
+
+def as_flight(data):
+    """Return data as a Flight, converting a dataframe"""
+    return data if isinstance(data, Flight) else Flight.from_frame(data)
+
+
+def join_wind(points, wind_data, tolerance=0.05, method="linear"):
+    """
+    Estimate the wind at every point
+
+    Args:
+        points: A Flight.
+        wind_data: A dataframe with the wind data, with datetimes.
+        tolerance, method: See align.align_wind
+
+    Returns:
+        points: A Flight sharing the columns of points, with wind speed,
+        direction and vector components, NaN where there is no wind.
+    """
+    speed, direction = wind_at(points.times, wind_data, tolerance, method)
+    return with_wind(points, speed, direction)
+
+
+def with_wind(points, speed, direction):
+    """
+    Return a Flight sharing the columns of points, with the given wind
+    speed and direction and the vector components, computed once for all
+    points
+    """
+    radians = np.radians(direction)
+    return points.replace(
+        wind_speed=np.asarray(speed, dtype=np.float32),
+        wind_direction=np.asarray(direction, dtype=np.float32),
+        wind_u=(np.cos(radians) * speed).astype(np.float32),
+        wind_v=(np.sin(radians) * speed).astype(np.float32))
@@ -5,22 +5,20 @@ Authors --Group 12 of MVK at KTH 2020.
 Version --2020.03.30
 """
 
+# Imported first, it times the startup from here
+import perf
 # Make file from other directory accessable for import
+import os
 import sys
 from tkinter import filedialog
 from tkinter import ttk
 import tkinter as tk
-from matplotlib.backends.backend_tkagg import (
-    FigureCanvasTkAgg, NavigationToolbar2Tk)
-from matplotlib.backend_bases import key_press_handler
-from matplotlib.figure import Figure
-from wind_rnd import generate_wind_data
-from mapdraw import DroneMap
-import math
+from playback import SPEEDS, Playback
+from scheduler import RenderScheduler
 import csv
 sys.dont_write_bytecode = True
-
-# Implement the default Matplotlib key bindings.
+# matplotlib, pandas and the modules using them are imported when first
+# used, after the window is shown, see MapFrame.drawMap
 
 
 """
@@ -59,7 +57,30 @@ class CsvFrame(MainFrame):
             master=self, text="Browse for wind file", command=self.display_data)
         self.button_csv_3 = tk.Button(
             master=self, text="Browse for drone file", command=self.display_flight)  # TODO
+        self.progress_csv_1 = ttk.Progressbar(
+            master=self, length=240, maximum=100)
+        self.button_csv_5 = tk.Button(
+            master=self, text="Cancel", command=self.cancel_load,
+            state=tk.DISABLED)
         self.text_csv_2 = tk.Text(master=self, width=30, height=6)
+        self.label_csv_3 = tk.Label(
+            master=self, text="Live source (file, udp://host:port\n"
+            "or tcp://host:port):")
+        self.entry_csv_3 = tk.Entry(master=self)
+        self.entry_csv_3.insert(0, "udp://127.0.0.1:5005")
+        self.button_csv_4 = tk.Button(
+            master=self, text="Start live", command=self.toggle_live)
+        self.button_csv_6 = tk.Button(
+            master=self, text="Add drone files to session",
+            command=self.add_flights)
+        self.listbox_csv_1 = tk.Listbox(
+            master=self, selectmode=tk.MULTIPLE, height=5, width=30,
+            exportselection=False)
+        self.listbox_csv_1.bind("<<ListboxSelect>>", self.toggle_flights)
+        self.checkbox_csv_1_value = tk.IntVar()
+        self.checkbox_csv_1 = tk.Checkbutton(
+            master=self, text="Align flight starts",
+            variable=self.checkbox_csv_1_value, command=self.toggle_align)
 
         self.label_csv_1.grid(row=1, column=0)
         self.entry_csv_1.grid(row=2, column=0, pady=5)
@@ -67,7 +88,42 @@ class CsvFrame(MainFrame):
 
         self.button_csv_2.grid(row=5, column=0)
         self.button_csv_3.grid(row=6, column=0)
+        self.progress_csv_1.grid(row=7, column=0)
+        self.button_csv_5.grid(row=7, column=1)
         self.text_csv_2.grid(row=8, column=0, pady=15, padx=10)
+        self.label_csv_3.grid(row=9, column=0)
+        self.entry_csv_3.grid(row=10, column=0)
+        self.button_csv_4.grid(row=10, column=1)
+        self.button_csv_6.grid(row=11, column=0, pady=5)
+        self.listbox_csv_1.grid(row=12, column=0)
+        self.checkbox_csv_1.grid(row=13, column=0)
+
+    """
+    This function starts showing live telemetry from the source written in
+    "entry_csv_3", or stops it if it is already shown.
+    """
+
+    def toggle_live(self):
+        self.text_csv_2.delete(0.0, "end")
+        mapFrame = self.parent.mapFrame
+        if mapFrame.map is None:
+            self.text_csv_2.insert("end", "The map is not ready yet")
+            return
+        if mapFrame.source is not None:
+            mapFrame.stop_live()
+            self.button_csv_4.configure(text="Start live")
+            self.text_csv_2.insert("end", "Live telemetry stopped")
+            return
+        from stream import open_source
+        try:
+            mapFrame.start_live(open_source(self.entry_csv_3.get()))
+        except (OSError, ValueError) as error:
+            self.text_csv_2.insert("end", "Could not open live source: "
+                                   + str(error))
+            return
+        self.button_csv_4.configure(text="Stop live")
+        self.show_flights(None)
+        self.text_csv_2.insert("end", "Waiting for live telemetry")
 
     """
     This function opens a file explorer to select a .csv file for display
@@ -84,27 +140,76 @@ class CsvFrame(MainFrame):
                 ("csv files", "*.csv"), ("all files", "*.*")))
         opened = False
         if(self.filename[-4:] == ".csv"):
-            try:
-                csv = open(self.filename)
-                self.output = csv.read()
+            if os.path.isfile(self.filename):
                 opened = True
-            except SyntaxError:
-                if isinstance(self.filename, str):
-                    self.output = "The file '" + self.filename + \
-                        "'is not of correct type. Please enter only .csv files."
-                else:
-                    self.output = "No drone .csv file selected"
+            else:
+                self.output = "The file '" + self.filename + \
+                    "' could not be found."
         elif isinstance(self.filename, str):
             self.output = "The file '" + self.filename + \
                 "'is not of correct type. Please enter only .csv files."
         else:
             self.output = "No drone .csv file selected"
         if opened:
-            self.parent.mapFrame.map.set_drone_data(self.filename)
-            self.output = "Drone data loaded"
+            self.button_csv_4.configure(text="Start live")
+            # Read in the background, see MapFrame.poll_loads
+            self.parent.mapFrame.load_flight(self.filename)
+            self.output = "Loading drone data"
 
         self.text_csv_2.insert("end", self.output)  # END isn't a string
 
+    """
+    This function opens a file explorer to select several .csv files, and
+    adds them to the session shown on the map. The flight shown before is
+    the first flight of a new session.
+    """
+
+    def add_flights(self):
+        self.text_csv_2.delete(0.0, "end")
+        filenames = filedialog.askopenfilenames(
+            title="Select Files", filetypes=(
+                ("csv files", "*.csv"), ("all files", "*.*")))
+        filenames = [filename for filename in filenames
+                     if filename[-4:] == ".csv" and os.path.isfile(filename)]
+        if not filenames:
+            self.text_csv_2.insert("end", "No drone .csv files selected")
+            return
+        self.button_csv_4.configure(text="Start live")
+        self.parent.mapFrame.load_session(filenames)
+        self.text_csv_2.insert("end", "Loading drone data")
+
+    """
+    These functions list the flights of the session, with the visible ones
+    selected, and show the selected flights when the selection changes.
+    """
+
+    def show_flights(self, session):
+        self.listbox_csv_1.delete(0, "end")
+        if session is None:
+            return
+        for flight, name in enumerate(session.names):
+            self.listbox_csv_1.insert("end", name)
+            if session.visible[flight]:
+                self.listbox_csv_1.selection_set(flight)
+
+    def toggle_flights(self, event):
+        session = self.parent.mapFrame.map.session
+        if session is None:
+            return
+        selected = self.listbox_csv_1.curselection()
+        for flight in range(len(session)):
+            session.set_visible(flight, flight in selected)
+        self.parent.mapFrame.map.show_session(session)
+
+    def toggle_align(self):
+        if self.parent.mapFrame.map is None:
+            return
+        session = self.parent.mapFrame.map.session
+        if session is None:
+            return
+        session.align_starts = bool(self.checkbox_csv_1_value.get())
+        self.parent.mapFrame.map.show_session(session)
+
     """
     This function reads the number of data points requested in the "entry_csv_2",
     and produces a file according to the name written in "entry_csv_1".
@@ -121,6 +226,7 @@ class CsvFrame(MainFrame):
         self.filename = self.entry_csv_1.get()  # Get contents of entry
 
         if (len(self.filename) > 0):
+            from wind_rnd import generate_wind_data
             generate_wind_data(self.filename, self.numDataPoints)
         else:
             print("File name must have a minimal length of 1.")
@@ -138,27 +244,48 @@ class CsvFrame(MainFrame):
                 ("csv files", "*.csv"), ("all files", "*.*")))
         opened = False
         if(self.filename[-4:] == ".csv"):
-            try:
-                csv = open(self.filename)
-                self.output = csv.read()
+            if os.path.isfile(self.filename):
                 opened = True
-            except BaseException:
-                if isinstance(self.filename, str):
-                    self.output = "The file '" + self.filename + \
-                        "'is not of correct type. Please enter only .csv files."
-                else:
-                    self.output = "No wind .csv file selected"
+            else:
+                self.output = "The file '" + self.filename + \
+                    "' could not be found."
         elif isinstance(self.filename, str):
             self.output = "The file '" + self.filename + \
                 "'is not of correct type. Please enter only .csv files."
         else:
             self.output = "No wind .csv file selected"
-        if opened:
-            self.parent.mapFrame.map.draw_wind(self.filename)
-            self.output = "Wind data loaded"
+        mapFrame = self.parent.mapFrame
+        if opened and (mapFrame.map is None or mapFrame.loader.busy()
+                       or mapFrame.map.get_data_length() == 0):
+            self.output = "Load drone data before the wind data"
+        elif opened:
+            mapFrame.load_wind(self.filename)
+            self.output = "Loading wind data"
 
         self.text_csv_2.insert("end", self.output)  # END isn't a string
 
+    """
+    These functions show the progress of the load running in the
+    background, and cancel it.
+    """
+
+    def show_progress(self, stage, progress):
+        self.progress_csv_1["value"] = progress * 100
+        self.button_csv_5.configure(state=tk.NORMAL)
+        self.text_csv_2.delete(0.0, "end")
+        self.text_csv_2.insert("end", "{0}... {1:.0%}".format(stage,
+                                                               progress))
+
+    def load_finished(self, output):
+        self.progress_csv_1["value"] = 0
+        self.button_csv_5.configure(state=tk.DISABLED)
+        self.text_csv_2.delete(0.0, "end")
+        self.text_csv_2.insert("end", output)
+
+    def cancel_load(self):
+        if self.parent.mapFrame.loader is not None:
+            self.parent.mapFrame.loader.cancel()
+
 
 """
 This frame class houses everything that is wanted when inspecting something on the DroneMap.
@@ -173,7 +300,8 @@ class InspectFrame(MainFrame):
 
         Args:
             point_data: A dictionary containing the positional data
-                and wind data at a certain point.
+                and wind data at a certain point, and its "metrics", see
+                DroneMap.metrics_at.
             displayWindData: A boolean indicating whether or not 'point_data'
                 includes wind data.
         """
@@ -184,18 +312,38 @@ class InspectFrame(MainFrame):
             "\n\nLatitude       = {0} \nLongitude      = {1} "
             "\nHeight         = {2} [m] \nSpeed          = {3} [m/s] ")
         formatted_string = display_data_string.format(
-            str(point_data["xmouse"]), str(point_data["ymouse"]),
+            str(point_data["ymouse"]), str(point_data["xmouse"]),
             str(point_data["height"]), str(point_data["hSpeed"]))
         if displayWindData:
             formatted_string = formatted_string + \
                 "\nWind Speed     = {0} [m/s] \nWind direction = {1} [deg.]" \
                 .format(str(point_data["windSpeed"]), str(point_data["windDir"]))
+        metrics = point_data.get("metrics", {})
+        if metrics:
+            from metrics import ROLLING_SECONDS
+            formatted_string += (
+                "\n\nDistance       = {0} [m] \nTrack speed    = {1} [m/s] "
+                "\nVertical speed = {2} [m/s] \nSpeed {3} s avg = {4} +- "
+                "{5} [m/s] ").format(
+                    format_metric(metrics["METRICS.distance [m]"]),
+                    format_metric(metrics["METRICS.trackSpeed [m/s]"]),
+                    format_metric(metrics["METRICS.vSpeed [m/s]"]),
+                    ROLLING_SECONDS,
+                    format_metric(metrics["METRICS.hSpeedMean [m/s]"]),
+                    format_metric(metrics["METRICS.hSpeedStd [m/s]"]))
+        if "METRICS.airspeed [m/s]" in metrics:
+            formatted_string += (
+                "\nAirspeed       = {0} [m/s] \nHeadwind       = {1} [m/s] "
+                "\nCrosswind      = {2} [m/s] ").format(
+                    format_metric(metrics["METRICS.airspeed [m/s]"]),
+                    format_metric(metrics["METRICS.headwind [m/s]"]),
+                    format_metric(metrics["METRICS.crosswind [m/s]"]))
 
         self.text_inspect_1.insert(tk.END, formatted_string)
         self.text_inspect_1.grid(row=1, column=0)
 
     def widgets(self):
-        self.text_inspect_1 = tk.Text(self, width=40, height=10)
+        self.text_inspect_1 = tk.Text(self, width=40, height=20)
         self.text_inspect_1.insert(tk.INSERT, "Inspect Frame")
         self.text_inspect_1.grid(row=0, column=0)
 
@@ -206,7 +354,8 @@ This frame houses everything that has to do with attitude.
 
 
 class AttitudeFrame(MainFrame):
-    # Inserts the pitch yaw and roll variables into the AttitudeFrame.
+    # Inserts the pitch yaw and roll variables into the AttitudeFrame, with
+    # the course and climb of the metrics if known.
     def updateInfo(self, attitude):
         self.slider_attitude_1.configure(state=tk.NORMAL)
         self.slider_attitude_2.configure(state=tk.NORMAL)
@@ -220,6 +369,19 @@ class AttitudeFrame(MainFrame):
         self.slider_attitude_2.configure(state=tk.DISABLED)
         self.slider_attitude_3.configure(state=tk.DISABLED)
 
+        metrics = attitude.get("metrics", {})
+        text = ""
+        if metrics:
+            from metrics import ROLLING_SECONDS
+            text = "Course {0} deg, drift {1} deg\nClimb {2} m/s, " \
+                "{3} s avg {4} m/s".format(
+                    format_metric(metrics["METRICS.course [deg]"], 0),
+                    format_metric(metrics["METRICS.drift [deg]"], 0),
+                    format_metric(metrics["METRICS.vSpeed [m/s]"]),
+                    ROLLING_SECONDS,
+                    format_metric(metrics["METRICS.vSpeedMean [m/s]"]))
+        self.label_attitude_1.configure(text=text)
+
     def widgets(self):
         self.slider_attitude_1 = tk.Scale(
             master=self, from_=-180, to=180, tickinterval=1, label="Pitch", bg="Red", length=160, state=tk.DISABLED)
@@ -230,6 +392,75 @@ class AttitudeFrame(MainFrame):
         self.slider_attitude_3 = tk.Scale(master=self, from_=-180, to=180, tickinterval=1,
                                        label="Roll", bg="Blue", orient=tk.HORIZONTAL, length=160, state=tk.DISABLED)
         self.slider_attitude_3.grid(row=1, column=2, columnspan=2)
+        self.label_attitude_1 = tk.Label(master=self, text="")
+        self.label_attitude_1.grid(row=2, column=0, columnspan=4)
+
+
+"""
+This frame shows where the time of the program goes, see perf.
+"""
+
+
+class PerfFrame(MainFrame):
+    # Milliseconds between updates of the shown timings
+    refresh_interval = 500
+    refresh_id = None
+
+    def widgets(self):
+        self.checkbox_perf_1_value = tk.IntVar()
+        self.checkbox_perf_1 = tk.Checkbutton(
+            master=self, text="Measure performance",
+            variable=self.checkbox_perf_1_value, command=self.toggle_perf)
+        self.button_perf_1 = tk.Button(
+            master=self, text="Export trace", command=self.export_trace)
+        self.text_perf_1 = tk.Text(self, width=44, height=8)
+        self.text_perf_1.insert(tk.INSERT, "Performance Frame")
+
+        self.checkbox_perf_1.grid(row=0, column=0)
+        self.button_perf_1.grid(row=0, column=1)
+        self.text_perf_1.grid(row=1, column=0, columnspan=2)
+
+    def toggle_perf(self):
+        """Start or stop recording the time of every stage"""
+        if self.checkbox_perf_1_value.get():
+            perf.TRACER.clear()
+            perf.enable()
+            self.refresh()
+        else:
+            perf.disable()
+            if self.refresh_id is not None:
+                self.after_cancel(self.refresh_id)
+                self.refresh_id = None
+
+    def refresh(self):
+        """
+        Show the time of the latest frame, and the mean time, allocated
+        memory blocks and rows of the recent spans of every stage
+        """
+        summary = perf.summary()
+        lines = []
+        frame = summary.get("draw_drone")
+        if frame is not None:
+            lines.append("Frame {0:.1f} ms, mean {1:.1f} ms ({2:.0f} fps)"
+                         .format(frame["last_ms"], frame["mean_ms"],
+                                 1000 / max(frame["mean_ms"], 1e-3)))
+        lines.append("{0:<15}{1:>9}{2:>10}{3:>10}".format(
+            "Stage", "ms", "allocs", "rows"))
+        for name, stage in summary.items():
+            rows = "" if stage["rows"] is None else stage["rows"]
+            lines.append("{0:<15}{1:>9.2f}{2:>10.0f}{3:>10}".format(
+                name[:14], stage["mean_ms"], stage["allocations"], rows))
+        self.text_perf_1.delete(1.0, tk.END)
+        self.text_perf_1.insert(tk.INSERT, "\n".join(lines))
+        self.refresh_id = self.after(self.refresh_interval, self.refresh)
+
+    def export_trace(self):
+        """Write the recorded spans to a Chrome trace file"""
+        path = filedialog.asksaveasfilename(
+            title="Export trace", defaultextension=".json",
+            filetypes=(("Chrome trace", "*.json"), ("all files", "*.*")))
+        if path:
+            perf.export(path)
 
 
 """
@@ -242,107 +473,228 @@ class MapFrame(MainFrame):
     point_data = {}
     location = {}
     time_end = 0
+    # Milliseconds between reads of the live telemetry source
+    poll_interval = 20
+    source = None
+    live = None
+    poll_id = None
+    # Milliseconds between checks for the progress of background loads
+    load_interval = 50
+    load_id = None
+    default_flight = "Data/attitutf.csv"
+    # The log of the shown flight, when not showing a session
+    flight_path = None
+    playback = None
+    play_id = None
+    # The slider position last set by playback
+    slider_position = 0
+    # Created once the window is shown, see drawMap
+    map = None
+    loader = None
+    # Print the startup times once the default flight and map are shown
+    report_startup = False
 
     def onpick(self, event):
         """
         Handles the event when an object in the canvas is clicked.
 
-        It extracts the coordinate of a given click and uses the csv file
-        of the drone data to retrieve the attitude data that was recorded at
-        that given coordinate.
+        The drawn point nearest to the click, in screen distance, is found
+        with the spatial index of the DroneMap, and its row of the drone
+        data and its metrics are read directly by index.
 
         It also calls a function in the AttitudeFrame that displays the retrieved
         attitude data.
         """
-        line = event.artist
-        xmouse, ymouse = event.mouseevent.xdata, event.mouseevent.ydata
-        xdata, ydata = line.get_data()
-        # reader = csv.reader(open("Data/attitutf.csv", "r",
-        #                         encoding="UTF-8"), delimiter=",")
-        reader = self.map.data
-        # next(reader, None)  # Skips the first row with the headers
-
-        pitch = []
-        yaw = []
-        roll = []
-        height = []
-        hSpeed = []
-        windSpeed = []
-        windDir = []
+        with perf.span("onpick"):
+            index = self.map.pick(event.mouseevent)
+            if index is None:
+                return
+            row = self.map.points.row(index)
+            hasWindData = "RANDOM.windSpeed" in row
+
+            self.point_data["pitch"] = float(row["OSD.pitch"])
+            self.point_data["yaw"] = float(row["OSD.yaw"])
+            self.point_data["roll"] = float(row["OSD.roll"])
+            self.point_data["xmouse"] = float(row["OSD.longitude"])
+            self.point_data["ymouse"] = float(row["OSD.latitude"])
+            self.point_data["height"] = float(row["OSD.height [m]"])
+            self.point_data["hSpeed"] = float(row["CALC.hSpeed [m/s]"])
+            if hasWindData:
+                self.point_data["windSpeed"] = float(row["RANDOM.windSpeed"])
+                self.point_data["windDir"] = float(row["RANDOM.direction"])
+            # Computed once per load, looked up by row
+            self.point_data["metrics"] = self.map.metrics_at(index)
+
+            self.controller.attitudeWindow.updateInfo(self.point_data)
+            self.controller.inspectWindow.updateInfo(self.point_data,
+                                                     hasWindData)
 
+    def drawMap(self):
         """
-        Because of how pick events work in matplotlib we can not click individual points
-        when history mode is enabled because the points are interpreted as a line.
-        The way the correct point is determined is by calculating the euclidean distance
-        between the coordinates of the different points on the line and the coordinates of
-        the mouse click. The point with the least euclidean distance from the mouse click
-        is classified as the clicked point.
-        """
-        low = 9999  # A dummy value, it just has to be larger than the expected euclidean distance.
-        closest_index = 0
-        i = 0
-
-        points = tuple(zip(xdata, ydata))
-        for p in points:
-            x = p[0]
-            y = p[1]
-            current = math.sqrt(((x - xmouse) + (y - ymouse))**2)
-            if (current < low):
-                low = current
-                closest_index = i
-
-            i += 1
-
-        hasWindData = "RANDOM.windSpeed" in reader.columns
-        for _, row in reader.iterrows():
-            if (math.isclose(float(row["OSD.longitude"]), float(xdata[closest_index]), abs_tol=0.0000001) and
-                    math.isclose(float(row["OSD.latitude"]),
-                                float(ydata[closest_index]), abs_tol=0.0000001)):
-
-                pitch.append(float(row["OSD.pitch"]))
-                yaw.append(float(row["OSD.roll"]))
-                roll.append(float(row["OSD.yaw"]))
-                height.append(float(row["OSD.height [m]"]))
-                hSpeed.append(float(row["CALC.hSpeed [m/s]"]))
-                if hasWindData:
-                    windSpeed.append(float(row["RANDOM.windSpeed"]))
-                    windDir.append(float(row["RANDOM.direction"]))
-
-        self.point_data["pitch"] = sum(pitch) / len(pitch)
-        self.point_data["yaw"] = sum(yaw) / len(yaw)
-        self.point_data["roll"] = sum(roll) / len(roll)
-        self.point_data["xmouse"] = xmouse
-        self.point_data["ymouse"] = ymouse
-        self.point_data["height"] = sum(height) / len(height)
-        self.point_data["hSpeed"] = sum(hSpeed) / len(hSpeed)
-        if hasWindData:
-            self.point_data["windSpeed"] = sum(windSpeed) / len(windSpeed)
-            self.point_data["windDir"] = sum(windDir) / len(windDir)
-
-        self.controller.attitudeWindow.updateInfo(self.point_data)
-        self.controller.inspectWindow.updateInfo(self.point_data, hasWindData)
+        Create the empty map, and load the default flight in the background
 
-    def drawMap(self):
-        self.map = DroneMap()
+        Called once the window is shown. matplotlib and the modules drawing
+        the map are imported here, so that the window does not wait for
+        them. The flight is drawn as soon as it is binned, and its map once
+        fetched, see poll_loads.
+        """
+        from matplotlib.backends.backend_tkagg import (
+            FigureCanvasTkAgg, NavigationToolbar2Tk)
+        from mapdraw import DroneMap
+        from loader import Loader
+        perf.mark("map modules imported")
+        self.map = DroneMap(csv_path=None)
+        self.loader = Loader(self.map)
         self.fig = self.map.get_fig()
         # A tk.DrawingArea.
-        self.canvas = FigureCanvasTkAgg(self.fig, master=self)
-        self.toolbar = NavigationToolbar2Tk(self.canvas, self)
+        self.canvas = FigureCanvasTkAgg(self.fig, master=self.map_area)
+        self.toolbar = NavigationToolbar2Tk(self.canvas, self.map_area)
         self.toolbar.update()
-        self.canvas.draw()
+        self.map.redraw()
         self.canvas.get_tk_widget().pack(side=tk.TOP, fill=tk.BOTH, expand=1)
         self.canvas.mpl_connect('pick_event', self.onpick)
+        perf.mark("empty map shown")
+        self.load_flight(self.default_flight)
+
+    def load_flight(self, csv_path):
+        """Read a flight and fetch its map in the background, then show it"""
+        if self.map is None:
+            # Loaded instead of the default flight
+            self.default_flight = csv_path
+            return
+        self.stop_live()
+        self.loader.load_flight(csv_path)
+        self.poll_loads()
+
+    def load_session(self, csv_paths):
+        """
+        Read flights and fetch the map of the session in the background,
+        then add them to the session
+        """
+        if self.map is None:
+            return
+        self.stop_live()
+        session = self.map.session
+        bbox = None
+        if session is not None:
+            bbox = session.bbox()
+        elif self.flight_path is not None:
+            csv_paths = [self.flight_path] + list(csv_paths)
+        self.loader.load_session(csv_paths, bbox)
+        self.poll_loads()
+
+    def add_session_flights(self, data):
+        """Add loaded flights to the session, starting one if needed"""
+        session = self.map.session
+        if session is None:
+            from session import Session
+            session = Session(align_starts=bool(
+                self.controller.csvWindow.checkbox_csv_1_value.get()))
+            self.flight_path = None
+        session.store.reserve(sum(len(drone_data)
+                                  for _, drone_data, _ in data["flights"]))
+        for name, drone_data, bins in data["flights"]:
+            session.add(name, drone_data, bins)
+        if data["basemap"] is not None:
+            self.map.show_basemap(data["basemap"], data["bbox"])
+            self.toolbar.update()
+        self.map.show_session(session)
+        self.controller.csvWindow.show_flights(session)
+
+    def load_wind(self, csv_path):
+        """Read wind data and join it onto the flight in the background"""
+        self.loader.load_wind(csv_path, self.map.drone_data,
+                              join=self.map.live is None
+                              and self.map.session is None,
+                              mapped=self.map.mapped)
+        self.poll_loads()
+
+    def poll_loads(self):
+        """
+        Show the progress of the background load, and its result when done
+
+        Called from Tk's event loop every load_interval milliseconds while
+        a load is running. Only the messages of the latest load are shown.
+        """
+        if self.load_id is not None:
+            self.after_cancel(self.load_id)
+            self.load_id = None
+        # Checked first, the last message of a finished load is queued
+        busy = self.loader.busy()
+        csvWindow = self.controller.csvWindow
+        for job, event, data in self.loader.poll():
+            if job is not self.loader.job:
+                continue
+            if event == "progress":
+                csvWindow.show_progress(*data)
+            elif event == "cancelled":
+                csvWindow.load_finished("Loading cancelled")
+            elif event == "error":
+                csvWindow.load_finished("Could not load '{0}': {1}".format(
+                    job.path, data))
+            elif event == "flight":
+                # Drawn while its map is fetched
+                self.stop_playback()
+                self.map.show_view(data["bbox"])
+                # Forget the zoom history of the previous flight
+                self.toolbar.update()
+                self.map.show_flight(data["drone_data"], data["points"],
+                                     data["bins"], data["mapped"],
+                                     data["metrics"])
+                self.flight_path = job.path
+                csvWindow.show_flights(None)
+                perf.mark("first flight frame")
+            elif job.kind == "flight":
+                if data["basemap"] is not None:
+                    self.map.show_basemap(data["basemap"], data["bbox"])
+                    self.toolbar.update()
+                    self.map.redraw()
+                csvWindow.load_finished("Drone data loaded")
+                perf.mark("map shown")
+                if self.report_startup:
+                    self.report_startup = False
+                    print(perf.startup_report())
+            elif job.kind == "session":
+                self.stop_playback()
+                self.add_session_flights(data)
+                csvWindow.load_finished("Drone data loaded")
+            else:
+                self.map.show_wind(data["wind_data"], data["merged_data"],
+                                   data["tolerance"], data["method"])
+                csvWindow.load_finished("Wind data loaded")
+        if busy:
+            self.load_id = self.after(self.load_interval, self.poll_loads)
 
     def widgets(self):
-        self.drawMap()
+        # The map is drawn here by drawMap, once the window is shown
+        self.map_area = tk.Frame(self, bg="white", width=1000, height=700)
+        self.map_area.pack(side=tk.TOP, fill=tk.BOTH, expand=1)
+        self.playback = Playback()
+        # Slider and checkbox events are drawn at most once per frame
+        self.renderer = RenderScheduler(self, self.updateMap)
+        self.button_back = tk.Button(master=self, text="<",
+                                     command=lambda: self.step(-1))
+        self.button_play = tk.Button(master=self, text="Play", width=5,
+                                     command=self.toggle_play)
+        self.button_forward = tk.Button(master=self, text=">",
+                                        command=lambda: self.step(1))
+        self.speed_value = tk.StringVar(value="1x")
+        self.speed_menu = tk.OptionMenu(
+            self, self.speed_value,
+            *["{0:g}x".format(speed) for speed in SPEEDS],
+            command=self.set_speed)
         self.slider_value = tk.IntVar()
-        self.slider = tk.Scale(master=self, from_=0, to=100,
-                            command=self.slider_move, length=850, orient=tk.HORIZONTAL)
+        self.slider = tk.Scale(master=self, from_=0, to=100, resolution=0.01,
+                            command=self.slider_move, length=650, orient=tk.HORIZONTAL)
         self.checkbox_value = tk.IntVar()
         self.checkbox = tk.Checkbutton(
             master=self, text="Show history", variable=self.checkbox_value, onvalue=0,
-            offvalue=10, command=self.updateMap)
+            offvalue=10, command=self.renderer.request)
         self.checkbox.deselect()
+        self.button_back.pack(side=tk.LEFT)
+        self.button_play.pack(side=tk.LEFT)
+        self.button_forward.pack(side=tk.LEFT)
+        self.speed_menu.pack(side=tk.LEFT)
         self.slider.pack(side=tk.LEFT)
         self.checkbox.pack(side=tk.RIGHT)
 
@@ -351,23 +703,159 @@ class MapFrame(MainFrame):
         Update the map, based on slider position (% of whole flight),
         and show a 10 second span of drone points until that point. If show
         history is checked, show all points up until the slider position
+
+        Moving the slider while playing continues playback from there. The
+        events of a drag are drawn at most once per frame, see renderer.
         """
-        self.flight_percent = self.slider.get() / 100
-        self.updateMap()
+        value = self.slider.get()
+        if self.map is None or abs(value - self.slider_position) < 0.005:
+            # Moved by playback, already drawn
+            return
+        self.slider_position = value
+        self.flight_percent = value / 100
+        timeline = self.map.timeline()
+        if timeline is not None:
+            first, last = timeline
+            self.playback.set_timeline(first, last)
+            self.playback.seek(first + int((last - first)
+                                           * self.flight_percent))
+        self.renderer.request()
+
+    def toggle_play(self):
+        """Play the flight from the slider position, or pause it"""
+        if self.map is None:
+            return
+        timeline = self.map.timeline()
+        if self.playback.playing or timeline is None:
+            self.stop_playback()
+            return
+        self.playback.set_timeline(*timeline)
+        self.playback.play()
+        self.button_play.configure(text="Pause")
+        self.play_frame()
+
+    def play_frame(self):
+        """
+        Draw the frame that is due, and schedule the next one
+
+        The drawn time follows the wall clock, see playback.Playback, so
+        when drawing is slower than the frame rate frames are dropped and
+        playback stays in real time.
+        """
+        self.play_id = None
+        timeline = self.map.timeline()
+        if timeline is None:
+            self.stop_playback()
+            return
+        self.playback.set_timeline(*timeline)
+        position, delay = self.playback.tick()
+        self.show_time(position)
+        if delay is None:
+            # The end of the flight
+            self.stop_playback()
+            return
+        self.play_id = self.after(int(delay * 1000), self.play_frame)
+
+    def step(self, count):
+        """Pause, and move count samples of the flight forward or back"""
+        if self.map is None:
+            return
+        timeline = self.map.timeline()
+        if timeline is None:
+            return
+        self.stop_playback()
+        self.playback.set_timeline(*timeline)
+        self.playback.step(count, self.map.sample_times())
+        self.show_time(self.playback.position())
+
+    def set_speed(self, value):
+        self.playback.set_speed(float(value.rstrip("x")))
+
+    def stop_playback(self):
+        if self.play_id is not None:
+            self.after_cancel(self.play_id)
+            self.play_id = None
+        self.playback.pause()
+        self.button_play.configure(text="Play")
+
+    def show_time(self, time_end):
+        """Draw the points up to a time, in ns, and move the slider there"""
+        self.map.draw_drone(time_span=self.checkbox_value.get(),
+                            time_end=time_end)
+        self.flight_percent = self.map.flight_percent
+        self.slider_position = round(self.flight_percent * 100, 2)
+        self.slider.set(self.slider_position)
+
+    def start_live(self, source):
+        """
+        Show telemetry from a live source, see stream.open_source
+
+        The source is read from Tk's event loop every poll_interval
+        milliseconds, reads never block, and the map is only updated when
+        rows have arrived. The slider is moved to the end so that the map
+        follows the latest rows.
+        """
+        self.stop_live()
+        self.stop_playback()
+        self.loader.cancel()
+        self.source = source
+        from stream import LiveFlight
+        self.live = LiveFlight()
+        self.slider.set(100)
+        self.flight_percent = 1
+        self.poll_live()
+
+    def poll_live(self):
+        """Append the rows that have arrived and show them"""
+        try:
+            lines = self.source.read_lines()
+        except OSError as error:
+            print("Live telemetry stopped: " + str(error))
+            self.stop_live()
+            return
+        if self.live.extend(lines):
+            self.map.show_live(self.live)
+        self.poll_id = self.after(self.poll_interval, self.poll_live)
+
+    def stop_live(self):
+        """Stop reading the live source, the shown rows are kept"""
+        if self.poll_id is not None:
+            self.after_cancel(self.poll_id)
+            self.poll_id = None
+        if self.source is not None:
+            self.source.close()
+            self.source = None
 
     def updateMap(self):
-        """Update the map"""
+        """
+        Update the map, see renderer to update it once per frame
+
+        Nothing is drawn when the shown points have not changed.
+        """
+        if self.map is None:
+            return
         self.map.draw_drone(flight_percent=self.flight_percent,
                             time_span=self.checkbox_value.get())
-        self.canvas.draw()
-        self.canvas.mpl_connect('pick_event', self.onpick)
 
-def main():
+
+def format_metric(value, digits=1):
+    """Format a metric for the panels, "-" if it is not known"""
+    if value != value:
+        return "-"
+    return "{0:.{1}f}".format(value, digits)
+
+
+def main(startup_report=False):
     """
     This is the main window of the program,
     it houses all the frames and their location relative to
     one another.
+
+    Args:
+        startup_report: Print the time taken by each stage of the startup,
+            once the default flight and its map are shown.
     """
+    perf.mark("modules imported")
     mainWindow = tk.Tk()
     mainWindow.title("GUI-Prototype")
     mainWindow.geometry("1280x720")
@@ -377,13 +865,22 @@ def main():
     mainWindow.attitudeWindow.grid(row=1, column=1)
     mainWindow.inspectWindow = InspectFrame(mainWindow, controller = mainWindow)
     mainWindow.inspectWindow.grid(row=2, column=1)
+    mainWindow.perfWindow = PerfFrame(mainWindow, controller = mainWindow)
+    mainWindow.perfWindow.grid(row=3, column=1)
     mainWindow.mapFrame = MapFrame(mainWindow, controller = mainWindow)
-    mainWindow.mapFrame.grid(row=0, column=0, rowspan=3)
+    mainWindow.mapFrame.grid(row=0, column=0, rowspan=4)
+    mainWindow.mapFrame.report_startup = startup_report
+    # Show the window before the map is built, see MapFrame.drawMap
+    mainWindow.update()
+    perf.mark("window shown")
+    mainWindow.after_idle(mainWindow.mapFrame.drawMap)
     mainWindow.mainloop()
+    if mainWindow.mapFrame.loader is not None:
+        mainWindow.mapFrame.loader.close()
 
 
 """
 This is the main loop of the program.
 """
 if __name__ == "__main__":
-    main()
+    main(startup_report="--startup-report" in sys.argv)
@@ -0,0 +1,356 @@
+"""
+Background loading of drone and wind logs
+
+Logs are parsed, joined with the wind and binned on a worker thread while
+the map of a flight is fetched on another, so the tkinter event loop keeps
+running during a load. The progress and the result of a load are posted to
+a queue, which the GUI reads from its event loop with Loader.poll. A load
+can be cancelled at any time, a log being parsed stops within a few hundred
+kB. Logs larger than memory are read out of core, see outofcore.
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.20
+"""
+
+import io
+import os
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from basemap import union
+from flightcache import default_cache
+from mapdraw import bin_flight, flight_bbox, parse_drone_csv, \
+    read_wind_csv, wind_points
+from metrics import CACHE_KIND, flight_metrics
+from outofcore import OUT_OF_CORE_BYTES, open_mapped
+from parallelcsv import PARALLEL_MIN_BYTES, parse_drone_csv_parallel
+from session import flight_bins
+import perf
+
+
+class Cancelled(Exception):
+    """Raised on the worker thread when its load has been cancelled"""
+
+
+class LoadJob():
+    """
+    A load, run on a worker thread
+
+    Attributes:
+        kind: "flight", "session" or "wind".
+        path: The log being loaded.
+        stage: The name of the running stage.
+        progress: The finished part of the load, from 0 to 1.
+        finished: Whether the last message of the job has been posted.
+    """
+
+    def __init__(self, kind, path, messages):
+        self.kind = kind
+        self.path = path
+        self.stage = None
+        self.progress = 0
+        self.finished = False
+        self.messages = messages
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """Stop the load at the next report, from any thread"""
+        self.cancelled.set()
+
+    def report(self, stage, progress):
+        """
+        Post the progress of the load, if it changed by at least 1%
+
+        Raises:
+            Cancelled: If the job has been cancelled.
+        """
+        if self.cancelled.is_set():
+            raise Cancelled()
+        if stage == self.stage and int(progress * 100) \
+                == int(self.progress * 100):
+            return
+        self.stage = stage
+        self.progress = progress
+        self.post("progress", (stage, progress))
+
+    def post(self, event, data=None):
+        self.messages.put((self, event, data))
+
+
+class ProgressFile(io.FileIO):
+    """
+    A log opened for parsing, reporting the part read to a LoadJob
+
+    pandas reads it in chunks of a few hundred kB, so the parsing of a
+    cancelled load is stopped after the current chunk.
+
+    Args:
+        path: The log to open.
+        job: The LoadJob to report to.
+        stage: The name of the stage reading the log.
+        start, end: The progress of the job before and after reading.
+    """
+
+    def __init__(self, path, job, stage, start=0, end=1):
+        super().__init__(path, "r")
+        self.size = max(os.fstat(self.fileno()).st_size, 1)
+        self.job = job
+        self.stage = stage
+        self.start = start
+        self.end = end
+
+    def read(self, size=-1):
+        self.job.report(self.stage, self.start + (self.end - self.start)
+                        * self.tell() / self.size)
+        return super().read(size)
+
+
+class Loader():
+    """
+    Runs loads on worker threads, one at a time
+
+    Starting a load cancels the current one. Every job posts ("progress",
+    (stage, progress)) messages and ends with exactly one "done" (with the
+    result), "error" (with the exception) or "cancelled" message. A flight
+    load also posts ("flight", result) once the flight is binned, before
+    its map has been fetched, with None as basemap.
+
+    Args:
+        drone_map: The DroneMap fetching the map of loaded flights. Only its
+            fetch_basemap is called from the worker threads.
+        poll_timeout: Seconds between checks for cancellation while waiting
+            for the map.
+    """
+
+    def __init__(self, drone_map, poll_timeout=0.1):
+        self.drone_map = drone_map
+        self.poll_timeout = poll_timeout
+        self.messages = queue.Queue()
+        # Cancelled jobs finish before the next starts, so the flight cache
+        # is only used by one thread
+        self.workers = ThreadPoolExecutor(max_workers=1)
+        self.map_workers = ThreadPoolExecutor(max_workers=1)
+        self.job = None
+
+    def load_flight(self, csv_path, fetch_map=True, out_of_core=None):
+        """
+        Read and bin a flight, and fetch its map
+
+        The result is a dict with the "drone_data", "points", "bins",
+        "mapped" and "metrics", see mapdraw.bin_flight and
+        metrics.flight_metrics, to pass to DroneMap.show_flight, and the
+        "basemap" and "bbox" to pass to DroneMap.show_basemap. The basemap
+        is None if not fetch_map. The metrics are cached with the flight.
+        The result without the basemap is also posted as a "flight"
+        message before the map is fetched, so the flight can be shown first.
+
+        Args:
+            csv_path: The drone log.
+            fetch_map: Whether to fetch the map of the flight.
+            out_of_core: Whether to read the flight through memory maps,
+                see outofcore. By default logs of at least
+                OUT_OF_CORE_BYTES are. Otherwise "mapped" is None.
+
+        Returns:
+            job: The LoadJob of the load.
+        """
+        return self._start(LoadJob("flight", csv_path, self.messages),
+                           self._load_flight, csv_path, fetch_map,
+                           out_of_core)
+
+    def load_session(self, csv_paths, bbox=None, fetch_map=True):
+        """
+        Read and bin flights to add to a session, and fetch the map of
+        them all
+
+        The result is a dict with the "flights", a list of (name,
+        drone_data, bins) to pass to session.Session.add, and the "basemap"
+        and "bbox" to pass to DroneMap.show_basemap. The bbox covers all
+        flights and the given bbox, e.g. that of the flights already in the
+        session. The basemap is None if not fetch_map.
+
+        Returns:
+            job: The LoadJob of the load.
+        """
+        return self._start(LoadJob("session", ", ".join(csv_paths),
+                                   self.messages),
+                           self._load_session, csv_paths, bbox, fetch_map)
+
+    def load_wind(self, csv_path, drone_data, tolerance=0.05,
+                  method="linear", join=True, mapped=None):
+        """
+        Read wind data, and join it onto a flight
+
+        The result is a dict with the "wind_data" and "merged_data" to pass
+        to DroneMap.show_wind, with the "tolerance" and "method". The
+        merged data is None if not join, e.g. for a live flight.
+
+        Args:
+            csv_path: The wind log.
+            drone_data: The flight, only read by the worker thread.
+            tolerance, method: See DroneMap.draw_wind
+            mapped: The outofcore.MappedFlight of the flight, if it was
+                loaded out of core, to join the wind on disk.
+
+        Returns:
+            job: The LoadJob of the load.
+        """
+        return self._start(LoadJob("wind", csv_path, self.messages),
+                           self._load_wind, csv_path, drone_data, tolerance,
+                           method, join, mapped)
+
+    def cancel(self):
+        """Cancel the current load, if any"""
+        if self.job is not None:
+            self.job.cancel()
+
+    def busy(self):
+        """Whether the current load has not posted its last message yet"""
+        return self.job is not None and not self.job.finished
+
+    def poll(self):
+        """
+        Return the messages posted since the last poll, without blocking
+
+        Returns:
+            messages: A list of (job, event, data) tuples, oldest first.
+        """
+        messages = []
+        while True:
+            try:
+                messages.append(self.messages.get_nowait())
+            except queue.Empty:
+                return messages
+
+    def close(self):
+        """Cancel the current load, and let the worker threads end"""
+        self.cancel()
+        self.workers.shutdown(wait=False)
+        self.map_workers.shutdown(wait=False)
+
+    def _start(self, job, load, *args):
+        self.cancel()
+        self.job = job
+        self.workers.submit(self._run, job, load, *args)
+        return job
+
+    def _run(self, job, load, *args):
+        try:
+            event, data = "done", load(job, *args)
+        except Cancelled:
+            event, data = "cancelled", None
+        except Exception as error:
+            event, data = "error", error
+        # Posted first, so the message is queued once busy() is False
+        job.post(event, data)
+        job.finished = True
+
+    def _load_flight(self, job, csv_path, fetch_map, out_of_core):
+        if out_of_core is None:
+            out_of_core = os.path.getsize(csv_path) >= OUT_OF_CORE_BYTES
+        mapped = None
+        if out_of_core:
+            # Ingested once, the bins and bounds with it
+            with ProgressFile(csv_path, job, "Reading", 0, 0.9) as log:
+                mapped = open_mapped(csv_path, log)
+            drone_data = mapped.frame()
+            bbox = mapped.bbox()
+        else:
+            with perf.span("read_drone_csv") as span:
+                drone_data = default_cache().load(
+                    csv_path, "drone",
+                    lambda path: _parse_drone_csv(path, job))
+                span.set_rows(len(drone_data))
+            bbox = flight_bbox(drone_data)
+        # Fetched while the flight is binned
+        fetching = None
+        if fetch_map:
+            fetching = self.map_workers.submit(self.drone_map.fetch_basemap,
+                                               bbox)
+        if mapped is None:
+            job.report("Binning", 0.8)
+            points, bins = bin_flight(drone_data)
+            job.report("Computing metrics", 0.85)
+            with perf.span("flight_metrics", len(points)):
+                metrics = default_cache().load(
+                    csv_path, CACHE_KIND, lambda path: flight_metrics(points))
+        else:
+            points, bins = mapped.flight(), mapped.bins()
+            job.report("Computing metrics", 0.9)
+            metrics = mapped.metrics()
+        result = {"drone_data": drone_data, "points": points, "bins": bins,
+                  "mapped": mapped, "metrics": metrics, "bbox": bbox,
+                  "basemap": None}
+        job.report("Fetching map", 0.9)
+        job.post("flight", result)
+
+        if fetching is not None:
+            result = dict(result, basemap=self._wait_for_map(job, fetching))
+        return result
+
+    def _load_session(self, job, csv_paths, bbox, fetch_map):
+        flights = []
+        boxes = [] if bbox is None else [bbox]
+        for i, csv_path in enumerate(csv_paths):
+            name = os.path.splitext(os.path.basename(csv_path))[0]
+            stage = "Reading {0} ({1}/{2})".format(name, i + 1,
+                                                   len(csv_paths))
+            start = 0.8 * i / len(csv_paths)
+            end = 0.8 * (i + 1) / len(csv_paths)
+            drone_data = default_cache().load(
+                csv_path, "drone", lambda path: _parse_drone_csv(
+                    path, job, stage, start, end))
+            job.report("Binning " + name, end)
+            drone_data, bins = flight_bins(drone_data)
+            flights.append((name, drone_data, bins))
+            if len(drone_data):
+                boxes.append(flight_bbox(drone_data))
+
+        bbox = union(boxes) if boxes else None
+        basemap = None
+        if fetch_map and bbox is not None:
+            basemap = self._wait_for_map(job, self.map_workers.submit(
+                self.drone_map.fetch_basemap, bbox))
+        return {"flights": flights, "bbox": bbox, "basemap": basemap}
+
+    def _wait_for_map(self, job, fetching):
+        """Wait for the map being fetched, checking for cancellation"""
+        while True:
+            job.report("Fetching map", 0.9)
+            try:
+                return fetching.result(self.poll_timeout)
+            except TimeoutError:
+                pass
+
+    def _load_wind(self, job, csv_path, drone_data, tolerance, method,
+                   join, mapped):
+        job.report("Reading", 0)
+        wind_data = read_wind_csv(csv_path,
+                                  drone_data["CUSTOM.updateTime"].iloc[0])
+        merged_data = None
+        if join:
+            job.report("Aligning", 0.3)
+            if mapped is not None:
+                merged_data = mapped.join_wind(wind_data, tolerance, method)
+            else:
+                merged_data = wind_points(drone_data, wind_data, tolerance,
+                                          method)
+        return {"wind_data": wind_data, "merged_data": merged_data,
+                "tolerance": tolerance, "method": method}
+
+
+def _parse_drone_csv(csv_path, job, stage="Reading", start=0, end=0.8):
+    """
+    Parse a flight, reporting the part read as the start:end of job
+
+    Large logs are parsed by worker processes when there are several
+    cores, see parallelcsv.
+    """
+    if (os.cpu_count() or 1) > 1 \
+            and os.path.getsize(csv_path) >= PARALLEL_MIN_BYTES:
+        data, _ = parse_drone_csv_parallel(
+            csv_path, progress=lambda parsed: job.report(
+                stage, start + (end - start) * parsed))
+        return data
+    with ProgressFile(csv_path, job, stage, start, end) as log:
+        return parse_drone_csv(log)
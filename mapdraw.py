@@ -5,93 +5,336 @@ Authors --Group 12 of MVK at KTH 2020.
 Version --2020.05.01
 """
 
+import collections
 import datetime
 import math
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
-import osmnx as ox
-# FOR HELP INSTALLING OSMNX, SEE THIS LINK:
-# https://stackoverflow.com/questions/45901732/could-not-find-or-load-spatialindex-c-dll-in-windows/45970431
+from matplotlib.quiver import Quiver
+from align import to_ns
+from basemap import Basemap, plot_layers
+from binning import DetailPyramid, GridIndex, TimeBins, bin_latest, \
+    closest
+from flightcache import FlightCache, default_cache
+from flightdata import Flight, as_flight, join_wind
+from metrics import flight_metrics, metrics_at
+import perf
 
 
-def read_drone_csv(csv_path):
+DRONE_COLUMNS = {
+    "CUSTOM.updateTime": str,
+    "OSD.latitude": np.float64,
+    "OSD.longitude": np.float64,
+    "OSD.pitch": np.float32,
+    "OSD.yaw": np.float32,
+    "OSD.roll": np.float32,
+    "OSD.height [m]": np.float32,
+    "CALC.hSpeed [m/s]": np.float32,
+}
+
+HOUR_NS = 3600 * 10**9
+# The size of the grid squares the drawn points are binned by
+GRID_SIZE = 0.00002
+# The number of the flight of each point of a session, see session.Session
+FLIGHT_COLUMN = "SESSION.flight"
+# Histories with more points than this are drawn with about one point per
+# LOD_PIXELS by LOD_PIXELS pixels of the map
+LOD_MIN_POINTS = 20000
+LOD_PIXELS = 3
+# Number of views whose drawn history points are kept
+LOD_CACHE_SIZE = 16
+
+
+def read_drone_csv(csv_path, cache=True):
     """
-    Read data csv
+    Read data csv, through the persistent flight cache
 
     Args:
         csv_path: The path to the .csv drone flight file.
+        cache: True to use the default FlightCache, a FlightCache to use
+            instead, or False to always parse the csv.
 
     Returns:
         data: A pandas dataframe with time, longitude, latitude, pitch, yaw,
         heigh and speed of the drone.
     """
+    with perf.span("read_drone_csv") as span:
+        if not cache:
+            data = parse_drone_csv(csv_path)
+        else:
+            data = _cached(cache).load(csv_path, "drone", parse_drone_csv)
+        span.set_rows(len(data))
+    return data
 
-    data = pd.read_csv(csv_path, delimiter=",", encoding="utf-8")
-    data = data[["CUSTOM.updateTime", "OSD.latitude", "OSD.longitude", "OSD.pitch", "OSD.yaw", "OSD.roll", "OSD.height [m]", "CALC.hSpeed [m/s]"]]
+
+def parse_drone_csv(csv_path):
+    """
+    Parse data csv
+
+    Only the needed columns are parsed, with explicit dtypes. Timestamps are
+    built with vectorized arithmetic and the hour is incremented every time
+    the minutes wrap around, so flights crossing a full hour keep
+    increasing times.
+
+    Args:
+        csv_path: The path to the .csv drone flight file.
+
+    Returns:
+        data: A pandas dataframe with time, longitude, latitude, pitch, yaw,
+        heigh and speed of the drone.
+    """
+
+    data = pd.read_csv(csv_path, delimiter=",", encoding="utf-8",
+                       usecols=list(DRONE_COLUMNS), dtype=DRONE_COLUMNS)
+    data, offsets, dates = split_rows(data[list(DRONE_COLUMNS)])
+    data["CUSTOM.updateTime"] = anchor_times(offsets, data.index.to_numpy(),
+                                             dates)
+    return data
+
+
+def split_rows(data):
+    """
+    Separate the time rows of a log from its date rows
+
+    Args:
+        data: The columns of DRONE_COLUMNS of some rows of a log, as read.
+            Its time column is replaced by the parsed times.
+
+    Returns:
+        (data, offsets, dates): The time rows without missing values, the
+        nanoseconds since the start of the hour of each, and a series of
+        the parsed dates of the date rows, by row label.
+    """
+    # Rows are either "MM:SS.f" times or, occasionally, "dd/mm/YYYY HH:MM"
+    times = parse_times(data["CUSTOM.updateTime"])
+    is_time = times.notna().to_numpy()
 
     # get date, if possible
-    dates = pd.to_datetime(data["CUSTOM.updateTime"],
+    dates = pd.to_datetime(data["CUSTOM.updateTime"][~is_time],
                            errors="coerce",
                            format="%d/%m/%Y %H:%M")
     dates = dates.dropna()
+
+    # convert time to nanoseconds since the start of the hour
+    data["CUSTOM.updateTime"] = times
+    data = data.dropna()
+    offsets = (data["CUSTOM.updateTime"].to_numpy().astype("datetime64[ns]")
+               - np.datetime64("1900-01-01", "ns")).astype(np.int64)
+    return data, offsets, dates
+
+
+def anchor_times(offsets, rows, dates):
+    """
+    Date the time rows of a log by its first date row
+
+    Args:
+        offsets: Nanoseconds since the start of the hour of each time row.
+        rows: The row labels of the time rows, in file order.
+        dates: A series of the parsed dates of the date rows, by row label.
+
+    Returns:
+        times: A datetime64[ns] array with the time of each time row.
+    """
+    # Count how many times the minutes have wrapped around
+    hours = np.zeros(len(offsets), dtype=np.int64)
+    hours[1:] = np.cumsum(np.diff(offsets) < -HOUR_NS // 2)
+
     try:
         date = dates.iloc[0]
+        hour = anchor_hour(date, dates.index[0], rows, offsets, hours)
     except IndexError:
         print("No date found - default time applied: 01/01/1990 00:00 ")
         date = datetime.datetime.strptime(
             "01/01/1990 00:00", "%d/%m/%Y %H:%M")
+        hour = 0
 
-    # convert time to datetime
-    data["CUSTOM.updateTime"] = pd.to_datetime(data["CUSTOM.updateTime"],
-                                               errors="coerce",
-                                               format="%M:%S.%f")
-    # drop nonconforming dates
-    data = data.dropna()
-    # Add date. NOTE: This does not handle the changing of the hour well :(
-    data["CUSTOM.updateTime"] = data["CUSTOM.updateTime"].apply(
-        lambda x: x.replace(year=date.year,
-                            month=date.month,
-                            day=date.day,
-                            hour=date.hour))
-    return data
+    # Add date
+    start = np.datetime64(date.replace(hour=0, minute=0), "ns") \
+        + np.timedelta64(hour, "h")
+    return start + (offsets + hours * HOUR_NS).astype("timedelta64[ns]")
 
 
-def read_wind_csv(csv_path, start_date):
+def parse_times(fields, chunk_size=100000):
+    """
+    Parse "MM:SS.f" times, like pd.to_datetime with format="%M:%S.%f" and
+    errors="coerce"
+
+    Times written like in DJI logs, "55:01.5", are parsed with array
+    arithmetic in chunks of chunk_size rows, which is much faster and lets
+    other threads, e.g. the GUI, run in between. The other fields are
+    parsed by pandas.
+
+    Args:
+        fields: A series of strings.
+
+    Returns:
+        times: A series of datetimes on 01/01/1900, NaT where a field is
+        not a time.
+    """
+    nanoseconds = np.zeros(len(fields), dtype=np.int64)
+    parsed = np.zeros(len(fields), dtype=bool)
+    digits = np.array([0, 1, 3, 4, 6])
+    for start in range(0, len(fields), chunk_size):
+        chars = fields.iloc[start:start + chunk_size].to_numpy(dtype="S8") \
+            .view(np.uint8).reshape(-1, 8)
+        values = chars[:, digits].astype(np.int64) - ord("0")
+        parsed[start:start + len(chars)] = (
+            (chars[:, 2] == ord(":")) & (chars[:, 5] == ord("."))
+            & (chars[:, 7] == 0)
+            & ((values >= 0) & (values <= 9)).all(axis=1)
+            & (values[:, 0] <= 5) & (values[:, 2] <= 5))
+        nanoseconds[start:start + len(chars)] = (
+            (values[:, 0] * 10 + values[:, 1]) * 60 * 10**9
+            + (values[:, 2] * 10 + values[:, 3]) * 10**9
+            + values[:, 4] * 10**8)
+
+    times = pd.Series(np.datetime64("1900-01-01", "ns")
+                      + nanoseconds.astype("timedelta64[ns]"),
+                      index=fields.index)
+    if not parsed.all():
+        times[~parsed] = pd.to_datetime(fields[~parsed], errors="coerce",
+                                        format="%M:%S.%f")
+    return times
+
+
+def anchor_hour(date, date_row, rows, offsets, hours):
+    """
+    Find the hour of the first time row, given the first date row
+
+    The date row holds the hour and minute at its position in the file. The
+    closest time row before it (or after it, if there is none) is assumed
+    to lie within a few minutes of that date.
+
+    Args:
+        date: The first parsed date.
+        date_row: The row label of the first date in the csv.
+        rows: The row labels of all time rows, in file order.
+        offsets: Nanoseconds since the start of the hour for each time row.
+        hours: Number of minute wrap arounds before each time row.
+
+    Returns:
+        hour: The hour of day of the first time row.
+    """
+    if len(rows) == 0:
+        return date.hour
+    i = max(np.searchsorted(rows, date_row) - 1, 0)
+    minute = offsets[i] // (60 * 10**9)
+    hour = date.hour
+    if minute - date.minute > 30:
+        hour -= 1
+    elif date.minute - minute > 30:
+        hour += 1
+    return hour - hours[i]
+
+
+def read_wind_csv(csv_path, start_date, cache=True):
     """
     Read wind data csv
 
     Args:
         csv_path: The path to the .csv drone flight file.
+        start_date: The time of the first wind sample.
+        cache: True to use the default FlightCache, a FlightCache to use
+            instead, or False to always parse the csv.
 
     Returns:
         data: A pandas dataframe with time, speed and direction
     """
-    data = pd.read_csv(csv_path, delimiter=",", encoding="utf-8")
-    data = data.dropna()
+    if cache:
+        data = _cached(cache).load(csv_path, "wind", parse_wind_csv)
+    else:
+        data = parse_wind_csv(csv_path)
+
+    return add_start_date(data, start_date)
+
+
+def add_start_date(data, start_date):
+    """
+    Convert wind times from seconds since the start to datetimes
 
-    # add start date
-    data["INCREMENTED.time"] = data["INCREMENTED.time"].apply(
-        lambda x: start_date + datetime.timedelta(seconds=x))
+    Args:
+        data: A dataframe with wind data, with times in seconds.
+        start_date: The time of the first wind sample.
 
+    Returns:
+        data: The dataframe, with datetimes.
+    """
+    data["INCREMENTED.time"] = np.datetime64(pd.Timestamp(start_date), "ns") \
+        + (data["INCREMENTED.time"].to_numpy() * 10**9) \
+        .round().astype("timedelta64[ns]")
     return data
 
 
+def parse_wind_csv(csv_path):
+    """
+    Parse wind data csv
+
+    Args:
+        csv_path: The path to the .csv wind file, or a .npy file written
+            by wind_rnd.generate_wind_data.
+
+    Returns:
+        data: A pandas dataframe with seconds since start, speed and
+        direction
+    """
+    if csv_path.endswith(".npy"):
+        data = pd.DataFrame(np.load(csv_path))
+    else:
+        data = pd.read_csv(csv_path, delimiter=",", encoding="utf-8")
+    return data.dropna()
+
+
+def _cached(cache):
+    """Return the FlightCache to use for a cache argument"""
+    return cache if isinstance(cache, FlightCache) else default_cache()
+
+
 class DroneMap():
     """
     Class that contains a drone map, with figure, axes and data
     """
 
-    def __init__(self):
+    def __init__(self, csv_path="Data/attitutf.csv", basemap=None,
+                 use_raster=False, blit=True):
+        """
+        Args:
+            csv_path: The drone flight to show, or None to start with an
+                empty map.
+            basemap: The Basemap serving the map layers. If None, layers
+                are fetched from OpenStreetMap and cached on disk.
+            use_raster: Draw a cached image of the map instead of the
+                vector layers.
+            blit: Only redraw the drone points and wind arrows on top of a
+                cached image of the map, instead of redrawing everything.
+        """
         self.flight_percent = 0
         self.time_span = None
         self.drone_points = None
-        self.arrows = []
+        self.wind_field = None
+        self.wind_clim = None
         self.xlim_diff = 0
         self.wind_data = None
-        self.drone_data = read_drone_csv("Data/attitutf.csv")
-        self.merged_data = self.grid_bin_data(self.drone_data)
-        self.data = None
+        self.wind_options = (0.05, "linear")
+        self.live = None
+        self.session = None
+        self.mapped = None
+        self.metrics = None
+        self.basemap = basemap if basemap is not None else Basemap()
+        self.use_raster = use_raster
+        self.blit = blit
+        self.background = None
+        self.canvas = None
+        self.map_artists = []
+        if csv_path is None:
+            # An empty map, until a flight is shown with show_flight
+            self._drone_data = None
+            self.set_merged_data(Flight.empty())
+            self.create_figure()
+            return
+        self.drone_data = read_drone_csv(csv_path)
+        self.set_merged_data(*bin_flight(self.drone_data))
+        self.metrics = flight_metrics(self.points)
         self.draw_map()
         self.draw_drone()
 
@@ -100,17 +343,227 @@ class DroneMap():
         return self.fig
 
     def get_data_length(self):
+        if self.live is not None:
+            return len(self.live)
+        if self.session is not None:
+            return self.session.num_rows()
+        if self._drone_data is None:
+            return 0
         return len(self.drone_data)
 
     def get_drone_data(self):
         """Fetch drone data, a dataframe with longitude and latitude points"""
         return self.drone_data
 
+    @property
+    def drone_data(self):
+        """
+        The shown flight, read from the live flight when streaming, or the
+        visible flights of a session
+        """
+        if self.live is not None:
+            return self.live.data()
+        if self.session is not None:
+            return self.session.data()
+        return self._drone_data
+
+    @drone_data.setter
+    def drone_data(self, drone_data):
+        self.live = None
+        self.session = None
+        self.mapped = None
+        self.metrics = None
+        self._drone_data = drone_data
+
     def set_drone_data(self, csv_path):
         """Set the drone data to be shown on the map"""
-        self.drone_data = read_drone_csv(csv_path)
+        drone_data = read_drone_csv(csv_path)
+        points, bins = bin_flight(drone_data)
+        self.show_flight(drone_data, points, bins,
+                         metrics=flight_metrics(points))
+
+    def show_flight(self, drone_data, points, bins=None, mapped=None,
+                    metrics=None):
+        """
+        Show a flight that has already been read and binned, e.g. by a
+        loader.Loader
+
+        Args:
+            drone_data: The flight, see read_drone_csv.
+            points, bins: The points of the flight and their bins, see
+                bin_flight. If bins is None, points are drawn as they are,
+                e.g. the binned points of grid_bin_data.
+            mapped: The outofcore.MappedFlight the flight is read from, if
+                it is loaded out of core. Wind is then joined on disk.
+            metrics: The metrics of points, see metrics.flight_metrics, or
+                None if not known.
+        """
+        self.drone_data = drone_data
+        self.mapped = mapped
+        self.metrics = metrics
+        self.wind_data = None
+        if self.wind_field is not None:
+            self.wind_field.remove()
+            self.wind_field = None
+        self.set_merged_data(points, bins)
         self.draw_drone()
 
+    def set_merged_data(self, merged_data, bins=None):
+        """
+        Set the points to draw, sorted by time
+
+        The points are kept as a flightdata.Flight, whose contiguous times
+        are searched for a time span with a binary search, and the drawn
+        points are slices of its columns, or with bins the latest point of
+        every grid square within the time span.
+
+        Args:
+            merged_data: The points to draw, a dataframe or a Flight.
+            bins: A binning.TimeBins over the points, which are then
+                already sorted by time, see bin_flight, or the
+                session.SessionBins of a session, or None to draw all
+                points of the time span.
+        """
+        self.points = as_flight(merged_data)
+        if bins is None:
+            self.points = self.points.sorted_by_time()
+        self.bins = bins
+        self.times = self.points.times
+        self.longitudes = self.points.longitudes
+        self.latitudes = self.points.latitudes
+        self.window = (0, 0)
+        # The (start, latest, end) window last drawn by draw_drone
+        self.drawn_window = None
+        self.history_window = (0, 0)
+        self.history_view = None
+        # Covers all points, picks are limited to the drawn window. Built
+        # on the first pick, see get_spatial_index
+        self.spatial_index = None
+        # Built when a long history is first drawn
+        self.detail = None
+        self.detail_views = collections.OrderedDict()
+        # The points of each flight of a session, to find their latest,
+        # known by the bins of a session
+        self.flight_points = getattr(bins, "positions", None)
+        if self.points.flights is not None and self.flight_points is None:
+            flights = self.points.flights
+            order = np.argsort(flights, kind="mergesort")
+            self.flight_points = np.split(
+                order, np.flatnonzero(np.diff(flights[order])) + 1)
+
+    def pick(self, mouse_event, radius=5):
+        """
+        Find the drawn point nearest to a mouse click
+
+        Args:
+            mouse_event: The matplotlib mouse event of the click.
+            radius: Maximum distance from the click, in points (1/72 inch).
+
+        Returns:
+            index: The row of the picked point in points, or None.
+        """
+        x, y = self.ax.transData.inverted().transform(
+            (mouse_event.x, mouse_event.y))
+        xmin, xmax = self.ax.get_xlim()
+        ymin, ymax = self.ax.get_ylim()
+        start, end = self.window
+        x_scale = self.ax.bbox.width / abs(xmax - xmin)
+        y_scale = self.ax.bbox.height / abs(ymax - ymin)
+        radius = radius * self.fig.dpi / 72
+        if self.bins is None:
+            return self.get_spatial_index().nearest(
+                x, y, x_scale, y_scale, radius, start, end)
+        # The nearest of the binned points of the window
+        self.bins.move(start, end)
+        return closest(self.longitudes, self.latitudes, self.bins.rows(),
+                       x, y, x_scale, y_scale, radius)
+
+    def metrics_at(self, index):
+        """
+        Look up the metrics of a point, see metrics.metrics_at
+
+        The metrics of a live flight are computed when first looked up
+        after rows arrive, over the buffered rows, so the distance is the
+        distance since the oldest of them.
+
+        Returns:
+            values: A dict from metric names to floats, empty if the
+            metrics of the shown points are not known.
+        """
+        if self.metrics is None and self.live is not None \
+                and len(self.points):
+            self.metrics = flight_metrics(self.points)
+        if self.metrics is None:
+            return {}
+        return metrics_at(self.points, self.metrics, index)
+
+    def get_spatial_index(self):
+        """Return the binning.GridIndex of the points, building it once"""
+        if self.spatial_index is None:
+            self.spatial_index = GridIndex(self.longitudes, self.latitudes)
+        return self.spatial_index
+
+    @property
+    def merged_data(self):
+        """The points to draw as a dataframe, sharing their arrays"""
+        return self.points.to_frame()
+
+    @property
+    def data(self):
+        """The currently drawn points, of the merged data"""
+        start, end = self.window
+        if self.bins is None:
+            return self.points.take(slice(start, end)).to_frame()
+        self.bins.move(start, end)
+        return self.points.take(self.bins.rows()).to_frame()
+
+    def find_window(self, flight_percent, time_span):
+        """
+        Find the points within a time span, with a binary search on time
+
+        Args:
+            flight_percent: The percent of the flight to find points up to
+            time_span: The number of seconds before the end to find points
+                for. None or 0 means the whole flight.
+
+        Returns:
+            (start, latest, end): The points start:latest are drawn as
+            history and latest:end are the latest points.
+        """
+        if len(self.times) == 0:
+            return 0, 0, 0
+        first = self.times[0]
+        duration = self.times[-1] - first
+        return self.window_at(first + int(duration * flight_percent),
+                              time_span)
+
+    def window_at(self, time_end, time_span):
+        """
+        Find the points within a time span, ending at a time
+
+        Args:
+            time_end: The time to find points up to, in ns.
+            time_span: See find_window
+
+        Returns:
+            (start, latest, end): See find_window
+        """
+        if len(self.times) == 0:
+            return 0, 0, 0
+        if time_span is None or time_span == 0:
+            time_span_ns = self.times[-1] - self.times[0]
+        else:
+            time_span_ns = int(time_span * 10**9)
+
+        time_start = time_end - time_span_ns
+        start = int(np.searchsorted(self.times, time_start, side="left"))
+        end = int(np.searchsorted(self.times, time_end, side="right"))
+        if end <= start:
+            return start, start, start
+        latest = int(np.searchsorted(self.times, self.times[end - 1],
+                                     side="left"))
+        return start, latest, end
+
     def draw_map(self, padx=0.001, pady=0.001):
         """
         Generate a 2d matplotlib plot with buildings and the drone flight path
@@ -124,91 +577,170 @@ class DroneMap():
         Returns:
             fig: A matplotlib figure containing the drone map
         """
-        north = max(self.drone_data["OSD.latitude"]) + pady
-        south = min(self.drone_data["OSD.latitude"]) - pady
-        east = max(self.drone_data["OSD.longitude"]) + padx
-        west = min(self.drone_data["OSD.longitude"]) - padx
+        bbox = flight_bbox(self.drone_data, padx, pady)
+        self.create_figure()
+        self.show_basemap(self.fetch_basemap(bbox), bbox)
+        return self.fig
 
-        # Fetch the OSM data
-        place = "Åkersberga, Sweden"
-        graph = ox.graph_from_bbox(north, south, east, west)
-        area = ox.gdf_from_place(place)
-        buildings = ox.create_footprints_gdf(
-            "shapely Polygon", north, south, east, west)
-        _, edges = ox.graph_to_gdfs(graph)
+    def fetch_basemap(self, bbox):
+        """
+        Get the map of a bbox, fetched from OSM or the basemap cache
 
-        # Plot the different map features
-        self.fig, self.ax = plt.subplots(figsize=(10, 7))
-        area.plot(ax=self.ax, facecolor='black')
-        edges.plot(ax=self.ax, linewidth=1, edgecolor='#BC8F8F')
-        buildings.plot(ax=self.ax, facecolor='khaki', alpha=0.7)
-        try:
-            leisure = ox.create_footprints_gdf(
-                "shapely Polygon", north, south, east, west, "leisure")
-            parks = leisure[leisure["leisure"].isin(["park","playground"])]
-            parks.plot(ax=self.ax, facecolor='limegreen')
-        except:
-            print("No parks within bbox")
+        Only reads the basemap, so it can be called from a worker thread.
+
+        Args:
+            bbox: The (north, south, east, west) bbox to get the map of.
 
+        Returns:
+            basemap_data: An image of the map if use_raster is set,
+            otherwise the map layers.
+        """
+        if self.use_raster:
+            return self.basemap.get_raster(*bbox)
+        return self.basemap.get_layers(*bbox)
+
+    def show_basemap(self, basemap_data, bbox):
+        """
+        Replace the drawn map, and show the bbox
+
+        Args:
+            basemap_data: The map, see fetch_basemap.
+            bbox: The (north, south, east, west) bbox of the map.
+        """
+        north, south, east, west = bbox
+        for artist in self.map_artists:
+            artist.remove()
+        drawn = set(self.ax.get_children())
+        if self.use_raster:
+            self.ax.imshow(basemap_data, extent=(west, east, south, north))
+        else:
+            plot_layers(self.ax, basemap_data)
+        self.map_artists = [artist for artist in self.ax.get_children()
+                            if artist not in drawn]
+        self.show_view(bbox)
+
+    def show_view(self, bbox):
+        """
+        Show a bbox, e.g. of a flight whose map is still being fetched
+
+        Args:
+            bbox: The (north, south, east, west) bbox to show.
+        """
+        north, south, east, west = bbox
         self.ax.axis("equal")
         self.ax.set_xlim(west, east)
         self.xlim_diff = east - west
         self.ax.set_ylim(north, south)
-        plt.tight_layout()
+        self.fig.tight_layout()
+        # The cached map no longer matches
+        self.background = None
+
+    def create_figure(self):
+        """Create the figure and axes, with the persistent artists"""
+        self.fig, self.ax = plt.subplots(figsize=(10, 7))
 
         # Event handlers
         def on_xlims_change(axes):
-            # Update the reference scale for arrow drawing
-            # TODO: Find some way to update the map on zoom action, rather than
-            #       having to wait for the slider to be updated
+            # Update the reference scale for arrow drawing. The canvas is
+            # redrawn after a zoom, which draws the rescaled arrows and the
+            # history points chosen for the new view.
             x, xmax = self.ax.get_xlim()
             self.xlim_diff = xmax - x
+            self.scale_wind_field()
 
         # Set callback, to update arrow size when screen is zoomed
         self.ax.callbacks.connect('xlim_changed', on_xlims_change)
 
-    def grid_bin_data(self, data, grid_size=0.00002):
+        # Persistent artists for the drone points, only their data changes.
+        # Animated artists are left out of full draws and blitted on top.
+        previous_points, = self.ax.plot([], [], 'co', picker=5,
+                                        animated=self.blit)
+        latest_point, = self.ax.plot([], [], 'ro', markersize=7, picker=5,
+                                     animated=self.blit)
+        self.drone_points = [previous_points, latest_point]
+
+    def connect_canvas(self):
+        """
+        Listen to draw events of the current figure canvas
+
+        The canvas is replaced when the figure is embedded in tkinter, so
+        this is checked before every redraw.
+        """
+        if self.canvas is self.fig.canvas:
+            return
+        self.canvas = self.fig.canvas
+        self.background = None
+        self.canvas.mpl_connect('draw_event', self.on_draw)
+
+    def on_draw(self, event):
+        """
+        Cache the freshly drawn map and draw the animated artists on it
+
+        After a zoom or pan the history points are chosen again for the
+        new view, without blitting they are drawn by another full draw.
+        """
+        changed = self.draw_history(*self.history_window)
+        if not self.blit or not hasattr(self.canvas, "copy_from_bbox"):
+            if changed:
+                self.canvas.draw_idle()
+            return
+        self.background = self.canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_animated()
+
+    def draw_animated(self):
+        """Draw the drone points and wind arrows onto the canvas"""
+        for artist in self.drone_points:
+            self.ax.draw_artist(artist)
+        if self.wind_field is not None:
+            self.ax.draw_artist(self.wind_field)
+
+    def redraw(self):
+        """
+        Show the updated drone points and wind arrows
+
+        When blitting, the cached map is restored and only the animated
+        artists are drawn. A full draw is done if there is no cached map
+        yet, e.g. on the first draw or after the canvas has changed.
+        """
+        self.connect_canvas()
+        if self.blit and self.background is not None:
+            with perf.span("blit"):
+                self.canvas.restore_region(self.background)
+                self.draw_animated()
+                self.canvas.blit(self.fig.bbox)
+        else:
+            with perf.span("canvas.draw"):
+                self.canvas.draw()
+
+    @staticmethod
+    def grid_bin_data(data, grid_size=GRID_SIZE):
         """
         Collapse data points into chunks of size grid_size,
-        taking only the latest point
+        taking only the latest point of the whole flight. See bin_flight
+        to only bin the points of the time span drawn.
         TODO: Do something cool with clustering
         TODO: Weight averaging by time
             Newer points should have more weight in the average
-        TODO: Dont bin points outside of slider scope maybe?
 
         args:
+            data: A dataframe with longitude, latitude and time columns
             grid_size: The size of each grid square
+
+        Returns:
+            binned_data: A dataframe with the latest point of each occupied
+            grid square, ordered by grid column and then by grid row
         """
-        # Get bin bounds
-        xmin = round_down(min(data["OSD.longitude"]), grid_size)
-        xmax = round_up(max(data["OSD.longitude"]), grid_size)
-        ymin = round_down(min(data["OSD.latitude"]), grid_size)
-        ymax = round_up(max(data["OSD.latitude"]), grid_size)
-
-        # new dataframe
-        binned_data = pd.DataFrame(columns=data.columns)
-
-        # Bin for each grid location
-        for x in np.arange(xmin, xmax, grid_size):
-            for y in np.arange(ymin, ymax, grid_size):
-                xend = x + grid_size
-                yend = y + grid_size
-                points = data.loc[(data["OSD.longitude"] >= x)
-                                       & (data["OSD.longitude"] < xend)
-                                       & (data["OSD.latitude"] >= y)
-                                       & (data["OSD.latitude"] < yend)].copy()
-                if points.size == 0:
-                    continue
-
-                # get most recent point
-                point = points.loc[points["CUSTOM.updateTime"]
-                                   == max(points["CUSTOM.updateTime"])]
-
-                binned_data = binned_data.append(point, ignore_index=True)
+        with perf.span("grid_bin_data", len(data)):
+            latest = bin_latest(data["OSD.longitude"].to_numpy(),
+                                data["OSD.latitude"].to_numpy(),
+                                data["CUSTOM.updateTime"].to_numpy(),
+                                grid_size)
+            binned_data = data.iloc[latest].reset_index(drop=True)
 
         return binned_data
 
-    def draw_drone(self, flight_percent=None, time_span=None):
+    def draw_drone(self, flight_percent=None, time_span=None,
+                   time_end=None):
         """
         Function that draws (or redraws) drone data points
 
@@ -216,7 +748,14 @@ class DroneMap():
             flight_percent: The percent of the flight to draw points up to
             time_span: The number of seconds before end to draw points.
                 This creates a window of time that you can see points for
+            time_end: The time to draw points up to, in ns, instead of
+                flight_percent. Used by playback, to draw exactly up to a
+                sample.
         """
+        if time_end is not None and len(self.times):
+            first, last = self.timeline()
+            flight_percent = (time_end - first) / (last - first) \
+                if last > first else 1
         # Cache time_end and time_stamp so they are not
         # reset after wind data is loaded in.
         if flight_percent is None:
@@ -228,100 +767,385 @@ class DroneMap():
         else:
             self.time_span = time_span
 
-        if self.merged_data is not None:
-            self.data = self.merged_data
-        else:
-            self.data = self.drone_data.copy()
-        all_time_points = self.data["CUSTOM.updateTime"]
-
         # If history box is checked, time_span is the entire flight
         # duration so all points are drawn. If unchecked, time_span
         # is default 10 so only the last 10 seconds are drawn.
-        if time_span is None or time_span == 0:
-            time_span = (max(all_time_points) - min(
-                all_time_points)).seconds
-
-        # Set the time interval where points are draw
-        time_end_seconds = (max(all_time_points) - min(
-            all_time_points)).seconds * flight_percent
-        time_end = min(all_time_points) + \
-            datetime.timedelta(seconds=time_end_seconds)
-        time_start = time_end - \
-            datetime.timedelta(seconds=time_span)
-
-        # Drop all points that aren't within our time interval
-        data_subset = self.data.drop(self.data[(all_time_points < time_start) | (
-            all_time_points > time_end)].index)
-        if data_subset.size == 0:
-            return
+        with perf.span("draw_drone") as span:
+            if time_end is not None:
+                start, latest, end = self.window_at(time_end, time_span)
+            else:
+                start, latest, end = self.find_window(flight_percent,
+                                                      time_span)
+            if end == start:
+                return
+            if (start, latest, end) == self.drawn_window:
+                # The same points are drawn, e.g. the slider moved less
+                # than the time between two points
+                return
+            self.window = (start, end)  # The currently displayed points
+            span.set_rows(end - start)
+
+            # Move the persistent artists to the new points. Last point in
+            # red, all points except last in cyan
+            latest_point = self.drone_points[1]
+            latest_points = self.latest_points(start, latest, end)
+            latest_point.set_data(self.longitudes[latest_points],
+                                  self.latitudes[latest_points])
+            self.history_window = (start, latest)
+            self.draw_history(start, latest)
+
+            self.redraw()  # Update canvas
+            self.drawn_window = (start, latest, end)
+
+    def timeline(self):
+        """Return the first and last time of the points, in ns, or None"""
+        if len(self.times) == 0:
+            return None
+        return int(self.times[0]), int(self.times[-1])
+
+    def sample_times(self):
+        """
+        Return the sorted times of the samples of the shown flight, in ns
+
+        These are the times of all rows of a flight, a live flight or the
+        visible flights of a session.
+        """
+        if self.bins is not None or self.live is not None \
+                or self.session is not None or self._drone_data is None:
+            return self.times
+        times = to_ns(self._drone_data["CUSTOM.updateTime"])
+        if np.all(times[1:] >= times[:-1]):
+            return times
+        return np.sort(times)
+
+    def invalidate(self):
+        """Draw the points on the next draw_drone, even if unchanged"""
+        self.drawn_window = None
+
+    def latest_points(self, start, latest, end):
+        """
+        Choose the points drawn as latest, of the points start:end
+
+        Returns:
+            latest_points: The points latest:end, or when showing a session
+            the latest point of every flight.
+        """
+        if self.flight_points is None:
+            return slice(latest, end)
+        points = []
+        for flight_points in self.flight_points:
+            i = np.searchsorted(flight_points, end) - 1
+            if i >= 0 and flight_points[i] >= start:
+                points.append(flight_points[i])
+        return np.array(points, dtype=np.int64)
+
+    def draw_history(self, start, latest):
+        """
+        Move the history points, and their wind vectors, to the points
+        start:latest, without redrawing
+
+        Returns:
+            changed: Whether other points are drawn than before.
+        """
+        view, history = self.history_points(start, latest)
+        changed = view != self.history_view
+        self.history_view = view
+        previous_points = self.drone_points[0]
+        previous_points.set_data(self.longitudes[history],
+                                 self.latitudes[history])
+
+        # Show the wind vectors of the drawn points, if applicable
+        if self.wind_field is not None and changed:
+            self.show_wind_field(history)
+        return changed
+
+    def history_points(self, start, latest):
+        """
+        Choose the history points to draw
+
+        With bins, the latest point of every grid square within the drawn
+        time span is drawn, see binning.TimeBins, and the bins are updated
+        from those of the last drawn time span.
 
-        self.data = data_subset.copy()  # Update data to contain currently displayed points
-
-        # Extract the latest point to distinguish it from the rest
-        last_point = data_subset.loc[data_subset["CUSTOM.updateTime"] == max(
-            data_subset["CUSTOM.updateTime"])]
-        data_subset = data_subset.drop(last_point.index)
-
-        # Remove old points from screen and reset drone_points to
-        # avoid memory leak.
-        if self.drone_points is not None:
-            for point in self.drone_points:
-                point.remove()
-            self.drone_points = None
-
-        # Plot all points except last in cyan
-        previous_points = self.ax.plot(
-            data_subset["OSD.longitude"].to_numpy(),
-            data_subset["OSD.latitude"].to_numpy(), 'co', picker=5)
-
-        # Plot last point in red
-        latest_point = self.ax.plot(
-            last_point["OSD.longitude"].to_numpy(),
-            last_point["OSD.latitude"].to_numpy(), 'ro', markersize=7,
-            picker=5)
-
-        # Concatenate last point to previous points and draw to screen
-        self.drone_points = previous_points + latest_point
-
-        # Clear arrows for redrawing
-        if self.arrows:
-            for arrow in self.arrows:
-                arrow.remove()
-            self.arrows = []
-        # Draw wind vectors, if applicable
-        if "RANDOM.windSpeed" in data_subset.columns:
-            xleft, xright = self.ax.get_xlim()
-            xdiff = xright - xleft
-            arrow_size_mod = 0.006 * xdiff
-            for _, point in data_subset.iterrows():
-                x = point["OSD.longitude"]
-                y = point["OSD.latitude"]
-                try:
-                    wx = math.cos(math.radians(point["RANDOM.direction"])) * \
-                        point["RANDOM.windSpeed"] * arrow_size_mod
-                    wy = math.sin(math.radians(point["RANDOM.direction"])) * \
-                        point["RANDOM.windSpeed"] * arrow_size_mod
-                except KeyError:
-                    print("Wind data missing for " +
-                          str(point["CUSTOM.updateTime"]) + "!")
-                    continue
-                self.arrows.append(self.ax.arrow(
-                    x, y, wx, wy, width=arrow_size_mod))
-
-        self.fig.canvas.draw()  # Update canvas
-
-    def draw_wind(self, csv_path):
+        Long histories are reduced to about one point per LOD_PIXELS by
+        LOD_PIXELS pixels of the current view, see binning.DetailPyramid,
+        or with bins by the centers of their grid squares.
+        Every drawn point is at most a few pixels from a left out point, so
+        isolated points are always drawn. The chosen points are cached for
+        the last LOD_CACHE_SIZE views.
+
+        Returns:
+            (view, history): A key of the view and the time window, and a
+            slice or an index array of the points to draw.
+        """
+        end = self.window[1]
+        if self.bins is None:
+            if latest - start <= LOD_MIN_POINTS:
+                return (start, latest), slice(start, latest)
+        elif min(end - start, self.bins.num_cells) <= LOD_MIN_POINTS:
+            return (start, latest, end), self.binned_history(start, latest)
+        xlim = self.ax.get_xlim()
+        ylim = self.ax.get_ylim()
+        columns = max(int(self.ax.bbox.width / LOD_PIXELS), 1)
+        rows = max(int(self.ax.bbox.height / LOD_PIXELS), 1)
+        view = (start, latest, end, xlim, ylim, columns, rows)
+        history = self.detail_views.get(view)
+        if history is None:
+            with perf.span("history_points", latest - start):
+                if self.bins is not None:
+                    self.bins.move(start, end)
+                    history = self.bins.select(xlim, ylim, columns, rows,
+                                               latest)
+                else:
+                    if self.detail is None:
+                        self.detail = DetailPyramid(
+                            self.longitudes, self.latitudes,
+                            self.get_spatial_index())
+                    history = self.detail.select(xlim, ylim, columns, rows,
+                                                 start, latest)
+            self.detail_views[view] = history
+            if len(self.detail_views) > LOD_CACHE_SIZE:
+                self.detail_views.popitem(last=False)
+        else:
+            self.detail_views.move_to_end(view)
+        return view, history
+
+    def binned_history(self, start, latest):
+        """
+        Return the sorted rows of the latest point of every grid square in
+        the drawn time span, which are not drawn as latest, see TimeBins
+        """
+        self.bins.move(start, self.window[1])
+        rows = self.bins.rows()
+        return rows[:np.searchsorted(rows, latest)]
+
+    def draw_wind(self, csv_path, tolerance=0.05, method="linear"):
         """
         Draw vectors from csv data onto the map
 
         Args:
             csv_path: The path to the csv file
+            tolerance: Maximum number of seconds between a drone sample and
+                the nearest wind sample for it to get wind data
+            method: "nearest" to use the nearest wind sample, or "linear"
+                to interpolate between the wind samples around each point
         """
         self.wind_data = read_wind_csv(csv_path, self.drone_data["CUSTOM.updateTime"].iloc[0])
-        self.merged_data = self.drone_data.merge(self.wind_data, how="left", left_on="CUSTOM.updateTime", right_on="INCREMENTED.time")
-        self.merged_data = self.grid_bin_data(self.merged_data)
+        self.merge_wind(tolerance, method)
+
+    def set_wind_data(self, wind_data, tolerance=0.05, method="linear"):
+        """
+        Draw wind data from memory, e.g. from wind_rnd.wind_dataframe
+
+        Args:
+            wind_data: A dataframe like a wind csv, with times in seconds
+                since the start of the flight
+            tolerance, method: See draw_wind
+        """
+        self.wind_data = add_start_date(
+            wind_data.copy(), self.drone_data["CUSTOM.updateTime"].iloc[0])
+        self.merge_wind(tolerance, method)
+
+    def merge_wind(self, tolerance, method):
+        """Join the wind data onto the drone data and draw it"""
+        merged_data = None
+        if self.live is None and self.session is None:
+            if self.mapped is not None:
+                merged_data = self.mapped.join_wind(self.wind_data,
+                                                    tolerance, method)
+            else:
+                merged_data = wind_points(self.drone_data, self.wind_data,
+                                          tolerance, method)
+        self.show_wind(self.wind_data, merged_data, tolerance, method)
+
+    def show_wind(self, wind_data, merged_data, tolerance=0.05,
+                  method="linear"):
+        """
+        Show wind data that has already been joined onto the drone data,
+        e.g. by a loader.Loader
+
+        Args:
+            wind_data: The wind data, with datetimes.
+            merged_data: The binned points with wind, see wind_points. Not
+                used when showing a live flight, whose points are joined
+                with the wind whenever rows arrive, or a session, whose
+                flights are joined with the wind here.
+            tolerance, method: See draw_wind
+        """
+        self.wind_data = wind_data
+        self.wind_options = (tolerance, method)
+        if self.live is not None:
+            self.show_live(self.live)
+            return
+        if self.session is not None:
+            self.session.join_wind(wind_data, tolerance, method)
+            self.show_session(self.session)
+            return
+        # The same points as before, with wind
+        self.set_merged_data(merged_data, self.bins)
+        self.make_wind_field()
+        self.draw_drone()
+
+    def show_live(self, live_flight):
+        """
+        Show the rows of a live flight, see stream.LiveFlight
+
+        Called whenever rows have been added to the live flight. The view
+        is widened when the drone leaves it, without fetching new map
+        layers. Like a loaded flight, the latest point of every grid square
+        within the time span shown is drawn. The metrics of the rows are
+        computed when looked up, see metrics_at.
+
+        Args:
+            live_flight: The LiveFlight to show.
+        """
+        self.live = live_flight
+        self.session = None
+        self.metrics = None
+        points, bins = live_flight.points()
+        if self.wind_data is not None:
+            points = join_wind(points, self.wind_data, *self.wind_options)
+        self.set_merged_data(points, bins)
+        if self.wind_data is not None:
+            self.make_wind_field()
+        elif self.wind_field is not None:
+            self.wind_field.remove()
+            self.wind_field = None
+        self.fit_view()
         self.draw_drone()
 
+    def show_session(self, session):
+        """
+        Show the visible flights of a session, see session.Session
+
+        Called again whenever flights are added, shown or hidden, or the
+        time axis of the session changes. The map is not changed, see
+        show_basemap.
+
+        Args:
+            session: The Session to show.
+        """
+        self.live = None
+        self.session = session
+        points, bins, self.metrics = session.points()
+        self.set_merged_data(points, bins)
+        if self.wind_field is not None:
+            self.wind_field.remove()
+            self.wind_field = None
+        if len(self.points) == 0:
+            # All flights are hidden
+            for artist in self.drone_points:
+                artist.set_data([], [])
+            self.redraw()
+            return
+        if session.has_wind:
+            self.make_wind_field()
+        self.draw_drone()
+
+    def fit_view(self, padx=0.001, pady=0.001):
+        """Widen the view to show all points, if any point is outside it"""
+        limits = [self.ax.get_xlim(), self.ax.get_ylim()]
+        extents = [(self.longitudes.min(), self.longitudes.max(), padx),
+                   (self.latitudes.min(), self.latitudes.max(), pady)]
+        if all(min(limit) <= low and high <= max(limit) for limit,
+               (low, high, _) in zip(limits, extents)):
+            return
+        for limit, (low, high, pad), set_limit in zip(
+                limits, extents, [self.ax.set_xlim, self.ax.set_ylim]):
+            widened = (min(low - pad, min(limit)), max(high + pad, max(limit)))
+            # Keep the direction of the axis
+            set_limit(widened if limit[0] <= limit[1] else widened[::-1])
+        # The cached map no longer matches the view
+        self.background = None
+
+    def make_wind_field(self):
+        """
+        Create the wind arrows of the points, coloured by wind speed on a
+        common scale. Arrows are only drawn for the drawn history points,
+        see show_wind_field.
+        """
+        # No arrows are drawn where no wind sample was close enough. The
+        # NaN ignoring reductions copy nothing, the speeds may be on disk.
+        speed = self.points.wind_speed
+        self.wind_clim = None
+        if len(speed):
+            low, high = np.fmin.reduce(speed), np.fmax.reduce(speed)
+            if not np.isnan(low):
+                self.wind_clim = (float(low), float(high))
+        self.show_wind_field(self.history_points(*self.history_window)[1])
+
+    def show_wind_field(self, history):
+        """
+        Replace the wind arrows with those of the history points
+
+        matplotlib builds a path for every arrow of a quiver on every draw,
+        masked or not, so the arrows are recreated for the drawn points
+        instead of masking those of all points.
+
+        Args:
+            history: A slice or an index array of the points.
+        """
+        if self.wind_field is not None:
+            self.wind_field.remove()
+        points = self.points
+        self.wind_field = Quiver(
+            self.ax, self.longitudes[history], self.latitudes[history],
+            points.wind_u[history], points.wind_v[history],
+            points.wind_speed[history], cmap="viridis", clim=self.wind_clim,
+            angles="xy", scale_units="xy", units="xy", animated=self.blit)
+        # Added without rescaling the axes to the arrows
+        self.ax.add_collection(self.wind_field, autolim=False)
+        self.scale_wind_field()
+
+    def scale_wind_field(self):
+        """Scale the wind arrows to the width of the shown part of the map"""
+        if self.wind_field is None:
+            return
+        arrow_size_mod = 0.006 * self.xlim_diff
+        self.wind_field.scale = 1 / arrow_size_mod
+        self.wind_field.width = arrow_size_mod
+
+
+def flight_bbox(drone_data, padx=0.001, pady=0.001):
+    """Return the padded (north, south, east, west) bbox of a flight"""
+    return (float(drone_data["OSD.latitude"].max()) + pady,
+            float(drone_data["OSD.latitude"].min()) - pady,
+            float(drone_data["OSD.longitude"].max()) + padx,
+            float(drone_data["OSD.longitude"].min()) - padx)
+
+
+def bin_flight(drone_data, grid_size=GRID_SIZE):
+    """
+    Prepare a flight to be drawn binned by the time span shown
+
+    Returns:
+        (points, bins): The points of the flight as a flightdata.Flight,
+        sorted by time, and the binning.TimeBins of the points, to pass to
+        DroneMap.show_flight.
+    """
+    points = as_flight(drone_data).sorted_by_time()
+    with perf.span("time_bins", len(points)):
+        bins = TimeBins(points.longitudes, points.latitudes, grid_size)
+    return points, bins
+
+
+def wind_points(drone_data, wind_data, tolerance=0.05, method="linear"):
+    """
+    Join wind data onto the points of a flight
+
+    Args:
+        drone_data: The flight, see read_drone_csv.
+        wind_data: The wind data, with datetimes.
+        tolerance, method: See DroneMap.draw_wind
+
+    Returns:
+        points: A flightdata.Flight of the points, sorted by time like those
+        of bin_flight, with wind speed, direction and vector components.
+    """
+    points = as_flight(drone_data).sorted_by_time()
+    with perf.span("join_wind", len(points)):
+        return join_wind(points, wind_data, tolerance, method)
+
 
 def round_down(x, a):
     return math.floor(x / a) * a
@@ -0,0 +1,218 @@
+"""
+Metrics derived from the samples of a flight
+
+The metrics of a flight are computed once per load, for every row at once
+with NumPy, and looked up by row when a point is inspected, see metrics_at.
+Rows are those of the points of DroneMap, sorted by time. Speeds are found
+from the rows before and after each row, and rolling statistics over the
+ROLLING_SECONDS up to each row, from cumulative sums.
+
+The flights of a session have their metrics computed when added, each
+over its own rows, see session.Session. Those of a live flight are
+computed over its buffered rows when a point is looked up, see
+DroneMap.metrics_at.
+
+The wind components of a row only depend on the row itself and the wind
+joined onto it, so they are computed when looked up, for the wind shown.
+
+Directions are in degrees clockwise from north, like the yaw of the logs.
+The wind blows along its arrows on the map, see flightdata.with_wind.
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.29
+"""
+
+import numpy as np
+import pandas as pd
+
+
+# Bump when the metrics change, to ignore cached metrics
+METRICS_VERSION = 1
+# The kind of the cached metrics of a log, see flightcache.FlightCache
+CACHE_KIND = "metrics{0}".format(METRICS_VERSION)
+ROLLING_SECONDS = 10
+EARTH_RADIUS = 6371000.0
+METRICS_COLUMNS = [
+    # Ground track distance since the start of the flight
+    "METRICS.distance [m]",
+    # Ground speed along the track of the positions
+    "METRICS.trackSpeed [m/s]",
+    # Direction of travel, NaN where the drone does not move
+    "METRICS.course [deg]",
+    # Heading minus course, from -180 to 180
+    "METRICS.drift [deg]",
+    "METRICS.vSpeed [m/s]",
+    # Mean and standard deviation of the logged horizontal speed, and the
+    # mean vertical speed, over the last ROLLING_SECONDS
+    "METRICS.hSpeedMean [m/s]",
+    "METRICS.hSpeedStd [m/s]",
+    "METRICS.vSpeedMean [m/s]",
+]
+
+
+def flight_metrics(points, window=ROLLING_SECONDS):
+    """
+    Compute the metrics of every row of a flight
+
+    Args:
+        points: A flightdata.Flight sorted by time.
+        window: The seconds of the rolling statistics.
+
+    Returns:
+        metrics: A dataframe with the float32 METRICS_COLUMNS, a row for
+        every row of points.
+    """
+    seconds = _seconds(points.times)
+    latitudes = np.radians(points.latitudes)
+    longitudes = np.radians(points.longitudes)
+
+    steps = np.hypot(np.diff(latitudes),
+                     np.diff(longitudes) * np.cos(latitudes[1:]))
+    distance = np.zeros(len(points))
+    np.cumsum(steps * EARTH_RADIUS, out=distance[1:])
+    del steps
+
+    east = _rate(longitudes, seconds) * np.cos(latitudes) * EARTH_RADIUS
+    north = _rate(latitudes, seconds) * EARTH_RADIUS
+    track_speed = np.hypot(east, north)
+    course = np.degrees(np.arctan2(east, north)) % 360
+    course[track_speed == 0] = np.nan
+    del east, north
+    drift = (points.yaw - course + 180) % 360 - 180
+
+    vertical_speed = _rate(points.height, seconds)
+    speed = points.speed.astype(np.float64)
+    first = np.searchsorted(points.times, points.times
+                            - int(window * 10**9), side="right")
+    speed_mean, speed_std = _rolling(speed, first, std=True)
+    vertical_mean, _ = _rolling(vertical_speed, first)
+
+    columns = [distance, track_speed, course, drift, vertical_speed,
+               speed_mean, speed_std, vertical_mean]
+    return pd.DataFrame({name: values.astype(np.float32)
+                         for name, values in zip(METRICS_COLUMNS, columns)},
+                        copy=False)
+
+
+def metric_chunks(points, chunk_rows, window=ROLLING_SECONDS):
+    """
+    Compute the metrics of a flight a chunk of rows at a time, e.g. of a
+    flight read through memory maps, see outofcore
+
+    Every chunk is computed with the rows of the window before it and the
+    row after it, and its distances continue those of the chunk before.
+
+    Yields:
+        metrics: The metrics of the next chunk_rows rows, see
+        flight_metrics.
+    """
+    distance = 0.0
+    window_ns = int(window * 10**9)
+    for start in range(0, len(points), chunk_rows):
+        end = min(start + chunk_rows, len(points))
+        first = max(int(np.searchsorted(points.times, points.times[start]
+                                        - window_ns, side="right")) - 1, 0)
+        last = min(end + 1, len(points))
+        chunk = points.take(slice(first, last))
+        metrics = flight_metrics(chunk, window).iloc[start - first:
+                                                     end - first]
+        distances = metrics["METRICS.distance [m]"].to_numpy(np.float64)
+        metrics = metrics.assign(**{"METRICS.distance [m]": (
+            distances - distances[0] + distance).astype(np.float32)})
+        # The step to the first row of the next chunk
+        distance += float(distances[-1] - distances[0])
+        if end < len(points):
+            distance += _step_distance(points, end - 1)
+        yield metrics.reset_index(drop=True)
+
+
+def metrics_at(points, metrics, row):
+    """
+    Look up the metrics of a row, with its wind components if points have
+    wind
+
+    Args:
+        points: The flightdata.Flight the metrics were computed for, with
+            or without wind.
+        metrics: The metrics of points, see flight_metrics.
+        row: The row of the point.
+
+    Returns:
+        values: A dict from the METRICS_COLUMNS, and with wind the
+        "METRICS.airspeed [m/s]", "METRICS.headwind [m/s]" and
+        "METRICS.crosswind [m/s]", to floats. The headwind blows against
+        the nose, the crosswind towards the right of the drone.
+    """
+    values = {name: float(metrics[name].iat[row]) for name in METRICS_COLUMNS}
+    if not points.has_wind():
+        return values
+    wind_u = float(points.wind_u[row])
+    wind_v = float(points.wind_v[row])
+    speed = values["METRICS.trackSpeed [m/s]"]
+    course = np.radians(np.nan_to_num(values["METRICS.course [deg]"]))
+    heading = np.radians(float(points.yaw[row]))
+    values["METRICS.airspeed [m/s]"] = float(np.hypot(
+        speed * np.sin(course) - wind_u, speed * np.cos(course) - wind_v))
+    values["METRICS.headwind [m/s]"] = -float(
+        wind_u * np.sin(heading) + wind_v * np.cos(heading))
+    values["METRICS.crosswind [m/s]"] = float(
+        wind_u * np.cos(heading) - wind_v * np.sin(heading))
+    return values
+
+
+def _seconds(times):
+    if len(times) == 0:
+        return np.empty(0)
+    return (times - times[0]) / 1e9
+
+
+def _rate(values, seconds):
+    """
+    The change of values per second at every row, from the rows before and
+    after it, NaN where no time passes
+    """
+    if len(values) < 2:
+        return np.full(len(values), np.nan)
+    values = np.asarray(values, dtype=np.float64)
+    changes = np.empty(len(values))
+    durations = np.empty(len(values))
+    changes[1:-1] = values[2:] - values[:-2]
+    durations[1:-1] = seconds[2:] - seconds[:-2]
+    changes[[0, -1]] = values[[1, -1]] - values[[0, -2]]
+    durations[[0, -1]] = seconds[[1, -1]] - seconds[[0, -2]]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rates = changes / durations
+    rates[durations == 0] = np.nan
+    return rates
+
+
+def _rolling(values, first, std=False):
+    """
+    The mean, and the standard deviation if std, of the known values of
+    the rows first[i]:i + 1 of every row i
+    """
+    known = np.isfinite(values)
+    sums = np.zeros(len(values) + 1)
+    np.cumsum(np.where(known, values, 0), out=sums[1:])
+    counts = np.zeros(len(values) + 1)
+    np.cumsum(known, out=counts[1:])
+    rows = np.arange(1, len(values) + 1)
+    count = counts[rows] - counts[first]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        mean = (sums[rows] - sums[first]) / count
+        if not std:
+            return mean, None
+        np.cumsum(np.where(known, values, 0)**2, out=sums[1:])
+        variance = (sums[rows] - sums[first]) / count - mean**2
+    return mean, np.sqrt(np.maximum(variance, 0))
+
+
+def _step_distance(points, row):
+    """The distance from a row to the next, in meters"""
+    latitudes = np.radians(np.asarray(points.latitudes[row:row + 2],
+                                      dtype=np.float64))
+    longitudes = np.radians(np.asarray(points.longitudes[row:row + 2],
+                                       dtype=np.float64))
+    return float(np.hypot(latitudes[1] - latitudes[0],
+                          (longitudes[1] - longitudes[0])
+                          * np.cos(latitudes[1])) * EARTH_RADIUS)
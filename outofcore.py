@@ -0,0 +1,491 @@
+"""
+Out-of-core flights, for logs larger than memory
+
+A log is ingested once, in a single streaming pass over chunks of
+CHUNK_ROWS rows, into a directory of raw column files. These are then
+memory-mapped: the pages of a time window are read from disk when it is
+drawn, and dropped again by the OS when it needs the memory. The same pass
+computes everything that would otherwise need the whole flight in memory:
+the bounds and time range of the flight, the links between the rows of
+every grid cell used by binning.TimeBins, checkpoints of the latest row of
+every cell, to bin a time window without going through all rows before it,
+and the centers of the cells, to choose the points of long histories.
+
+Memory use is bounded by the chunk size and the number of occupied cells,
+not by the length of the flight. The rows of the log must be in time order.
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.27
+"""
+
+import datetime
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+import pandas as pd
+from align import interpolate, to_ns
+from binning import TimeBins
+from flightcache import DEFAULT_CACHE_DIR
+from flightdata import COLUMNS, Flight, with_wind
+from mapdraw import DRONE_COLUMNS, GRID_SIZE, HOUR_NS, anchor_hour, \
+    parse_times
+from metrics import CACHE_KIND, METRICS_COLUMNS, metric_chunks
+import perf
+
+
+# Rows parsed and written at a time
+CHUNK_ROWS = 1000000
+# Logs of at least this many bytes are loaded out of core by default
+OUT_OF_CORE_BYTES = 1024**3
+# Bump when the layout of the ingested files changes
+FORMAT_VERSION = 1
+SUMMARY_NAME = "summary.json"
+# The attributes of a Flight read from the drone logs
+DRONE_ATTRIBUTES = [(attribute, dtype) for attribute, name, dtype in COLUMNS
+                    if name in DRONE_COLUMNS]
+WIND_ATTRIBUTES = [(attribute, dtype) for attribute, name, dtype in COLUMNS
+                   if attribute.startswith("wind_")]
+# The next link of the latest row of a cell
+NO_ROW = np.iinfo(np.int32).max
+# Keys of absolute grid cells, ix * CELL_STRIDE + iy
+CELL_STRIDE = 2**32
+
+
+def mapped_directory(csv_path, cache_dir=DEFAULT_CACHE_DIR):
+    """Return the directory a log is ingested into, by path, size and time"""
+    stat = os.stat(csv_path)
+    key = "{0}|{1}|{2}".format(os.path.abspath(csv_path), stat.st_size,
+                               stat.st_mtime_ns)
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16)
+    return os.path.join(cache_dir, "mapped", digest.hexdigest())
+
+
+def open_mapped(csv_path, log=None, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Open the ingested files of a log, ingesting it first if needed
+
+    Args:
+        csv_path: The path to the .csv drone flight file.
+        log: The log to parse on a miss, e.g. a loader.ProgressFile of
+            csv_path. csv_path by default.
+        cache_dir: The directory keeping the ingested logs.
+
+    Returns:
+        flight: A MappedFlight.
+    """
+    directory = mapped_directory(csv_path, cache_dir)
+    try:
+        mapped = MappedFlight(directory)
+        if mapped.summary.get("format") == FORMAT_VERSION:
+            return mapped
+    except (OSError, ValueError):
+        pass
+    shutil.rmtree(directory, ignore_errors=True)
+    parent = os.path.dirname(directory)
+    os.makedirs(parent, exist_ok=True)
+    ingesting = tempfile.mkdtemp(prefix="ingest-", dir=parent)
+    try:
+        ingest(csv_path if log is None else log, ingesting)
+        os.replace(ingesting, directory)
+    finally:
+        shutil.rmtree(ingesting, ignore_errors=True)
+    return MappedFlight(directory)
+
+
+def ingest(log, directory, chunk_rows=CHUNK_ROWS, grid_size=GRID_SIZE):
+    """
+    Parse a drone log into a directory of column files, in one pass
+
+    Rows are parsed like mapdraw.parse_drone_csv.
+
+    Args:
+        log: The path to the .csv drone flight file, or a file object of it.
+        directory: An empty directory to write to.
+        chunk_rows: The number of rows parsed at a time.
+        grid_size: The size of the grid squares the rows are binned by.
+
+    Returns:
+        summary: The summary of the flight, see MappedFlight.
+    """
+    writer = _Writer(directory, grid_size, chunk_rows)
+    with perf.span("ingest") as span:
+        chunks = pd.read_csv(log, delimiter=",", encoding="utf-8",
+                             usecols=list(DRONE_COLUMNS), dtype=DRONE_COLUMNS,
+                             chunksize=chunk_rows)
+        with chunks:
+            for chunk in chunks:
+                writer.add(chunk)
+        summary = writer.close()
+        span.set_rows(summary["num_rows"])
+    return summary
+
+
+class _Writer():
+    """The state of an ingest, carried from one chunk to the next"""
+
+    def __init__(self, directory, grid_size, chunk_rows):
+        self.directory = directory
+        self.grid_size = grid_size
+        self.chunk_rows = chunk_rows
+        self.files = {name: open(self.path(name), "wb")
+                      for name in [attribute for attribute, _
+                                   in DRONE_ATTRIBUTES]
+                      + ["cells", "next", "previous", "checkpoints"]}
+        self.num_rows = 0
+        self.dropped = 0
+        # Times are written from the default date until a date is found
+        self.start = to_ns([datetime.datetime(1990, 1, 1)])[0]
+        self.dated = False
+        # The last time row: csv row label, offset, hours and time
+        self.last = None
+        self.bounds = [np.inf, -np.inf, np.inf, -np.inf]
+        # Sorted keys of the known cells and their numbers
+        self.cell_keys = np.empty(0, dtype=np.int64)
+        self.cell_numbers = np.empty(0, dtype=np.int64)
+        self.cell_x = np.empty(0)
+        self.cell_y = np.empty(0)
+        self.last_row = np.empty(0, dtype=np.int32)
+        self.checkpoints = []
+        self.checkpoint_size = 0
+
+    def path(self, name):
+        return os.path.join(self.directory, name + ".bin")
+
+    def add(self, chunk):
+        """Parse and write a chunk of the log"""
+        chunk = chunk[list(DRONE_COLUMNS)]
+        times = parse_times(chunk["CUSTOM.updateTime"])
+        is_time = times.notna().to_numpy()
+        dates = pd.to_datetime(chunk["CUSTOM.updateTime"][~is_time],
+                               errors="coerce", format="%d/%m/%Y %H:%M")
+        dates = dates.dropna()
+        chunk = chunk.assign(**{"CUSTOM.updateTime": times}).dropna()
+        self.dropped += int((~is_time).sum()) - len(dates) \
+            + int(is_time.sum()) - len(chunk)
+        if len(chunk) == 0 and len(dates) == 0:
+            return
+
+        offsets = (chunk["CUSTOM.updateTime"].to_numpy()
+                   .astype("datetime64[ns]")
+                   - np.datetime64("1900-01-01", "ns")).astype(np.int64)
+        labels = chunk.index.to_numpy()
+        hours = np.cumsum(np.diff(offsets, prepend=offsets[:1]
+                                  if self.last is None else self.last[1])
+                          < -HOUR_NS // 2) \
+            + (0 if self.last is None else self.last[2])
+        if not self.dated and len(dates):
+            self.date(dates, labels, offsets, hours)
+        if len(chunk) == 0:
+            return
+
+        times = self.start + offsets + hours * HOUR_NS
+        first = times[0] if self.last is None else self.last[3]
+        if np.any(np.diff(times, prepend=first) < 0):
+            raise ValueError("Rows out of time order, the log cannot be "
+                             "loaded out of core")
+        if self.num_rows + len(times) >= NO_ROW:
+            raise ValueError("Too many rows to load out of core")
+        self.last = (labels[-1], offsets[-1], hours[-1], times[-1])
+
+        columns = dict(Flight.from_frame(chunk).columns(), times=times)
+        for attribute, dtype in DRONE_ATTRIBUTES:
+            self.files[attribute].write(
+                np.ascontiguousarray(columns[attribute], dtype=dtype)
+                .tobytes())
+        x, y = columns["longitudes"], columns["latitudes"]
+        self.bounds = [min(self.bounds[0], x.min()),
+                       max(self.bounds[1], x.max()),
+                       min(self.bounds[2], y.min()),
+                       max(self.bounds[3], y.max())]
+        self.link(x, y)
+        self.num_rows += len(times)
+        if self.num_rows - self.checkpoint_size \
+                >= max(len(self.last_row), self.chunk_rows):
+            self.checkpoint()
+
+    def date(self, dates, labels, offsets, hours):
+        """Anchor the times at the first date, fixing the written times"""
+        if self.last is not None:
+            labels = np.append(self.last[0], labels)
+            offsets = np.append(self.last[1], offsets)
+            hours = np.append(self.last[2], hours)
+        date = dates.iloc[0]
+        hour = anchor_hour(date, dates.index[0], labels, offsets, hours)
+        start = (np.datetime64(date.replace(hour=0, minute=0), "ns")
+                 + np.timedelta64(hour, "h")).astype(np.int64)
+        shift = start - self.start
+        self.start = start
+        self.dated = True
+        if self.num_rows and shift:
+            self.files["times"].flush()
+            times = np.memmap(self.path("times"), dtype=np.int64, mode="r+",
+                              shape=(self.num_rows,))
+            for row in range(0, self.num_rows, self.chunk_rows):
+                times[row:row + self.chunk_rows] += shift
+            times.flush()
+            del times
+            self.last = self.last[:3] + (self.last[3] + shift,)
+
+    def link(self, x, y):
+        """Write the cells of a chunk and the links between their rows"""
+        ix = np.floor(x / self.grid_size).astype(np.int64)
+        iy = np.floor(y / self.grid_size).astype(np.int64)
+        keys, inverse = np.unique(ix * CELL_STRIDE + iy, return_inverse=True)
+        del ix, iy
+        found = np.searchsorted(self.cell_keys, keys)
+        known = found < len(self.cell_keys)
+        known[known] = self.cell_keys[found[known]] == keys[known]
+        numbers = np.empty(len(keys), dtype=np.int64)
+        numbers[known] = self.cell_numbers[found[known]]
+        new = np.flatnonzero(~known)
+        numbers[new] = len(self.last_row) + np.arange(len(new))
+        self.cell_keys = np.insert(self.cell_keys, found[new], keys[new])
+        self.cell_numbers = np.insert(self.cell_numbers, found[new],
+                                      numbers[new])
+        new_x = (keys[new] + CELL_STRIDE // 2) // CELL_STRIDE
+        new_y = keys[new] - new_x * CELL_STRIDE
+        self.cell_x = np.append(self.cell_x, (new_x + 0.5) * self.grid_size)
+        self.cell_y = np.append(self.cell_y, (new_y + 0.5) * self.grid_size)
+        self.last_row = np.append(self.last_row,
+                                  np.full(len(new), -1, dtype=np.int32))
+
+        cells = numbers[inverse].astype(np.int32)
+        rows = self.num_rows + np.arange(len(cells), dtype=np.int32)
+        order = np.argsort(cells, kind="stable")
+        same = cells[order[1:]] == cells[order[:-1]]
+        next_rows = np.full(len(cells), NO_ROW, dtype=np.int32)
+        next_rows[order[:-1][same]] = rows[order[1:][same]]
+        previous = np.full(len(cells), -1, dtype=np.int32)
+        previous[order[1:][same]] = rows[order[:-1][same]]
+        firsts = order[np.append(True, ~same)]
+        lasts = order[np.append(~same, True)]
+        earlier = self.last_row[cells[firsts]]
+        previous[firsts] = earlier
+        self.last_row[cells[lasts]] = rows[lasts]
+
+        # Link the earlier rows of the cells to this chunk
+        linked = earlier >= 0
+        if np.any(linked) and self.num_rows:
+            self.files["next"].flush()
+            written = np.memmap(self.path("next"), dtype=np.int32,
+                                mode="r+", shape=(self.num_rows,))
+            written[earlier[linked]] = rows[firsts][linked]
+            written.flush()
+            del written
+        self.files["cells"].write(cells.tobytes())
+        self.files["next"].write(next_rows.tobytes())
+        self.files["previous"].write(previous.tobytes())
+
+    def checkpoint(self):
+        """Store the latest row of every cell before the next row"""
+        self.checkpoints.append((self.num_rows, self.checkpoint_size,
+                                 len(self.last_row)))
+        self.checkpoint_size += len(self.last_row)
+        self.files["checkpoints"].write(self.last_row.tobytes())
+
+    def close(self):
+        """Close the files and write the summary"""
+        for file in self.files.values():
+            file.close()
+        if not self.dated:
+            print("No date found - default time applied: 01/01/1990 00:00 ")
+        np.save(os.path.join(self.directory, "cell_x.npy"), self.cell_x)
+        np.save(os.path.join(self.directory, "cell_y.npy"), self.cell_y)
+        times = None
+        if self.num_rows:
+            mapped = np.memmap(self.path("times"), dtype=np.int64, mode="r",
+                               shape=(self.num_rows,))
+            times = (int(mapped[0]), int(mapped[-1]))
+            del mapped
+        west, east, south, north = self.bounds
+        summary = {
+            "format": FORMAT_VERSION,
+            "num_rows": self.num_rows,
+            "dropped_rows": self.dropped,
+            "grid_size": self.grid_size,
+            "num_cells": len(self.last_row),
+            "bounds": None if not self.num_rows
+            else [float(north), float(south), float(east), float(west)],
+            "times": times,
+            "checkpoints": self.checkpoints,
+        }
+        with open(os.path.join(self.directory, SUMMARY_NAME), "w") as out:
+            json.dump(summary, out)
+        return summary
+
+
+class MappedFlight():
+    """
+    An ingested flight, see ingest, read through memory maps
+
+    Args:
+        directory: The directory the flight was ingested into.
+
+    Attributes:
+        summary: A dict with the "num_rows", "dropped_rows", "grid_size",
+            "num_cells", the (north, south, east, west) "bounds" and the
+            first and last "times" of the flight, None when it is empty,
+            and the (row, offset, cells) of the bin "checkpoints".
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, SUMMARY_NAME)) as summary:
+            self.summary = json.load(summary)
+
+    def __len__(self):
+        return self.summary["num_rows"]
+
+    def column(self, name, dtype, length=None, directory=None):
+        """Memory-map a column file, read only"""
+        length = len(self) if length is None else length
+        if length == 0:
+            return np.empty(0, dtype=dtype)
+        path = os.path.join(directory or self.directory, name + ".bin")
+        return np.memmap(path, dtype=dtype, mode="r", shape=(length,))
+
+    def flight(self):
+        """Return the flight, a Flight of memory-mapped columns"""
+        return Flight(**{attribute: self.column(attribute, dtype)
+                         for attribute, dtype in DRONE_ATTRIBUTES})
+
+    def frame(self):
+        """Return the flight as a dataframe, see read_drone_csv"""
+        return self.flight().to_frame()
+
+    def bbox(self, padx=0.001, pady=0.001):
+        """Return the padded bbox of the flight, see mapdraw.flight_bbox"""
+        north, south, east, west = self.summary["bounds"]
+        return north + pady, south - pady, east + padx, west - padx
+
+    def bins(self):
+        """Return the time bins of the flight, see MappedBins"""
+        return MappedBins(self)
+
+    def metrics(self, chunk_rows=CHUNK_ROWS):
+        """
+        Return the metrics of the flight, see metrics.flight_metrics, as a
+        dataframe of memory-mapped columns
+
+        The metrics are computed a chunk at a time the first time, and
+        stored with the columns of the flight.
+        """
+        directory = os.path.join(self.directory, CACHE_KIND)
+        if not os.path.isdir(directory):
+            computing = tempfile.mkdtemp(prefix="metrics-",
+                                         dir=self.directory)
+            try:
+                files = [open(os.path.join(computing, "{0}.bin".format(i)),
+                              "wb") for i in range(len(METRICS_COLUMNS))]
+                with perf.span("metrics mapped", len(self)):
+                    for chunk in metric_chunks(self.flight(), chunk_rows):
+                        for file, name in zip(files, METRICS_COLUMNS):
+                            file.write(chunk[name].to_numpy().tobytes())
+                for file in files:
+                    file.close()
+                os.replace(computing, directory)
+            finally:
+                shutil.rmtree(computing, ignore_errors=True)
+        return pd.DataFrame({
+            name: self.column(str(i), np.float32, directory=directory)
+            for i, name in enumerate(METRICS_COLUMNS)}, copy=False)
+
+    def join_wind(self, wind_data, tolerance=0.05, method="linear",
+                  chunk_rows=CHUNK_ROWS):
+        """
+        Estimate the wind at every row, like flightdata.join_wind, a chunk
+        of rows at a time
+
+        The wind columns are written to a new directory of column files,
+        the columns of an earlier join may still be shown.
+
+        Args:
+            wind_data: The wind data, with datetimes.
+            tolerance, method: See align.align_wind
+
+        Returns:
+            points: The flight, with memory-mapped wind columns.
+        """
+        for name in os.listdir(self.directory):
+            if name.startswith("wind-"):
+                shutil.rmtree(os.path.join(self.directory, name),
+                              ignore_errors=True)
+        directory = tempfile.mkdtemp(prefix="wind-", dir=self.directory)
+        order = np.argsort(to_ns(wind_data["INCREMENTED.time"]),
+                           kind="mergesort")
+        wind_times = to_ns(wind_data["INCREMENTED.time"])[order]
+        wind_speed = wind_data["RANDOM.windSpeed"].to_numpy()[order]
+        wind_direction = wind_data["RANDOM.direction"].to_numpy()[order]
+        tolerance_ns = int(tolerance * 10**9)
+
+        points = self.flight()
+        files = {attribute: open(os.path.join(directory, attribute + ".bin"),
+                                 "wb")
+                 for attribute, _ in WIND_ATTRIBUTES}
+        with perf.span("join_wind mapped", len(self)):
+            for row in range(0, len(self), chunk_rows):
+                times = np.asarray(points.times[row:row + chunk_rows])
+                # The wind samples around the chunk, the same as those
+                # around each of its rows
+                first = max(np.searchsorted(wind_times, times[0]) - 1, 0)
+                last = np.searchsorted(wind_times, times[-1], side="right") \
+                    + 1
+                window = slice(first, last)
+                speed = interpolate(times, wind_times[window],
+                                    wind_speed[window], tolerance_ns, method)
+                direction = interpolate(
+                    times, wind_times[window], wind_direction[window],
+                    tolerance_ns, method, circular=True)
+                wind = with_wind(Flight(), speed, direction)
+                for attribute, dtype in WIND_ATTRIBUTES:
+                    files[attribute].write(
+                        getattr(wind, attribute).astype(dtype).tobytes())
+        for file in files.values():
+            file.close()
+        return points.replace(**{
+            attribute: self.column(attribute, dtype, directory=directory)
+            for attribute, dtype in WIND_ATTRIBUTES})
+
+
+class MappedBins(TimeBins):
+    """
+    The TimeBins of an ingested flight, read through memory maps
+
+    A window far from the last one is binned from the checkpoint before
+    its end, going through at most the rows between two checkpoints.
+
+    Args:
+        mapped: The MappedFlight.
+    """
+
+    def __init__(self, mapped):
+        summary = mapped.summary
+        self.window = (0, 0)
+        self.num_cells = summary["num_cells"]
+        self.cells = mapped.column("cells", np.int32)
+        self.next = mapped.column("next", np.int32)
+        self.previous = mapped.column("previous", np.int32)
+        self.cell_x = np.load(os.path.join(mapped.directory, "cell_x.npy"))
+        self.cell_y = np.load(os.path.join(mapped.directory, "cell_y.npy"))
+        self.cell_latest = np.full(self.num_cells, -1, dtype=np.int64)
+        self.checkpoints = summary["checkpoints"]
+        self.checkpoint_rows = [row for row, _, _ in self.checkpoints]
+        self.latest_rows = mapped.column(
+            "checkpoints", np.int32,
+            sum(cells for _, _, cells in self.checkpoints))
+
+    def _bin_cells(self, start, end):
+        """Bin a window from the latest rows at the checkpoint before it"""
+        checkpoint = np.searchsorted(self.checkpoint_rows, end,
+                                     side="right") - 1
+        first = 0
+        if checkpoint >= 0:
+            first, offset, cells = self.checkpoints[checkpoint]
+            self.cell_latest[:cells] = self.latest_rows[offset:offset + cells]
+        rows = np.arange(first, end)
+        latest = rows[self.next[first:end] >= end]
+        self.cell_latest[self.cells[latest]] = latest
+        self.cell_latest[self.cell_latest < start] = -1
@@ -0,0 +1,174 @@
+"""
+Parallel parsing of large drone logs
+
+pd.read_csv parses a log on one core. parse_drone_csv_parallel splits the
+log, after its header, into byte ranges of whole lines, which worker
+processes parse into typed columns and time offsets at the same time. Only
+the steps that need the whole flight run in the calling process: the hour
+of every row, counted from the first row, and the date. The columns of the
+ranges are copied once, into the columns of the result.
+
+A range reports the rows it kept and dropped, so broken parts of a log can
+be found. Fields are assumed not to hold line breaks, as in the DJI logs.
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.28
+"""
+
+import io
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from mapdraw import DRONE_COLUMNS, anchor_times, parse_times, split_rows
+
+
+# Bytes of the log parsed by a worker at a time
+CHUNK_BYTES = 32 * 1024 * 1024
+# Smaller logs are parsed faster without starting worker processes
+PARALLEL_MIN_BYTES = 2 * CHUNK_BYTES
+TIME_COLUMN = "CUSTOM.updateTime"
+
+
+def line_ranges(csv_path, chunk_bytes=CHUNK_BYTES):
+    """
+    Split a log into byte ranges of about chunk_bytes, at line breaks
+
+    Returns:
+        (header, ranges): The header line, and the (start, end) byte
+        offsets of every range after it.
+    """
+    with open(csv_path, "rb") as log:
+        header = log.readline()
+        size = os.fstat(log.fileno()).st_size
+        ranges = []
+        start = log.tell()
+        while start < size:
+            end = start + chunk_bytes
+            if end < size:
+                log.seek(end)
+                log.readline()
+                end = log.tell()
+            end = min(end, size)
+            ranges.append((start, end))
+            start = end
+    return header, ranges
+
+
+def parse_range(csv_path, start, end, header):
+    """
+    Parse the lines in a byte range of a log, run by a worker process
+
+    Args:
+        csv_path: The path to the .csv drone flight file.
+        start, end: The byte range, see line_ranges.
+        header: The header line of the log, parsed before the range so
+            that short rows are read like by parse_drone_csv.
+
+    Returns:
+        parsed: A dict with the "columns" of the time rows kept, their
+        time "offsets" and row labels "rows" within the range, see
+        mapdraw.split_rows, the first of the "dates" and the "report" of
+        the range, see parse_drone_csv_parallel.
+    """
+    text = bytearray(header)
+    with open(csv_path, "rb") as log:
+        log.seek(start)
+        text += log.read(end - start)
+    data = pd.read_csv(io.BytesIO(text), delimiter=",", encoding="utf-8",
+                       usecols=list(DRONE_COLUMNS), dtype=DRONE_COLUMNS)
+    del text
+    lines = len(data)
+    fields = data[TIME_COLUMN]
+    data, offsets, dates = split_rows(data[list(DRONE_COLUMNS)])
+    rows = data.index.to_numpy()
+
+    # Rows neither kept nor dates have missing values, or no time at all.
+    # The rows are labelled 0, 1, ... by read_csv.
+    dropped = np.ones(lines, dtype=bool)
+    dropped[rows] = False
+    dropped[dates.index.to_numpy()] = False
+    dropped = np.flatnonzero(dropped)
+    non_conforming = int(parse_times(fields.iloc[dropped]).isna().sum())
+    report = {"start": start, "end": end, "lines": lines,
+              "rows": len(rows), "dates": len(dates),
+              "incomplete": len(dropped) - non_conforming,
+              "non_conforming": non_conforming}
+    return {"columns": {name: data[name].to_numpy() for name in DRONE_COLUMNS
+                        if name != TIME_COLUMN},
+            "offsets": offsets, "rows": rows, "dates": dates.iloc[:1],
+            "report": report}
+
+
+def parse_drone_csv_parallel(csv_path, workers=None, chunk_bytes=CHUNK_BYTES,
+                             progress=None):
+    """
+    Parse a drone log like mapdraw.parse_drone_csv, with worker processes
+
+    Args:
+        csv_path: The path to the .csv drone flight file.
+        workers: The number of worker processes, one per core by default.
+            With one, the ranges are parsed in this process.
+        chunk_bytes: The size of the byte ranges parsed by the workers.
+        progress: Called with the part of the ranges parsed, from 0 to 1,
+            whenever a range has been parsed. An exception raised by it,
+            e.g. loader.Cancelled, stops the parsing.
+
+    Returns:
+        (data, report): The parsed log, equal to that of parse_drone_csv,
+        and a dataframe with a row for every byte range: its "start" and
+        "end" byte, the number of "lines" in it, the time "rows" kept, the
+        "dates" found, the "incomplete" rows dropped for missing values and
+        the "non_conforming" rows holding neither a time nor a date.
+    """
+    header, ranges = line_ranges(csv_path, chunk_bytes)
+    workers = workers or os.cpu_count() or 1
+    results = [None] * len(ranges)
+    if workers == 1 or len(ranges) <= 1:
+        for i, (start, end) in enumerate(ranges):
+            results[i] = parse_range(csv_path, start, end, header)
+            if progress is not None:
+                progress((i + 1) / len(ranges))
+    else:
+        with ProcessPoolExecutor(min(workers, len(ranges))) as pool:
+            futures = {pool.submit(parse_range, csv_path, start, end,
+                                   header): i
+                       for i, (start, end) in enumerate(ranges)}
+            try:
+                for done, future in enumerate(as_completed(futures), 1):
+                    results[futures[future]] = future.result()
+                    if progress is not None:
+                        progress(done / len(ranges))
+            except BaseException:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    # The row labels of each range, counted from the first data line
+    firsts = np.cumsum([0] + [result["report"]["lines"]
+                              for result in results])
+    rows = _concatenate([result.pop("rows") + first
+                         for result, first in zip(results, firsts)],
+                        np.int64)
+    offsets = _concatenate([result.pop("offsets") for result in results],
+                           np.int64)
+    dates = next((result["dates"].set_axis(result["dates"].index + first)
+                  for result, first in zip(results, firsts)
+                  if len(result["dates"])), pd.Series([], dtype=object))
+    columns = {TIME_COLUMN: anchor_times(offsets, rows, dates)}
+    del offsets
+    for name, dtype in DRONE_COLUMNS.items():
+        if name != TIME_COLUMN:
+            columns[name] = _concatenate(
+                [result["columns"].pop(name) for result in results], dtype)
+    data = pd.DataFrame(columns, index=pd.Index(rows), copy=False)
+    report = pd.DataFrame([result["report"] for result in results],
+                          columns=["start", "end", "lines", "rows", "dates",
+                                   "incomplete", "non_conforming"])
+    return data, report
+
+
+def _concatenate(arrays, dtype):
+    if not arrays:
+        return np.empty(0, dtype=dtype)
+    return np.concatenate(arrays)
@@ -0,0 +1,248 @@
+"""
+Instrumentation of the hot paths
+
+The stages of loading and drawing a flight are wrapped in spans, which
+record their wall time, the number of memory blocks allocated while they
+ran and the number of rows they handled. Tracing is off by default, a span
+then costs well under a microsecond. When enabled, counting the allocated
+blocks makes a span cost some tens of microseconds. The GUI shows the
+recorded spans in its performance panel, and any run, e.g. a benchmark,
+can export them as a Chrome trace, to be opened in chrome://tracing or
+https://ui.perfetto.dev.
+
+Usage:
+    perf.enable()
+    with perf.span("grid_bin_data") as span:
+        ...
+        span.set_rows(len(data))
+    perf.export("trace.json")
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.23
+"""
+
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+
+# The start of the program, for the startup marks
+STARTED = time.perf_counter()
+# Number of spans kept for export, the oldest are dropped first
+MAX_EVENTS = 1000000
+# Number of recent spans of each stage summarized by Tracer.summary
+RECENT_SPANS = 100
+
+
+class Span():
+    """
+    A running stage, see Tracer.span
+
+    Attributes:
+        name: The name of the stage.
+        rows: The number of rows handled, or None if not set.
+    """
+
+    __slots__ = ("tracer", "name", "rows", "start", "blocks")
+
+    def __init__(self, tracer, name, rows=None):
+        self.tracer = tracer
+        self.name = name
+        self.rows = rows
+
+    def set_rows(self, rows):
+        self.rows = int(rows)
+
+    def __enter__(self):
+        self.blocks = sys.getallocatedblocks()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter_ns()
+        self.tracer.record(self.name, self.start, end - self.start,
+                           sys.getallocatedblocks() - self.blocks, self.rows)
+
+
+class _NullSpan():
+    """The span of a disabled tracer, recording nothing"""
+
+    __slots__ = ()
+
+    def set_rows(self, rows):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Tracer():
+    """
+    Records spans of named stages, from any thread
+
+    Args:
+        max_events: The number of spans kept for export.
+        recent: The number of recent spans of each stage kept for summary.
+    """
+
+    def __init__(self, max_events=MAX_EVENTS, recent=RECENT_SPANS):
+        self.enabled = False
+        self.events = collections.deque(maxlen=max_events)
+        self.recent = {}
+        self.recent_size = recent
+        self.lock = threading.Lock()
+
+    def span(self, name, rows=None):
+        """
+        Return a context manager timing a stage, which does nothing when
+        the tracer is disabled
+
+        Args:
+            name: The name of the stage.
+            rows: The number of rows handled, can also be set later with
+                set_rows.
+        """
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, rows)
+
+    def record(self, name, start, duration, allocations=0, rows=None):
+        """
+        Record a finished span
+
+        Args:
+            name: The name of the stage.
+            start, duration: perf_counter_ns at the start, and nanoseconds.
+            allocations: Memory blocks allocated, minus those freed.
+            rows: The number of rows handled, or None.
+        """
+        event = (name, start, duration, allocations, rows,
+                 threading.get_ident())
+        with self.lock:
+            self.events.append(event)
+            recent = self.recent.get(name)
+            if recent is None:
+                recent = self.recent[name] = collections.deque(
+                    maxlen=self.recent_size)
+            recent.append(event)
+
+    def clear(self):
+        with self.lock:
+            self.events.clear()
+            self.recent.clear()
+
+    def summary(self):
+        """
+        Summarize the recent spans of every stage
+
+        Returns:
+            summary: A dict from stage name to a dict with the "count" of
+            recent spans, the "last_ms" and "mean_ms" duration, the mean
+            "allocations" and the "rows" of the last span, slowest stage
+            first.
+        """
+        with self.lock:
+            recent = {name: list(events)
+                      for name, events in self.recent.items()}
+        summary = {}
+        for name, events in recent.items():
+            durations = [event[2] for event in events]
+            summary[name] = {
+                "count": len(events),
+                "last_ms": durations[-1] / 1e6,
+                "mean_ms": sum(durations) / len(durations) / 1e6,
+                "allocations": sum(event[3] for event in events)
+                / len(events),
+                "rows": events[-1][4],
+            }
+        return dict(sorted(summary.items(),
+                           key=lambda item: -item[1]["mean_ms"]))
+
+    def export(self, path):
+        """
+        Write the recorded spans as a Chrome trace
+
+        Every span is a complete ("X") event, in microseconds, with the
+        allocations and rows as arguments.
+        """
+        with self.lock:
+            events = list(self.events)
+        pid = os.getpid()
+        trace = []
+        for name, start, duration, allocations, rows, thread in events:
+            args = {"allocations": allocations}
+            if rows is not None:
+                args["rows"] = rows
+            trace.append({"name": name, "cat": "dronemap", "ph": "X",
+                          "ts": start / 1000, "dur": duration / 1000,
+                          "pid": pid, "tid": thread, "args": args})
+        with open(path, "w") as out:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, out)
+
+
+# The tracer of the hot paths
+TRACER = Tracer()
+# (stage, seconds since STARTED) of the startup, see mark
+MARKS = []
+
+
+def span(name, rows=None):
+    """Time a stage with the default tracer, see Tracer.span"""
+    if not TRACER.enabled:
+        return NULL_SPAN
+    return Span(TRACER, name, rows)
+
+
+def enable():
+    TRACER.enabled = True
+
+
+def disable():
+    TRACER.enabled = False
+
+
+def enabled():
+    return TRACER.enabled
+
+
+def summary():
+    return TRACER.summary()
+
+
+def export(path):
+    TRACER.export(path)
+
+
+def mark(stage):
+    """
+    Record that a stage of the startup has been reached, always, whether
+    tracing is enabled or not
+
+    Only the first time a stage is reached is recorded.
+    """
+    if stage not in dict(MARKS):
+        MARKS.append((stage, time.perf_counter() - STARTED))
+
+
+def startup_report():
+    """
+    Return the stages of the startup, one per line, with the seconds since
+    the program started, i.e. since perf was first imported, and since the
+    stage before
+    """
+    lines = []
+    last = 0
+    for stage, seconds in MARKS:
+        lines.append("{0:<24}{1:>8.0f} ms{2:>+9.0f} ms".format(
+            stage, seconds * 1000, (seconds - last) * 1000))
+        last = seconds
+    return "\n".join(lines)
@@ -0,0 +1,153 @@
+"""
+Real time playback of a flight timeline
+
+A Playback keeps the position on the timeline of the shown flight, in
+nanoseconds like the times of DroneMap. While playing, the position follows
+the wall clock times the speed, so a frame that takes too long makes the
+next frames skip ahead instead of falling behind. Frames are due on a fixed
+grid of frame_interval seconds; the due frames that pass while a frame is
+drawn are dropped. Playback does not draw anything itself, see
+guimain.MapFrame.play_frame.
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.24
+"""
+
+import bisect
+import time
+
+
+SPEEDS = [0.5, 1, 2, 4, 8, 16, 32, 64]
+# Seconds between frames while playing
+FRAME_INTERVAL = 1 / 30
+
+
+class Playback():
+    """
+    The playback position on a timeline
+
+    Args:
+        start, end: The first and last time of the timeline, in ns.
+        speed: Seconds of flight per second of wall time.
+        frame_interval: Seconds between frames while playing.
+        clock: Returns the wall time in seconds.
+
+    Attributes:
+        playing: Whether the position follows the wall clock.
+        frames: The number of frames drawn while playing.
+        dropped: The number of due frames skipped because drawing fell
+            behind.
+    """
+
+    def __init__(self, start=0, end=0, speed=1,
+                 frame_interval=FRAME_INTERVAL, clock=time.perf_counter):
+        self.start = start
+        self.end = end
+        self.speed = speed
+        self.frame_interval = frame_interval
+        self.clock = clock
+        self.playing = False
+        self.frames = 0
+        self.dropped = 0
+        # The position at anchor_clock, the position while playing is
+        # found from the wall time since then
+        self.anchor_position = start
+        self.anchor_clock = clock()
+        self.last_frame = None
+
+    def set_timeline(self, start, end):
+        """Change the timeline, e.g. when rows arrive, keeping the position"""
+        if (start, end) == (self.start, self.end):
+            return
+        position = self.position()
+        self.start = start
+        self.end = end
+        self._anchor(position)
+
+    def position(self, now=None):
+        """Return the current position, in ns"""
+        if not self.playing:
+            return self.anchor_position
+        if now is None:
+            now = self.clock()
+        position = self.anchor_position \
+            + int((now - self.anchor_clock) * self.speed * 10**9)
+        return min(position, self.end)
+
+    def play(self):
+        """Play from the current position, or from the start if at the end"""
+        position = self.position()
+        if position >= self.end:
+            position = self.start
+        self.playing = True
+        self._anchor(position)
+
+    def pause(self):
+        self._anchor(self.position())
+        self.playing = False
+
+    def toggle(self):
+        """Play if paused, pause if playing"""
+        if self.playing:
+            self.pause()
+        else:
+            self.play()
+
+    def set_speed(self, speed):
+        self._anchor(self.position())
+        self.speed = speed
+
+    def seek(self, position):
+        """Move to a position, playing on from there if playing"""
+        self._anchor(position)
+
+    def step(self, count, sample_times):
+        """
+        Pause, and move count samples forward or backward
+
+        Args:
+            count: The number of samples to move, negative to move back.
+            sample_times: The sorted times of the samples of the flight,
+                in ns.
+        """
+        self.pause()
+        if len(sample_times) == 0:
+            return
+        position = self.position()
+        # The sample at or before the position, -1 if there is none. Moving
+        # back from between two samples first moves to the one before.
+        index = bisect.bisect_right(sample_times, position) - 1
+        if count < 0 and index >= 0 and sample_times[index] < position:
+            index += 1
+        index = min(max(index + count, 0), len(sample_times) - 1)
+        self._anchor(int(sample_times[index]))
+
+    def tick(self):
+        """
+        Start a frame
+
+        Returns:
+            (position, delay): The position to draw, and the seconds until
+            the next frame is due, or None when the end has been reached
+            and playback stopped.
+        """
+        now = self.clock()
+        position = self.position(now)
+        # Rounded, timers may fire a little early
+        frame = int((now - self.anchor_clock) / self.frame_interval + 0.5)
+        if self.last_frame is not None:
+            self.dropped += max(frame - self.last_frame - 1, 0)
+        self.last_frame = frame
+        self.frames += 1
+        if position >= self.end:
+            self.pause()
+            return position, None
+        delay = self.anchor_clock + (frame + 1) * self.frame_interval \
+            - self.clock()
+        return position, max(delay, 0)
+
+    def _anchor(self, position):
+        self.anchor_position = int(min(max(position, self.start), self.end))
+        self.anchor_clock = self.clock()
+        # Frames are counted from the anchor
+        self.last_frame = None
@@ -0,0 +1,72 @@
+"""
+Coalescing of render requests
+
+Tk calls the command of a Scale for every value it passes while being
+dragged, far more often than the screen is refreshed. A RenderScheduler
+turns bursts of such events into at most one render per display frame:
+the first request of a burst schedules a render for the start of the next
+frame, and the requests arriving before it runs are merged into it. The
+render reads the latest state, so no event is lost.
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.25
+"""
+
+import time
+
+
+# Seconds between refreshes of a 60 Hz display
+DISPLAY_FRAME = 1 / 60
+
+
+class RenderScheduler():
+    """
+    Runs a render at most once per frame, however often it is requested
+
+    Args:
+        widget: A Tk widget, whose after and after_cancel schedule the
+            renders.
+        render: Called with no arguments to render the latest state.
+        frame_interval: Minimum number of seconds between renders.
+        clock: Returns the wall time in seconds.
+
+    Attributes:
+        requests: The number of requests.
+        renders: The number of renders run.
+    """
+
+    def __init__(self, widget, render, frame_interval=DISPLAY_FRAME,
+                 clock=time.perf_counter):
+        self.widget = widget
+        self.render = render
+        self.frame_interval = frame_interval
+        self.clock = clock
+        self.pending = None
+        self.last_render = None
+        self.requests = 0
+        self.renders = 0
+
+    def request(self):
+        """Render soon, together with the other requests of this frame"""
+        self.requests += 1
+        if self.pending is not None:
+            return
+        delay = 0
+        if self.last_render is not None:
+            delay = max(self.last_render + self.frame_interval
+                        - self.clock(), 0)
+        # Also delayed when due now, so that the events already queued
+        # are merged into this render
+        self.pending = self.widget.after(int(delay * 1000), self._run)
+
+    def cancel(self):
+        """Drop the pending render, if any"""
+        if self.pending is not None:
+            self.widget.after_cancel(self.pending)
+            self.pending = None
+
+    def _run(self):
+        self.pending = None
+        self.last_render = self.clock()
+        self.renders += 1
+        self.render()
@@ -0,0 +1,388 @@
+"""
+Sessions of many drone flights shown on one map
+
+The flights of a session are kept in one columnar store, each column an
+array shared by all flights, and a flight is a range of rows of it. Adding
+a flight costs about the size of its columns, plus the binning.TimeBins of
+its rows. The map of a session covers the union of the flights, and the
+flights are shown on a common time axis, either in absolute time or with
+their starts aligned. Every flight shows the latest of its points in each
+grid square within the time span shown, like a single flight does. The
+metrics of every flight are computed once, when it is added, and stored
+as columns like the others.
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.21
+"""
+
+import numpy as np
+import pandas as pd
+from align import to_ns, wind_at
+from basemap import union
+from binning import TimeBins, screen_bins
+from flightdata import COLUMNS as FLIGHT_COLUMNS, Flight, with_wind
+from mapdraw import DRONE_COLUMNS, GRID_SIZE, flight_bbox
+from metrics import METRICS_COLUMNS, flight_metrics
+
+
+# Stored columns and their types, the wind columns are added when wind is
+# joined
+SESSION_COLUMNS = dict(DRONE_COLUMNS,
+                       **{"CUSTOM.updateTime": "datetime64[ns]"})
+STORED_COLUMNS = dict(SESSION_COLUMNS,
+                      **{name: np.float32 for name in METRICS_COLUMNS})
+WIND_COLUMNS = ["RANDOM.windSpeed", "RANDOM.direction"]
+# Grow the store by this factor when it is full
+GROWTH = 1.5
+
+
+def flight_bins(drone_data, grid_size=GRID_SIZE):
+    """
+    Prepare a flight to be added to a session, see mapdraw.bin_flight
+
+    Returns:
+        (drone_data, bins): The flight sorted by time, itself if it already
+        is, and the binning.TimeBins of its rows.
+    """
+    if not drone_data["CUSTOM.updateTime"].is_monotonic_increasing:
+        drone_data = drone_data.sort_values("CUSTOM.updateTime",
+                                            kind="mergesort")
+    return drone_data, TimeBins(drone_data["OSD.longitude"].to_numpy(),
+                                drone_data["OSD.latitude"].to_numpy(),
+                                grid_size)
+
+
+class FlightStore():
+    """
+    Columns of many flights, stored one flight after another
+
+    Flight i is the rows offsets[i]:offsets[i + 1] of every column. The
+    arrays are grown by GROWTH when full, or to the exact size needed when
+    reserve is called before adding flights.
+
+    Args:
+        dtypes: The type of each column.
+    """
+
+    def __init__(self, dtypes):
+        self.arrays = {name: np.empty(0, dtype=dtype)
+                       for name, dtype in dtypes.items()}
+        self.offsets = [0]
+
+    def __len__(self):
+        return self.offsets[-1]
+
+    def capacity(self):
+        return len(next(iter(self.arrays.values())))
+
+    def add_column(self, name, dtype):
+        """Add a column, NaN for the stored flights"""
+        array = np.empty(self.capacity(), dtype=dtype)
+        array[:] = np.nan
+        self.arrays[name] = array
+
+    def reserve(self, num_rows):
+        """Make room for num_rows more rows"""
+        needed = len(self) + num_rows
+        if needed <= self.capacity():
+            return
+        for name, array in self.arrays.items():
+            grown = np.empty(needed, dtype=array.dtype)
+            grown[:len(self)] = array[:len(self)]
+            self.arrays[name] = grown
+
+    def append(self, data):
+        """
+        Copy a flight into the store
+
+        Args:
+            data: A dataframe with some of the columns of the store, the
+                others are filled with NaN (NaT for times).
+
+        Returns:
+            flight: The number of the flight.
+        """
+        start = len(self)
+        end = start + len(data)
+        if end > self.capacity():
+            self.reserve(max(len(data),
+                             int(self.capacity() * GROWTH) - start))
+        for name, array in self.arrays.items():
+            if name in data.columns:
+                array[start:end] = data[name].to_numpy()
+            else:
+                array[start:end] = np.datetime64("NaT") \
+                    if array.dtype.kind == "M" else np.nan
+        self.offsets.append(end)
+        return len(self.offsets) - 2
+
+    def rows(self, flight):
+        """Return the slice of the rows of a flight"""
+        return slice(self.offsets[flight], self.offsets[flight + 1])
+
+    def column(self, name, flight=None):
+        """Return a column of all flights, or of one, without copying"""
+        if flight is None:
+            return self.arrays[name][:len(self)]
+        return self.arrays[name][self.rows(flight)]
+
+    def take(self, rows, columns=None):
+        """Return a dataframe with copies of the given rows"""
+        if columns is None:
+            columns = list(self.arrays)
+        return pd.DataFrame({name: self.arrays[name][rows]
+                             for name in columns})
+
+    def nbytes(self):
+        """Return the number of bytes used by the stored rows"""
+        return sum(array[:len(self)].nbytes for array in self.arrays.values())
+
+
+class Session():
+    """
+    Many flights, shown together with DroneMap.show_session
+
+    Args:
+        align_starts: Show the flights as if they all started at the start
+            of the earliest flight, instead of in absolute time.
+        grid_size: The size of the grid squares the flights are binned by.
+    """
+
+    def __init__(self, align_starts=False, grid_size=GRID_SIZE):
+        self.align_starts = align_starts
+        self.grid_size = grid_size
+        self.store = FlightStore(STORED_COLUMNS)
+        self.names = []
+        self.visible = []
+        self.starts = []
+        self.bboxes = []
+        # The TimeBins of each flight, over its rows
+        self.bins = []
+        self.has_wind = False
+        # The (wind_data, tolerance, method) joined, to join onto flights
+        # added later
+        self.wind = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, drone_data, bins=None):
+        """
+        Add a flight, computing its metrics and joining the wind of the
+        session onto it
+
+        Args:
+            name: The name shown for the flight.
+            drone_data: The flight, see read_drone_csv.
+            bins: The TimeBins of drone_data, which is then sorted by time,
+                see flight_bins. Sorted and binned here if None.
+
+        Returns:
+            flight: The number of the flight.
+        """
+        if bins is None:
+            drone_data, bins = flight_bins(drone_data, self.grid_size)
+        flight = self.store.append(drone_data)
+        self.names.append(name)
+        self.visible.append(True)
+        times = self.store.column("CUSTOM.updateTime", flight)
+        self.starts.append(times.min() if len(times) else None)
+        self.bboxes.append(flight_bbox(drone_data) if len(drone_data)
+                           else None)
+        self.bins.append(bins)
+        rows = self.store.rows(flight)
+        metrics = flight_metrics(self._flight(
+            rows, times=to_ns(self.store.arrays["CUSTOM.updateTime"][rows])))
+        for name in METRICS_COLUMNS:
+            self.store.column(name, flight)[:] = metrics[name].to_numpy()
+        if self.wind is not None:
+            self._join_wind(flight, *self.wind)
+        return flight
+
+    def set_visible(self, flight, visible):
+        self.visible[flight] = visible
+
+    def shown(self):
+        """Return the numbers of the visible flights with rows"""
+        return [flight for flight in range(len(self))
+                if self.visible[flight] and self.starts[flight] is not None]
+
+    def num_rows(self):
+        """Return the number of rows of the visible flights"""
+        return sum(self.store.offsets[flight + 1] - self.store.offsets[flight]
+                   for flight in self.shown())
+
+    def bbox(self):
+        """Return the (north, south, east, west) bbox of all flights"""
+        boxes = [box for box in self.bboxes if box is not None]
+        return union(boxes) if boxes else None
+
+    def data(self):
+        """
+        Return the rows of the visible flights, earliest flight first
+
+        The rows are copied, so this is meant for occasional use, e.g. to
+        find the start of the session.
+        """
+        flights = sorted(self.shown(), key=lambda flight: self.starts[flight])
+        if not flights:
+            return self.store.take(slice(0, 0), list(DRONE_COLUMNS))
+        rows = np.concatenate([np.arange(self.store.offsets[flight],
+                                         self.store.offsets[flight + 1])
+                               for flight in flights])
+        return self.store.take(rows, list(DRONE_COLUMNS))
+
+    def points(self):
+        """
+        Return the points of the visible flights, sorted by time, their
+        bins and their metrics
+
+        With align_starts, every flight is moved in time to start at the
+        start of the earliest visible flight.
+
+        Returns:
+            (points, bins, metrics): A flightdata.Flight with the rows of
+            the visible flights, the number of the flight of each point,
+            and wind vectors if wind has been joined, the SessionBins of
+            the points, to pass to DroneMap.set_merged_data, and the
+            metrics of the points, see metrics.flight_metrics. The metrics
+            of a flight are those of the flight alone.
+        """
+        flights = self.shown()
+        lengths = [self.store.offsets[flight + 1] - self.store.offsets[flight]
+                   for flight in flights]
+        rows = np.empty(0, dtype=np.int64)
+        numbers = np.empty(0, dtype=np.int32)
+        times = np.empty(0, dtype=np.int64)
+        if flights:
+            rows = np.concatenate([np.arange(self.store.offsets[flight],
+                                             self.store.offsets[flight + 1])
+                                   for flight in flights])
+            numbers = np.repeat(np.array(flights, dtype=np.int32), lengths)
+            times = to_ns(self.store.column("CUSTOM.updateTime")[rows])
+        if flights and self.align_starts:
+            first = min(to_ns([self.starts[flight]])[0]
+                        for flight in flights)
+            shifts = np.array([first - to_ns([self.starts[flight]])[0]
+                               for flight in flights])
+            times = times + np.repeat(shifts, lengths)
+        positions = np.arange(len(times))
+        if np.any(times[1:] < times[:-1]):
+            # Every flight is sorted by time, and keeps its order
+            order = np.argsort(times, kind="mergesort")
+            positions[order] = positions.copy()
+            rows, numbers, times = rows[order], numbers[order], times[order]
+        firsts = np.cumsum([0] + lengths)
+        if len(rows) and rows[-1] - rows[0] + 1 == len(rows) \
+                and np.all(rows[1:] > rows[:-1]):
+            # Share the columns of the store, e.g. when all flights are
+            # shown and follow one another in time
+            rows = slice(rows[0], rows[-1] + 1)
+
+        points = self._flight(rows, times=times, flights=numbers)
+        if self.has_wind:
+            points = with_wind(points, points.wind_speed,
+                               points.wind_direction)
+        bins = SessionBins([self.bins[flight] for flight in flights],
+                           [positions[first:end] for first, end
+                            in zip(firsts[:-1], firsts[1:])])
+        metrics = pd.DataFrame({name: self.store.arrays[name][rows]
+                                for name in METRICS_COLUMNS}, copy=False)
+        return points, bins, metrics
+
+    def _flight(self, rows, **columns):
+        """A flightdata.Flight of the given rows of the store, and wind"""
+        stored = [name for name in SESSION_COLUMNS
+                  if name != "CUSTOM.updateTime"]
+        if self.has_wind:
+            stored += WIND_COLUMNS
+        return Flight(**columns, **{
+            attribute: np.asarray(self.store.arrays[name][rows], dtype=dtype)
+            for attribute, name, dtype in FLIGHT_COLUMNS if name in stored})
+
+    def join_wind(self, wind_data, tolerance=0.05, method="linear"):
+        """
+        Join wind samples onto all flights, by absolute time, and onto
+        the flights added later
+
+        Args:
+            wind_data: The wind data, with datetimes.
+            tolerance, method: See align.align_wind
+        """
+        for name in WIND_COLUMNS:
+            if name not in self.store.arrays:
+                self.store.add_column(name, np.float32)
+        self._join_wind(None, wind_data, tolerance, method)
+        self.wind = (wind_data, tolerance, method)
+        self.has_wind = True
+
+    def _join_wind(self, flight, wind_data, tolerance, method):
+        """Join wind samples onto one flight, or all if flight is None"""
+        speed, direction = wind_at(
+            to_ns(self.store.column("CUSTOM.updateTime", flight)), wind_data,
+            tolerance, method)
+        self.store.column("RANDOM.windSpeed", flight)[:] = speed
+        self.store.column("RANDOM.direction", flight)[:] = direction
+
+
+class SessionBins():
+    """
+    The bins of the points of a session, like binning.TimeBins
+
+    Each flight is binned by its own TimeBins, so a grid square crossed by
+    several flights shows the latest point of each of them. A window of the
+    points of the session is a range of the rows of every flight, found
+    with a binary search, and moving the window moves the TimeBins of the
+    flights.
+
+    Args:
+        bins: The TimeBins of every shown flight.
+        positions: For every shown flight, the sorted points of the session
+            holding its rows.
+
+    Attributes:
+        num_cells: The number of occupied cells of all flights.
+        window: The (start, end) points binned last.
+    """
+
+    def __init__(self, bins, positions):
+        self.bins = bins
+        self.positions = positions
+        self.num_cells = sum(flight_bins.num_cells for flight_bins in bins)
+        self.window = (0, 0)
+
+    def move(self, start, end):
+        """Bin the points start:end, see TimeBins.move"""
+        end = max(end, start)
+        for flight_bins, positions in zip(self.bins, self.positions):
+            flight_bins.move(int(np.searchsorted(positions, start)),
+                             int(np.searchsorted(positions, end)))
+        self.window = (start, end)
+
+    def rows(self):
+        """Return the sorted points of the latest rows of every cell"""
+        rows = np.concatenate([np.empty(0, dtype=np.int64)] + [
+            positions[flight_bins.rows()]
+            for flight_bins, positions in zip(self.bins, self.positions)])
+        rows.sort()
+        return rows
+
+    def select(self, xlim, ylim, columns, rows, below):
+        """Choose about one point per screen bin, see TimeBins.select"""
+        x = [np.empty(0)]
+        y = [np.empty(0)]
+        latest = [np.empty(0, dtype=np.int64)]
+        for flight_bins, positions in zip(self.bins, self.positions):
+            flight_latest = flight_bins.cell_latest
+            cells = np.flatnonzero(
+                (flight_latest >= 0)
+                & (flight_latest < np.searchsorted(positions, below)))
+            x.append(flight_bins.cell_x[cells])
+            y.append(flight_bins.cell_y[cells])
+            latest.append(positions[flight_latest[cells]])
+        x, y, latest = (np.concatenate(x), np.concatenate(y),
+                        np.concatenate(latest))
+        chosen = latest[screen_bins(x, y, np.arange(len(latest)), xlim, ylim,
+                                    columns, rows)]
+        chosen.sort()
+        return chosen
@@ -0,0 +1,680 @@
+"""
+Live telemetry from a growing log file or a socket
+
+A LiveFlight keeps the latest rows of a flight in a preallocated ring
+buffer, together with the latest row of every grid cell, both updated as
+rows arrive. Rows are read without blocking from a TailSource, a csv log
+that is still being written, or a SocketSource, lines of a log sent over
+UDP or TCP. A ReplayServer plays back an existing log at any speed, to any
+of those.
+
+Usage:
+    python stream.py Data/attitutf.csv --speed 4 --udp 127.0.0.1:5005
+    python stream.py Data/attitutf.csv --tcp 127.0.0.1:5005
+    python stream.py Data/attitutf.csv --file growing.csv
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.20
+"""
+
+import argparse
+import datetime
+import os
+import socket
+import threading
+import time
+import numpy as np
+import pandas as pd
+from binning import TimeBins
+from flightdata import COLUMNS as FLIGHT_COLUMNS, Flight
+from mapdraw import DRONE_COLUMNS, GRID_SIZE, HOUR_NS
+
+
+TIME_COLUMN = "CUSTOM.updateTime"
+VALUE_COLUMNS = [column for column in DRONE_COLUMNS if column != TIME_COLUMN]
+DEFAULT_CAPACITY = 1 << 20
+# No next row of the same cell, see LiveFlight
+NO_ROW = np.iinfo(np.int64).max
+# Largest UDP datagram sent by the replay server
+MAX_DATAGRAM = 32768
+# Seconds between repeated headers over UDP, for listeners starting late
+HEADER_INTERVAL = 1.0
+
+
+def parse_time(field):
+    """
+    Parse a "MM:SS.f" time of a DJI log
+
+    Returns:
+        offset: Nanoseconds since the start of the hour, or None if field
+        is not a time.
+    """
+    minutes, colon, seconds = field.partition(":")
+    if not colon or "/" in field:
+        return None
+    try:
+        return int(minutes) * 60 * 10**9 + int(round(float(seconds) * 10**9))
+    except ValueError:
+        return None
+
+
+def parse_date(field):
+    """Parse a "dd/mm/YYYY HH:MM" date row of a DJI log, or return None"""
+    try:
+        return datetime.datetime.strptime(field, "%d/%m/%Y %H:%M")
+    except ValueError:
+        return None
+
+
+class TelemetryParser():
+    """
+    Parses the lines of a DJI log, a batch of lines at a time
+
+    The times of the log only hold minutes and seconds. The hour is counted
+    up when the minutes wrap around, and the date and hour are taken from
+    the first date row. Until a date row has been read, the times start at
+    01/01/1990 00:00, like read_drone_csv does for logs without a date.
+    Rows with a missing or malformed value are skipped.
+    """
+
+    def __init__(self):
+        self.positions = None
+        self.start = np.datetime64("1990-01-01T00:00", "ns").astype(np.int64)
+        self.dated = False
+        self.last_offset = None
+        self.hours = 0
+        self.skipped = 0
+
+    def parse(self, lines):
+        """
+        Parse lines of a log
+
+        Args:
+            lines: The lines, without line endings. Header lines set the
+                column order of the lines after them.
+
+        Returns:
+            (rows, shift): A dict with an array per column of DRONE_COLUMNS,
+            times in int64 nanoseconds, and the nanoseconds to add to the
+            times of rows parsed earlier, when a date row has fixed the hour.
+        """
+        times = []
+        values = []
+        shift = 0
+        for line in lines:
+            fields = line.lstrip("\ufeff").split(",")
+            if fields[0] == TIME_COLUMN:
+                self.positions = [fields.index(column) for column
+                                  in DRONE_COLUMNS]
+                continue
+            if self.positions is None:
+                self.skipped += 1
+                continue
+            try:
+                row = [fields[i] for i in self.positions]
+            except IndexError:
+                self.skipped += 1
+                continue
+
+            offset = parse_time(row[0])
+            if offset is None:
+                date = parse_date(row[0])
+                if date is not None and not self.dated:
+                    start = self._date_start(date)
+                    # Times of this batch are made absolute below
+                    shift = start - self.start
+                    self.start = start
+                    self.dated = True
+                elif date is None:
+                    self.skipped += 1
+                continue
+            try:
+                row_values = [float(value) for value in row[1:]]
+            except ValueError:
+                self.skipped += 1
+                continue
+
+            if self.last_offset is not None \
+                    and offset - self.last_offset < -HOUR_NS // 2:
+                self.hours += 1
+            self.last_offset = offset
+            times.append(offset + self.hours * HOUR_NS)
+            values.append(row_values)
+
+        rows = {TIME_COLUMN: self.start + np.array(times, dtype=np.int64)}
+        values = np.array(values, dtype=np.float64).reshape(-1,
+                                                            len(VALUE_COLUMNS))
+        for i, column in enumerate(VALUE_COLUMNS):
+            rows[column] = values[:, i].astype(DRONE_COLUMNS[column])
+        return rows, shift
+
+    def _date_start(self, date):
+        """The time of the start of hour 0 of the log, given a date row"""
+        hour = date.hour
+        if self.last_offset is not None:
+            # The date row holds the hour of the time row just before it
+            minute = (self.last_offset // (60 * 10**9)) % 60
+            if minute - date.minute > 30:
+                hour -= 1
+            elif date.minute - minute > 30:
+                hour += 1
+        midnight = np.datetime64(date.replace(hour=0, minute=0), "ns")
+        return (midnight + np.timedelta64(hour - self.hours, "h")) \
+            .astype(np.int64)
+
+
+class LiveFlight():
+    """
+    The latest rows of a flight, in a preallocated ring buffer
+
+    Appending rows overwrites the oldest ones once the buffer is full. The
+    rows of every occupied grid cell are linked to the previous and next
+    row of the cell as rows arrive, and the latest row of every cell is
+    tracked, so the rows can be binned by any time span without binning
+    them again, see LiveBins. The cells are the cells of grid_bin_data,
+    anchored at 0 instead of at the smallest coordinate.
+
+    Args:
+        capacity: Maximum number of rows kept.
+        grid_size: The size of each grid square.
+    """
+
+    def __init__(self, capacity=DEFAULT_CAPACITY, grid_size=GRID_SIZE):
+        self.capacity = capacity
+        self.grid_size = grid_size
+        self.columns = {TIME_COLUMN: np.zeros(capacity, dtype=np.int64)}
+        for column in VALUE_COLUMNS:
+            self.columns[column] = np.zeros(capacity,
+                                            dtype=DRONE_COLUMNS[column])
+        # The number of the cell of every row, and whether the row is the
+        # latest of its cell
+        self.cell = np.zeros(capacity, dtype=np.int32)
+        self.is_latest = np.zeros(capacity, dtype=bool)
+        # The sequence numbers of the previous and next row of the same
+        # cell, -1 and NO_ROW if there is none
+        self.previous = np.full(capacity, -1, dtype=np.int64)
+        self.next = np.full(capacity, NO_ROW, dtype=np.int64)
+        # Cell key -> number of the cell, numbered as they are first seen
+        self.cell_numbers = {}
+        # The center of every cell, and the sequence number of its latest
+        # row, -1 if none of its rows are buffered. Grown when full.
+        self.cell_x = np.empty(0)
+        self.cell_y = np.empty(0)
+        self.cell_latest = np.empty(0, dtype=np.int64)
+        # Number of rows appended so far
+        self.total = 0
+        self.parser = TelemetryParser()
+
+    def __len__(self):
+        return min(self.total, self.capacity)
+
+    @property
+    def num_cells(self):
+        return len(self.cell_numbers)
+
+    def extend(self, lines):
+        """
+        Parse and append lines of a log
+
+        Returns:
+            num_rows: The number of rows appended.
+        """
+        rows, shift = self.parser.parse(lines)
+        if shift:
+            self.columns[TIME_COLUMN] += shift
+        return self.append(rows)
+
+    def append(self, rows):
+        """
+        Append rows, overwriting the oldest rows if the buffer is full
+
+        Args:
+            rows: A dict with an array per column of DRONE_COLUMNS, times in
+                int64 nanoseconds.
+
+        Returns:
+            num_rows: The number of rows appended.
+        """
+        num_rows = len(rows[TIME_COLUMN])
+        if num_rows == 0:
+            return 0
+        if num_rows > self.capacity:
+            # Only the last rows fit, as if the others were overwritten
+            skip = num_rows - self.capacity
+            rows = {column: values[skip:] for column, values in rows.items()}
+            self.total += skip
+            num_rows = self.capacity
+            # The buffered rows are all overwritten
+            self.cell_latest.fill(-1)
+            self.is_latest.fill(False)
+        seqs = np.arange(self.total, self.total + num_rows)
+        slots = seqs % self.capacity
+
+        # Rows about to be overwritten leave their cells
+        overwritten = slots[seqs >= self.capacity]
+        evicted = overwritten[self.is_latest[overwritten]]
+        self.cell_latest[self.cell[evicted]] = -1
+        self.is_latest[evicted] = False
+
+        for column, values in rows.items():
+            self.columns[column][slots] = values
+        cells = self._cell_numbers(rows["OSD.longitude"],
+                                   rows["OSD.latitude"])
+        self.cell[slots] = cells
+
+        # Link the new rows of each cell, the first to the latest buffered
+        # row of the cell
+        order = np.argsort(cells, kind="stable")
+        same = cells[order[1:]] == cells[order[:-1]]
+        firsts = order[np.append(True, ~same)]
+        lasts = order[np.append(~same, True)]
+        previous = np.empty(num_rows, dtype=np.int64)
+        previous[order[1:][same]] = seqs[order[:-1][same]]
+        previous[firsts] = self.cell_latest[cells[firsts]]
+        following = np.full(num_rows, NO_ROW, dtype=np.int64)
+        following[order[:-1][same]] = seqs[order[1:][same]]
+        self.previous[slots] = previous
+        self.next[slots] = following
+        linked = previous[firsts] >= 0
+        self.next[previous[firsts][linked] % self.capacity] = \
+            seqs[firsts][linked]
+        self.is_latest[previous[firsts][linked] % self.capacity] = False
+
+        # The last new row in each cell becomes the latest row of the cell
+        self.cell_latest[cells[lasts]] = seqs[lasts]
+        self.is_latest[slots[lasts]] = True
+        self.total += num_rows
+        return num_rows
+
+    def _cell_numbers(self, longitudes, latitudes):
+        """Return the number of the cell of every row, numbering new cells"""
+        ix = np.floor(longitudes / self.grid_size).astype(np.int64)
+        iy = np.floor(latitudes / self.grid_size).astype(np.int64)
+        keys, firsts, inverse = np.unique(ix * 2**32 + iy, return_index=True,
+                                          return_inverse=True)
+        num_cells = self.num_cells
+        numbers = np.array([self.cell_numbers.setdefault(
+            key, len(self.cell_numbers)) for key in keys.tolist()],
+            dtype=np.int32)
+        new = numbers >= num_cells
+        if self.num_cells > len(self.cell_latest):
+            size = max(self.num_cells, 2 * len(self.cell_latest))
+            self.cell_x = np.resize(self.cell_x, size)
+            self.cell_y = np.resize(self.cell_y, size)
+            self.cell_latest = np.append(
+                self.cell_latest,
+                np.full(size - len(self.cell_latest), -1, dtype=np.int64))
+        self.cell_x[numbers[new]] = (ix[firsts[new]] + 0.5) * self.grid_size
+        self.cell_y[numbers[new]] = (iy[firsts[new]] + 0.5) * self.grid_size
+        return numbers[inverse.ravel()]
+
+    def _slots(self, mask=None):
+        """Slots of the buffered rows (where mask is set), oldest first"""
+        if mask is None:
+            mask = np.ones(self.capacity, dtype=bool)
+        if self.total <= self.capacity:
+            return np.flatnonzero(mask[:self.total])
+        start = self.total % self.capacity
+        return np.concatenate([start + np.flatnonzero(mask[start:]),
+                               np.flatnonzero(mask[:start])])
+
+    def _ordered(self, values):
+        """
+        The values of the buffered rows, oldest first, sharing the buffer
+        until it is full
+        """
+        if self.total <= self.capacity:
+            return values[:self.total]
+        start = self.total % self.capacity
+        return np.concatenate([values[start:], values[:start]])
+
+    def _frame(self, slots):
+        data = pd.DataFrame({column: values[slots] for column, values
+                             in self.columns.items()})
+        data[TIME_COLUMN] = data[TIME_COLUMN].to_numpy().view(
+            "datetime64[ns]")
+        return data
+
+    def points(self):
+        """
+        Return the buffered rows and their bins, like mapdraw.bin_flight
+
+        Returns:
+            (points, bins): The rows as a flightdata.Flight, oldest first,
+            and their LiveBins. Until the buffer is full, the points share
+            its arrays and are only valid until the next rows are appended.
+        """
+        points = Flight(**{attribute: self._ordered(self.columns[name])
+                           for attribute, name, _ in FLIGHT_COLUMNS
+                           if name in self.columns})
+        return points, LiveBins(self)
+
+    def data(self):
+        """Return all buffered rows, like read_drone_csv"""
+        return self._frame(self._slots())
+
+
+class LiveBins(TimeBins):
+    """
+    The TimeBins of the buffered rows of a LiveFlight, from the links kept
+    as rows arrive
+
+    A window up to the latest row is binned from the latest row of every
+    cell, other windows by going through their rows.
+
+    Args:
+        live: The LiveFlight.
+    """
+
+    def __init__(self, live):
+        # The sequence number of the oldest buffered row
+        first = live.total - len(live)
+        self.window = (0, 0)
+        self.num_cells = live.num_cells
+        self.cells = live._ordered(live.cell)
+        self.previous = live._ordered(live.previous)
+        self.next = live._ordered(live.next)
+        if first:
+            # Rows before the first are no longer buffered
+            self.previous = self.previous - first
+            self.next = self.next - first
+        self.is_latest = live._ordered(live.is_latest)
+        self.cell_x = live.cell_x[:self.num_cells]
+        self.cell_y = live.cell_y[:self.num_cells]
+        self.cell_latest = np.full(self.num_cells, -1, dtype=np.int64)
+
+    def _bin_cells(self, start, end):
+        if end == len(self.cells):
+            latest = start + np.flatnonzero(self.is_latest[start:])
+        else:
+            rows = np.arange(start, end)
+            latest = rows[self.next[start:end] >= end]
+        self.cell_latest[self.cells[latest]] = latest
+
+
+class TailSource():
+    """
+    Reads the lines added to a log file that is still being written
+
+    Args:
+        path: The log file.
+        from_start: Read the lines already in the file, otherwise only the
+            header and the lines added from now on.
+    """
+
+    def __init__(self, path, from_start=True):
+        self.path = path
+        self.file = open(path, "rb")
+        self.partial = b""
+        self.header = []
+        if not from_start:
+            header = self.file.readline().decode("utf-8")
+            self.header = [header.rstrip("\r\n")]
+            self.file.seek(0, os.SEEK_END)
+
+    def read_lines(self, max_bytes=1 << 20):
+        """Return the complete lines added since the last call"""
+        if os.fstat(self.file.fileno()).st_size < self.file.tell():
+            # The log was truncated and is written again from the start
+            self.file.seek(0)
+            self.partial = b""
+        data = self.partial + self.file.read(max_bytes)
+        lines, self.partial = _split_lines(data)
+        lines = self.header + lines
+        self.header = []
+        return lines
+
+    def close(self):
+        self.file.close()
+
+
+class SocketSource():
+    """
+    Reads lines of a log sent over UDP or TCP, e.g. by a ReplayServer
+
+    Args:
+        host, port: For UDP the address to listen on, for TCP the address
+            of the server to connect to.
+        protocol: "udp" or "tcp".
+    """
+
+    def __init__(self, host, port, protocol="udp"):
+        self.protocol = protocol
+        self.partial = b""
+        self.closed = False
+        if protocol == "udp":
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF,
+                                   1 << 22)
+            self.socket.bind((host, port))
+        else:
+            self.socket = socket.create_connection((host, port), timeout=5)
+        self.socket.setblocking(False)
+
+    def read_lines(self, max_bytes=1 << 20):
+        """Return the complete lines received since the last call"""
+        data = [self.partial]
+        received = 0
+        while received < max_bytes and not self.closed:
+            try:
+                chunk = self.socket.recv(65536)
+            except (BlockingIOError, InterruptedError):
+                break
+            if not chunk and self.protocol == "tcp":
+                self.closed = True
+            data.append(chunk)
+            received += len(chunk)
+        lines, self.partial = _split_lines(b"".join(data))
+        return lines
+
+    def close(self):
+        self.socket.close()
+
+
+def _split_lines(data):
+    """Split data into complete decoded lines and the incomplete rest"""
+    lines = data.split(b"\n")
+    rest = lines.pop()
+    return [line.decode("utf-8").rstrip("\r") for line in lines if line], rest
+
+
+def open_source(spec):
+    """
+    Open a live telemetry source
+
+    Args:
+        spec: "udp://host:port" to listen for UDP datagrams,
+            "tcp://host:port" to connect to a TCP server, or the path of a
+            log file to tail.
+    """
+    for protocol in ("udp", "tcp"):
+        prefix = protocol + "://"
+        if spec.startswith(prefix):
+            host, _, port = spec[len(prefix):].rpartition(":")
+            return SocketSource(host or "127.0.0.1", int(port), protocol)
+    return TailSource(spec)
+
+
+class ReplayServer():
+    """
+    Plays back a log at the pace of its timestamps
+
+    Args:
+        csv_path: The log to play back.
+        target: For "udp" the (host, port) to send to, for "tcp" the
+            (host, port) to accept clients on, for "file" the path of the
+            log to write.
+        protocol: "udp", "tcp" or "file".
+        speed: Playback speed, 2 plays the log twice as fast.
+        loop: Start over at the end of the log.
+    """
+
+    def __init__(self, csv_path, target, protocol="udp", speed=1.0,
+                 loop=False):
+        with open(csv_path, encoding="utf-8") as log:
+            lines = log.read().lstrip("\ufeff").split("\n")
+        lines = [line.rstrip("\r") for line in lines if line]
+        self.header = lines[0]
+        self.lines = lines[1:]
+        self.target = target
+        self.protocol = protocol
+        self.speed = speed
+        self.loop = loop
+        self.due = self._due_times()
+        # perf_counter time each time row was sent, for latency measurement
+        self.sent_times = []
+        self.stopped = threading.Event()
+        self.thread = None
+        self.clients = []
+
+    def _due_times(self):
+        """Seconds after the first row at which each line is due"""
+        due = np.zeros(len(self.lines))
+        first = last = None
+        hours = 0
+        for i, line in enumerate(self.lines):
+            offset = parse_time(line.partition(",")[0])
+            if offset is not None:
+                if last is not None and offset - last < -HOUR_NS // 2:
+                    hours += 1
+                last = offset
+                offset += hours * HOUR_NS
+                if first is None:
+                    first = offset
+                due[i] = (offset - first) / 10**9
+            elif i > 0:
+                due[i] = due[i - 1]
+        return np.maximum.accumulate(due)
+
+    def start(self):
+        """Start playing back in a background thread"""
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def run(self):
+        """Play back the log, until the end or until stopped"""
+        if self.protocol == "udp":
+            out = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        elif self.protocol == "tcp":
+            out = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            out.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            out.bind(self.target)
+            out.listen()
+            out.setblocking(False)
+        else:
+            out = open(self.target, "w", encoding="utf-8")
+        self.clients = []
+        try:
+            # Start playing back when the first client has connected
+            while self.protocol == "tcp" and not self.clients \
+                    and not self.stopped.wait(0.01):
+                self._accept(out)
+            if self.protocol != "tcp":
+                # TCP clients get the header when they connect
+                self._send(out, [self.header])
+            last_header = time.perf_counter()
+            while not self.stopped.is_set():
+                start = time.perf_counter()
+                i = 0
+                while i < len(self.lines) and not self.stopped.is_set():
+                    now = time.perf_counter()
+                    if self.protocol == "udp" \
+                            and now - last_header > HEADER_INTERVAL:
+                        self._send(out, [self.header])
+                        last_header = now
+                    # Send every line that is due, then wait for the next
+                    due = (now - start) * self.speed
+                    end = int(np.searchsorted(self.due, due, side="right"))
+                    end = max(end, i + 1)
+                    self._send(out, self.lines[i:end])
+                    sent = time.perf_counter()
+                    self.sent_times.extend(
+                        sent for line in self.lines[i:end]
+                        if parse_time(line.partition(",")[0]) is not None)
+                    i = end
+                    if i < len(self.lines):
+                        wait = self.due[i] / self.speed \
+                            - (time.perf_counter() - start)
+                        self.stopped.wait(max(wait, 0))
+                if not self.loop:
+                    break
+        finally:
+            for client in self.clients:
+                client.close()
+            out.close()
+
+    def _send(self, out, lines):
+        data = "".join(line + "\n" for line in lines)
+        if self.protocol == "file":
+            out.write(data)
+            out.flush()
+            return
+        data = data.encode("utf-8")
+        if self.protocol == "udp":
+            # Whole lines in every datagram
+            while data:
+                cut = len(data)
+                if cut > MAX_DATAGRAM:
+                    cut = data.rindex(b"\n", 0, MAX_DATAGRAM) + 1
+                out.sendto(data[:cut], self.target)
+                data = data[cut:]
+            return
+        self._accept(out)
+        for client in list(self.clients):
+            try:
+                client.sendall(data)
+            except OSError:
+                self.clients.remove(client)
+                client.close()
+
+    def _accept(self, server):
+        """Accept new TCP clients, and send them the header"""
+        while True:
+            try:
+                client, _ = server.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            client.setblocking(True)
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            client.sendall((self.header + "\n").encode("utf-8"))
+            self.clients.append(client)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Play back a drone log as live telemetry")
+    parser.add_argument("csv_path", help="the log to play back")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="playback speed, e.g. 4 for 4x")
+    parser.add_argument("--loop", action="store_true",
+                        help="start over at the end of the log")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--udp", metavar="HOST:PORT",
+                        help="send datagrams to this address")
+    target.add_argument("--tcp", metavar="HOST:PORT",
+                        help="accept clients on this address")
+    target.add_argument("--file", help="write a growing log to this path")
+    args = parser.parse_args(argv)
+
+    if args.file:
+        server = ReplayServer(args.csv_path, args.file, "file", args.speed,
+                              args.loop)
+    else:
+        protocol = "udp" if args.udp else "tcp"
+        host, _, port = (args.udp or args.tcp).rpartition(":")
+        server = ReplayServer(args.csv_path, (host or "127.0.0.1", int(port)),
+                              protocol, args.speed, args.loop)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
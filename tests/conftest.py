@@ -0,0 +1,16 @@
+"""
+The modules under test are at the top of the repository, and maps are
+drawn without a display
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.30
+"""
+
+import os
+import sys
+import matplotlib
+
+matplotlib.use("Agg")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
@@ -0,0 +1,206 @@
+"""
+Tests of the alignment of wind samples to the drone timeline
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.30
+"""
+
+import bisect
+import numpy as np
+import pandas as pd
+import pytest
+from align import align_wind, asof_indices, interpolate, resample_wind, \
+    to_ns, wind_at
+
+
+SECOND = 10**9
+START = np.datetime64("2020-02-28T14:00:00", "ns")
+
+
+def wind_frame(seconds, speeds, directions):
+    times = START + (np.asarray(seconds, dtype=np.float64)
+                     * SECOND).astype("timedelta64[ns]")
+    return pd.DataFrame({"INCREMENTED.time": times,
+                         "RANDOM.windSpeed": np.asarray(speeds, float),
+                         "RANDOM.direction": np.asarray(directions, float)})
+
+
+def drone_frame(seconds):
+    times = START + (np.asarray(seconds, dtype=np.float64)
+                     * SECOND).astype("timedelta64[ns]")
+    return pd.DataFrame({"CUSTOM.updateTime": times,
+                         "OSD.height [m]": np.arange(len(times), dtype=float)})
+
+
+def circular_distance(a, b):
+    return np.abs((np.asarray(a) - np.asarray(b) + 180) % 360 - 180)
+
+
+def test_tolerance_cut_off():
+    sample_times = np.array([0, SECOND], dtype=np.int64)
+    times = np.array([-SECOND // 2, 0, SECOND // 5, SECOND // 2,
+                      SECOND * 4 // 5, 2 * SECOND], dtype=np.int64)
+    for method in ("nearest", "linear"):
+        estimates = interpolate(times, sample_times, [0.0, 10.0],
+                                SECOND * 3 // 10, method)
+        assert np.isnan(estimates[[0, 3, 5]]).all()
+        assert not np.isnan(estimates[[1, 2, 4]]).any()
+    _, _, _, matched = asof_indices(times, sample_times, SECOND * 3 // 10)
+    assert matched.tolist() == [False, True, True, False, True, False]
+
+
+def test_tolerance_is_inclusive():
+    estimates = interpolate(np.array([SECOND // 2]),
+                            np.array([0, SECOND]), [0.0, 10.0], SECOND // 2)
+    assert estimates[0] == pytest.approx(5)
+
+
+def test_nearest_and_linear():
+    sample_times = np.array([0, SECOND], dtype=np.int64)
+    times = np.array([0, SECOND * 3 // 10, SECOND * 7 // 10, SECOND])
+    nearest = interpolate(times, sample_times, [0.0, 10.0], SECOND,
+                          "nearest")
+    linear = interpolate(times, sample_times, [0.0, 10.0], SECOND, "linear")
+    assert nearest.tolist() == [0, 0, 10, 10]
+    assert linear == pytest.approx([0, 3, 7, 10])
+
+
+def test_no_samples():
+    estimates = interpolate(np.array([0, 1]), np.array([], dtype=np.int64),
+                            [], SECOND)
+    assert np.isnan(estimates).all()
+
+
+def test_circular_interpolation_across_north():
+    sample_times = np.array([0, SECOND], dtype=np.int64)
+    times = np.array([0, SECOND // 4, SECOND // 2, SECOND * 3 // 4, SECOND])
+    estimates = interpolate(times, sample_times, [359.0, 1.0], SECOND,
+                            circular=True)
+    # Interpolated as unit vectors, so only about linear between samples
+    assert circular_distance(estimates, [359, 359.5, 0, 0.5, 1]).max() \
+        < 1e-3
+    assert circular_distance(estimates[[0, 2, 4]], [359, 0, 1]).max() < 1e-9
+    assert ((estimates >= 0) & (estimates < 360)).all()
+    # Not the long way round, through 180
+    assert (circular_distance(estimates, 0) <= 1 + 1e-9).all()
+
+
+def test_circular_nearest_keeps_directions():
+    estimates = interpolate(np.array([SECOND // 4, SECOND * 3 // 4]),
+                            np.array([0, SECOND]), [359.0, 1.0], SECOND,
+                            "nearest", circular=True)
+    assert estimates.tolist() == [359, 1]
+
+
+def test_unsorted_drone_times():
+    wind = wind_frame([0, 1, 2], [0, 10, 20], [0, 2, 4])
+    seconds = [1.5, 0.25, 2, 0.5, 1]
+    merged = align_wind(drone_frame(seconds), wind, tolerance=1)
+    assert merged["RANDOM.windSpeed"].to_numpy() == pytest.approx(
+        [15, 2.5, 20, 5, 10])
+    assert merged["RANDOM.direction"].to_numpy() == pytest.approx(
+        [3, 0.5, 4, 1, 2], abs=1e-3)
+    # The drone rows are kept as they were
+    assert merged["OSD.height [m]"].tolist() == [0, 1, 2, 3, 4]
+
+
+def test_unsorted_wind_samples():
+    wind = wind_frame([0, 1, 2, 3], [0, 10, 20, 30], [10, 20, 30, 40])
+    shuffled = wind.iloc[[2, 0, 3, 1]]
+    drone = drone_frame(np.linspace(-0.5, 3.5, 17))
+    expected = align_wind(drone, wind, tolerance=0.3)
+    merged = align_wind(drone, shuffled, tolerance=0.3)
+    pd.testing.assert_frame_equal(merged, expected)
+    speed, direction = wind_at(to_ns(drone["CUSTOM.updateTime"]), shuffled,
+                               tolerance=0.3)
+    np.testing.assert_array_equal(speed, expected["RANDOM.windSpeed"])
+    np.testing.assert_array_equal(direction, expected["RANDOM.direction"])
+
+
+def test_duplicate_timestamps():
+    wind = wind_frame([0, 1, 1, 2], [0, 10, 10, 20], [0, 10, 10, 20])
+    merged = align_wind(drone_frame([0.5, 1, 1.5]), wind, tolerance=1)
+    assert merged["RANDOM.windSpeed"].to_numpy() == pytest.approx([5, 10, 15])
+    # Duplicated drone times get the same wind
+    merged = align_wind(drone_frame([1.5, 1.5]), wind, tolerance=1)
+    assert merged["RANDOM.windSpeed"].tolist() == [15, 15]
+
+
+def test_matched_wind_time():
+    wind = wind_frame([0, 1], [0, 10], [0, 10])
+    merged = align_wind(drone_frame([0.2, 0.5, 0.9, 5]), wind,
+                        tolerance=0.3)
+    times = merged["INCREMENTED.time"]
+    assert times.iloc[0] == START
+    assert times.iloc[2] == START + np.timedelta64(SECOND, "ns")
+    assert times.iloc[[1, 3]].isna().all()
+
+
+@pytest.mark.parametrize("rate", [0.5, 3, 7.3])
+def test_resample_wind(rate):
+    seconds = [0, 1.3, 2, 4.1, 6, 6.5, 10]
+    wind = wind_frame(seconds, np.multiply(seconds, 2), seconds)
+    resampled = resample_wind(wind, rate)
+    step = int(round(SECOND / rate))
+    times = to_ns(resampled["INCREMENTED.time"]) - to_ns([START])[0]
+    assert times[0] == 0
+    assert (np.diff(times) == step).all()
+    assert times[-1] <= 10 * SECOND < times[-1] + step
+    # Speed and direction are linear in time
+    assert resampled["RANDOM.windSpeed"].to_numpy() == pytest.approx(
+        2 * times / SECOND)
+    assert resampled["RANDOM.direction"].to_numpy() == pytest.approx(
+        times / SECOND, abs=1e-3)
+
+
+def test_resample_wind_range_and_tolerance():
+    wind = wind_frame([0, 1, 5, 6], [0, 1, 5, 6], [0, 0, 0, 0])
+    resampled = resample_wind(
+        wind, 2, start=START + np.timedelta64(SECOND, "ns"),
+        end=START + np.timedelta64(5 * SECOND, "ns"), tolerance=0.6)
+    assert len(resampled) == 9
+    speeds = resampled["RANDOM.windSpeed"].to_numpy()
+    assert speeds[[0, 1, 7, 8]] == pytest.approx([1, 1.5, 4.5, 5])
+    # Further than the tolerance from both samples of the gap
+    assert np.isnan(speeds[2:7]).all()
+
+
+def naive_interpolate(time, sample_times, values, tolerance_ns):
+    """The linear estimate at one time, one sample at a time"""
+    after = bisect.bisect_left(sample_times, time)
+    before = max(after - 1, 0)
+    after = min(after, len(sample_times) - 1)
+    if sample_times[after] == time:
+        before = after
+    distance = min(abs(time - sample_times[before]),
+                   abs(sample_times[after] - time))
+    if distance > tolerance_ns:
+        return np.nan
+    span = sample_times[after] - sample_times[before]
+    if span <= 0:
+        return values[before]
+    weight = min(max((time - sample_times[before]) / span, 0), 1)
+    return values[before] + weight * (values[after] - values[before])
+
+
+def test_million_rows_against_naive():
+    rng = np.random.default_rng(9)
+    num_rows = 1000000
+    # Wind at about 10 Hz with jitter, gaps and duplicates
+    sample_times = np.sort(rng.integers(0, num_rows // 10 * SECOND // 10,
+                                        num_rows // 10)) // 1000 * 1000
+    values = rng.normal(5, 2, len(sample_times))
+    # Drone times at about 100 Hz, in any order, some outside the wind
+    times = rng.integers(-SECOND, sample_times[-1] + SECOND, num_rows)
+    tolerance_ns = SECOND // 20
+
+    estimates = interpolate(times, sample_times, values, tolerance_ns)
+    assert len(estimates) == num_rows
+    checked = rng.choice(num_rows, 5000, replace=False)
+    sample_list = sample_times.tolist()
+    expected = [naive_interpolate(int(times[row]), sample_list, values,
+                                  tolerance_ns) for row in checked]
+    np.testing.assert_allclose(estimates[checked], expected, rtol=1e-12,
+                               atol=1e-12)
+    # Most drone times have a wind sample in tolerance, not all
+    assert 0.5 < np.isfinite(estimates).mean() < 1
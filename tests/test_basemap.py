@@ -0,0 +1,104 @@
+"""
+Tests of the basemap store, with the StaticProvider stand-in
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.30
+"""
+
+import pytest
+from basemap import LAYERS, Basemap, BasemapStore, StaticProvider
+
+
+# Layers only need to be picklable for the store
+REAL_LAYERS = {"area": "area", "edges": "edges", "buildings": "buildings",
+               "parks": "parks"}
+
+
+@pytest.fixture
+def store(tmp_path):
+    return BasemapStore(str(tmp_path / "basemap"))
+
+
+def test_contained_bbox_is_served_from_store(store):
+    store.save((10, 0, 10, 0), REAL_LAYERS)
+    provider = StaticProvider()
+    layers = Basemap(provider, store).get_layers(5, 1, 5, 1)
+    assert layers == REAL_LAYERS
+    assert provider.calls == 0
+
+
+def test_fetched_layers_replace_overlapping_entries(store):
+    store.save((10, 0, 10, 0), {"edges": "old"})
+    provider = StaticProvider(REAL_LAYERS)
+    layers = Basemap(provider, store).get_layers(12, 5, 12, 5)
+    assert layers == REAL_LAYERS
+    assert provider.calls == 1
+    assert list(store.index.values()) == [[12, 0, 12, 0]]
+
+
+def test_empty_fetch_keeps_overlapping_entries(store):
+    key = store.save((10, 0, 10, 0), REAL_LAYERS)
+    provider = StaticProvider()
+    layers = Basemap(provider, store).get_layers(12, 5, 12, 5)
+    assert provider.calls == 1
+    # The stored layers are served, and the store is left as it was
+    assert layers == REAL_LAYERS
+    assert store.index == {key: [10, 0, 10, 0]}
+    assert BasemapStore(store.store_dir).load(key) == REAL_LAYERS
+
+
+def test_empty_fetch_is_not_stored(store):
+    provider = StaticProvider()
+    layers = Basemap(provider, store).get_layers(12, 5, 12, 5)
+    assert layers == {name: None for name in LAYERS}
+    assert store.index == {}
+    # A later fetch with data is not shadowed by empty layers
+    provider.layers = REAL_LAYERS
+    assert Basemap(provider, store).get_layers(12, 5, 12, 5) == REAL_LAYERS
+    assert provider.calls == 2
+
+
+def test_failed_fetch_keeps_store(store):
+    class FailingProvider():
+        def fetch(self, north, south, east, west):
+            raise OSError("offline")
+
+    key = store.save((10, 0, 10, 0), REAL_LAYERS)
+    layers = Basemap(FailingProvider(), store).get_layers(12, 5, 12, 5)
+    assert layers == REAL_LAYERS
+    assert store.index == {key: [10, 0, 10, 0]}
+
+
+def test_lookup_only_reads_store(store):
+    key = store.save((10, 0, 10, 0), REAL_LAYERS)
+    assert store.lookup((5, 1, 5, 1)) == REAL_LAYERS
+    assert store.lookup((12, 5, 12, 5)) == REAL_LAYERS
+    assert store.lookup((30, 20, 30, 20)) == {name: None for name in LAYERS}
+    assert store.index == {key: [10, 0, 10, 0]}
+
+
+class SquareLayer():
+    """A layer drawing a filled square, standing in for a GeoDataFrame"""
+
+    def __init__(self, bbox):
+        self.bbox = bbox
+
+    def plot(self, ax, **style):
+        north, south, east, west = self.bbox
+        ax.fill([west, east, east, west], [south, south, north, north],
+                color="black")
+
+
+def test_empty_raster_is_not_stored(store):
+    bbox = (59.5, 59.4, 18.3, 18.2)
+    offline = Basemap(StaticProvider(), store)
+    image = offline.get_raster(*bbox, zoom=0)
+    # Nothing drawn, and nothing stored
+    assert (image == image[0, 0]).all()
+    assert store.load_raster(bbox, 0) is None
+
+    online = Basemap(StaticProvider({"area": SquareLayer(
+        (59.48, 59.42, 18.28, 18.22))}), store)
+    image = online.get_raster(*bbox, zoom=0)
+    assert not (image == image[0, 0]).all()
+    assert store.load_raster(bbox, 0) is not None
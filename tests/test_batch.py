@@ -0,0 +1,41 @@
+"""
+Tests of the headless batch processing
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.30
+"""
+
+import json
+import os
+import batch
+import flightcache
+from basemap import BasemapStore
+
+
+FLIGHT_LOG = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "Data", "attitutf.csv")
+
+
+def test_offline_run_does_not_change_basemap_store(tmp_path, monkeypatch):
+    store_dir = str(tmp_path / "basemap")
+    monkeypatch.setattr(flightcache, "_default_cache",
+                        flightcache.FlightCache(str(tmp_path / "cache")))
+    monkeypatch.setattr(batch, "BasemapStore",
+                        lambda: BasemapStore(store_dir))
+
+    def no_fetching(*args):
+        raise AssertionError("offline runs must not fetch map data")
+
+    monkeypatch.setattr(batch, "Basemap", no_fetching)
+    # An entry far from the flight, which must stay the only one
+    key = BasemapStore(store_dir).save((10, 0, 10, 0), {"edges": None})
+    before = sorted(os.listdir(store_dir))
+
+    out_dir = str(tmp_path / "out")
+    os.makedirs(out_dir)
+    summary = batch.process_flight(FLIGHT_LOG, None, out_dir, "png", True)
+
+    assert os.path.exists(summary["image"])
+    assert sorted(os.listdir(store_dir)) == before
+    with open(os.path.join(store_dir, "index.json")) as index:
+        assert json.load(index) == {key: [10, 0, 10, 0]}
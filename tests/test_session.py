@@ -0,0 +1,130 @@
+"""
+Tests of the binning of the flights of a session by the time span shown
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.30
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+from binning import cell_keys
+from mapdraw import GRID_SIZE
+from metrics import METRICS_COLUMNS, flight_metrics
+from session import Session
+
+START = np.datetime64("2020-02-28T14:00:00", "ns")
+
+
+def random_flight(rng, num_rows, start_s, shuffle=False):
+    """A flight at 10 Hz hopping between the squares of a small grid"""
+    data = pd.DataFrame({
+        "CUSTOM.updateTime": START + np.timedelta64(start_s, "s")
+        + (np.arange(num_rows) * 10**8).astype("timedelta64[ns]"),
+        "OSD.latitude": 59.1 + (rng.integers(0, 6, num_rows) + 0.5)
+        * GRID_SIZE,
+        "OSD.longitude": 18.1 + (rng.integers(0, 6, num_rows) + 0.5)
+        * GRID_SIZE})
+    for name in ["OSD.pitch", "OSD.yaw", "OSD.roll", "OSD.height [m]",
+                 "CALC.hSpeed [m/s]"]:
+        data[name] = rng.normal(size=num_rows).astype(np.float32)
+    if shuffle:
+        data = data.sample(frac=1, random_state=1).reset_index(drop=True)
+    return data
+
+
+def latest_rows(points, start, end):
+    """The latest row of every flight in every square, one at a time"""
+    ix, iy = cell_keys(points.longitudes, points.latitudes, GRID_SIZE)
+    latest = {}
+    for row in range(start, end):
+        latest[points.flights[row], ix[row], iy[row]] = row
+    return np.sort(np.array(list(latest.values()), dtype=np.int64))
+
+
+@pytest.mark.parametrize("align_starts", [False, True])
+def test_bins_of_time_span(align_starts):
+    rng = np.random.default_rng(3)
+    session = Session(align_starts=align_starts)
+    session.add("a", random_flight(rng, 300, 0))
+    session.add("b", random_flight(rng, 200, 7, shuffle=True))
+    session.add("c", random_flight(rng, 100, 1000))
+    for visible in ([True, True, True], [True, False, True]):
+        for flight, shown in enumerate(visible):
+            session.set_visible(flight, shown)
+        points, bins, _ = session.points()
+        assert (np.diff(points.times) >= 0).all()
+        assert len(points) == session.num_rows()
+        for _ in range(40):
+            start, end = sorted(rng.integers(0, len(points) + 1, 2))
+            bins.move(start, end)
+            np.testing.assert_array_equal(
+                bins.rows(), latest_rows(points, start, end))
+
+
+def test_scrubbing_back_shows_points_of_time_span():
+    rng = np.random.default_rng(4)
+    session = Session()
+    session.add("a", random_flight(rng, 300, 0))
+    points, bins, _ = session.points()
+    bins.move(0, len(points))
+    bins.move(0, 100)
+    rows = bins.rows()
+    # Every square visited in the time span shows a point of it, also
+    # when the square is visited again later
+    assert (rows < 100).all()
+    np.testing.assert_array_equal(rows, latest_rows(points, 0, 100))
+
+
+def test_select_chooses_binned_rows():
+    rng = np.random.default_rng(5)
+    session = Session()
+    session.add("a", random_flight(rng, 300, 0))
+    session.add("b", random_flight(rng, 300, 10))
+    points, bins, _ = session.points()
+    bins.move(50, 400)
+    chosen = bins.select((18, 18.2), (59, 59.2), 200, 200, 300)
+    assert len(chosen)
+    assert set(chosen) <= set(bins.rows())
+    assert (chosen < 300).all()
+
+
+def test_flight_added_after_wind_gets_wind():
+    rng = np.random.default_rng(7)
+    session = Session()
+    session.add("a", random_flight(rng, 100, 0))
+    seconds = np.arange(0, 2000, 0.5)
+    wind_data = pd.DataFrame({
+        "INCREMENTED.time": START + (seconds * 10**9).astype(
+            "timedelta64[ns]"),
+        "RANDOM.windSpeed": np.full(len(seconds), 4.0),
+        "RANDOM.direction": np.full(len(seconds), 90.0)})
+    session.join_wind(wind_data, tolerance=1)
+    session.add("b", random_flight(rng, 100, 1000))
+
+    points, _, _ = session.points()
+    assert len(points) == 200
+    np.testing.assert_allclose(points.wind_speed, 4)
+    np.testing.assert_allclose(points.wind_direction, 90)
+    assert np.isfinite(points.wind_u).all()
+
+
+@pytest.mark.parametrize("align_starts", [False, True])
+def test_metrics_of_each_flight(align_starts):
+    rng = np.random.default_rng(8)
+    session = Session(align_starts=align_starts)
+    flights = [random_flight(rng, 300, 0), random_flight(rng, 200, 7),
+               random_flight(rng, 100, 1000)]
+    for number, data in enumerate(flights):
+        session.add(str(number), data)
+    session.set_visible(1, False)
+    points, bins, metrics = session.points()
+    assert list(metrics.columns) == METRICS_COLUMNS
+    assert len(metrics) == len(points)
+    for flight, positions in zip([0, 2], bins.positions):
+        alone = Session()
+        alone.add("alone", flights[flight])
+        alone_points, _, _ = alone.points()
+        expected = flight_metrics(alone_points)
+        pd.testing.assert_frame_equal(
+            metrics.iloc[positions].reset_index(drop=True), expected)
@@ -0,0 +1,75 @@
+"""
+Tests of the binning of live flights by the time span shown
+
+Authors --Group 12 of MVK at KTH 2020.
+Version --2020.05.30
+"""
+
+import numpy as np
+import pytest
+from mapdraw import DRONE_COLUMNS, DroneMap
+from metrics import flight_metrics, metrics_at
+from stream import TIME_COLUMN, VALUE_COLUMNS, LiveFlight
+
+
+def latest_rows(points, start, end, grid_size):
+    """The latest row in every square, one row at a time"""
+    keys = zip(np.floor(points.longitudes / grid_size).tolist(),
+               np.floor(points.latitudes / grid_size).tolist())
+    latest = {}
+    for row, key in enumerate(keys):
+        if start <= row < end:
+            latest[key] = row
+    return np.sort(np.array(list(latest.values()), dtype=np.int64))
+
+
+@pytest.mark.parametrize("capacity", [50, 1000])
+def test_bins_of_time_span(capacity):
+    rng = np.random.default_rng(6)
+    live = LiveFlight(capacity=capacity)
+    time = 0
+    for batch in range(50):
+        # Now and then more rows than fit
+        num_rows = int(rng.integers(
+            1, 3 * capacity // 2 if batch % 17 == 0 else 40))
+        rows = {TIME_COLUMN: time + np.arange(num_rows) * 10**8}
+        time += num_rows * 10**8
+        for column in VALUE_COLUMNS:
+            rows[column] = rng.normal(size=num_rows).astype(
+                DRONE_COLUMNS[column])
+        rows["OSD.longitude"] = 18 + (rng.integers(0, 8, num_rows) + 0.5) \
+            * live.grid_size
+        rows["OSD.latitude"] = 59 + (rng.integers(0, 8, num_rows) + 0.5) \
+            * live.grid_size
+        live.append(rows)
+
+        points, bins = live.points()
+        assert len(points) == len(live)
+        assert (np.diff(points.times) > 0).all()
+        for i in range(8):
+            start, end = sorted(rng.integers(0, len(points) + 1, 2))
+            if i == 0:
+                end = len(points)
+            bins.move(start, end)
+            np.testing.assert_array_equal(
+                bins.rows(),
+                latest_rows(points, start, end, live.grid_size))
+
+
+def test_metrics_of_live_flight():
+    rng = np.random.default_rng(10)
+    live = LiveFlight(capacity=100)
+    drone_map = DroneMap()
+    for batch in range(3):
+        rows = {TIME_COLUMN: (batch * 60 + np.arange(60)) * 10**8}
+        for column in VALUE_COLUMNS:
+            rows[column] = rng.normal(size=60).astype(DRONE_COLUMNS[column])
+        rows["OSD.longitude"] = 18 + rng.random(60) * 0.001
+        rows["OSD.latitude"] = 59 + rng.random(60) * 0.001
+        live.append(rows)
+        drone_map.show_live(live)
+        points, _ = live.points()
+        expected = flight_metrics(points)
+        for row in (0, len(points) // 2, len(points) - 1):
+            assert drone_map.metrics_at(row) == pytest.approx(
+                metrics_at(points, expected, row), nan_ok=True)
@@ -3,52 +3,172 @@ Simple program for generating pseudo-random values for wind speed and wind
 direction. The program outputs the data in a CSV-file with incremented
 timestamps at 10Hz
 
+The values are a random walk, generated with numpy in chunks so that any
+number of data points can be written with bounded memory. Wind speed is
+reflected at its bounds and the direction wraps around at 360 degrees.
+
 Written by Magnus Lindahl, 25/3 2020
 Tomass Wilson, 13/04 2020
 """
 
-import random
+import numpy as np
+import pandas as pd
+from numpy.lib.format import open_memmap
+
+
+CHUNK_SIZE = 1000000
+COLUMNS = ["INCREMENTED.time", "RANDOM.windSpeed", "RANDOM.direction"]
+BINARY_DTYPE = np.dtype([("INCREMENTED.time", np.float64),
+                         ("RANDOM.windSpeed", np.float32),
+                         ("RANDOM.direction", np.float32)])
+
+
+def reflect(values, low, high):
+    """Fold values into [low, high], as if reflected at the bounds"""
+    width = high - low
+    return low + width - np.abs((values - low) % (2 * width) - width)
+
+
+def wind_chunks(num_data_points, rate=10, seed=None, start_time=0.0,
+                start_wind=10, start_dir=45, wind_step=1, dir_step=5,
+                max_wind=30, chunk_size=CHUNK_SIZE):
+    """
+    Generate a random walk of wind speed and direction, chunk by chunk
+
+    Args:
+        num_data_points: Total number of data points.
+        rate: Number of data points per second.
+        seed: Seed for the random generator, for repeatable data.
+        start_time: Time of the first data point, in seconds. Must not be
+            negative when writing csv.
+        start_wind: Wind speed before the first data point, in m/s.
+        start_dir: Wind direction before the first data point, in degrees.
+        wind_step: Maximum change in wind speed between two data points.
+        dir_step: Maximum change in wind direction between two data points.
+        max_wind: Wind speed is kept between 0 and max_wind.
+        chunk_size: Maximum number of data points per chunk.
+
+    Yields:
+        (time, speed, direction): float64 arrays for each chunk.
+    """
+    # One generator per value, so the values don't depend on chunk_size
+    wind_rng, dir_rng = [np.random.default_rng(child) for child
+                         in np.random.SeedSequence(seed).spawn(2)]
+    last_wind = float(start_wind)
+    last_dir = float(start_dir)
+    for first in range(0, num_data_points, chunk_size):
+        size = min(chunk_size, num_data_points - first)
+        time = start_time + np.arange(first, first + size) / rate
+
+        # The walk is continued from the last point of the previous chunk
+        wind = last_wind + np.cumsum(wind_rng.uniform(-wind_step, wind_step,
+                                                      size))
+        direction = last_dir + np.cumsum(dir_rng.uniform(-dir_step, dir_step,
+                                                         size))
+        last_wind = wind[-1]
+        last_dir = direction[-1] % 360
+        yield time, reflect(wind, 0, max_wind), direction % 360
+
+
+def format_fixed(values, decimals=3):
+    """
+    Format values like "%.3f", all at once
+
+    Args:
+        values: Array of values.
+        decimals: Number of decimals.
+
+    Returns:
+        chars: A uint8 array with one row of ascii characters per value,
+        left padded with zero bytes to the same width.
+    """
+    values = np.asarray(values)
+    scaled = np.round(np.abs(values) * 10**decimals).astype(np.int64)
+    integer = scaled // 10**decimals
+    fraction = scaled % 10**decimals
+    int_digits = len(str(int(integer.max()))) if len(integer) else 1
+    chars = np.zeros((len(scaled), int_digits + 1 + decimals), dtype=np.uint8)
+    for k in range(int_digits):
+        digit = ord("0") + (integer // 10**k) % 10
+        chars[:, int_digits - 1 - k] = np.where(
+            (integer >= 10**k) | (k == 0), digit, 0)
+    chars[:, int_digits] = ord(".")
+    for k in range(decimals):
+        chars[:, -1 - k] = ord("0") + (fraction // 10**k) % 10
+    negative = values < 0
+    if negative.any():
+        # The padding between the sign and the digits is dropped later
+        sign = np.where(negative, ord("-"), 0).astype(np.uint8)
+        chars = np.hstack([sign[:, None], chars])
+    return chars
+
+
+def csv_bytes(columns):
+    """Format columns of values as csv rows, without header"""
+    return join_fields([format_fixed(column) for column in columns])
+
+
+def join_fields(fields):
+    """
+    Join formatted fields into csv rows
+
+    Args:
+        fields: One uint8 array per column, as returned by format_fixed.
+            Zero bytes are padding and are left out.
+
+    Returns:
+        rows: The csv rows as bytes, each ending with a newline.
+    """
+    separators = [np.full((len(fields[0]), 1), ord(char), dtype=np.uint8)
+                  for char in "," * (len(fields) - 1) + "\n"]
+    rows = np.hstack([part for pair in zip(fields, separators)
+                      for part in pair]).ravel()
+    return rows[rows != 0].tobytes()
+
+
+def wind_dataframe(num_data_points, **kwargs):
+    """
+    Generate wind data in memory, without writing a file
+
+    Takes the same arguments as wind_chunks.
+
+    Returns:
+        data: A dataframe with the columns of a wind csv, see read_wind_csv.
+    """
+    chunks = list(wind_chunks(num_data_points, **kwargs))
+    if not chunks:
+        return pd.DataFrame({column: [] for column in COLUMNS})
+    return pd.DataFrame({
+        column: np.concatenate([chunk[i] for chunk in chunks])
+        for i, column in enumerate(COLUMNS)})
 
 
 # MAIN
-def generate_wind_data(filename, num_data_points):
-    """Generate a csv with num_data_points points"""
-    last_dir = 45
-    last_wind = 10
-
-    # Functions for generating pseudo-random values for wind speed,
-    # and wind direction.
-    def wind_rnd():
-        return random.uniform(last_wind-1, last_wind+1)  # +- interval
-
-    def dir_rnd():
-        return random.uniform(last_dir-5, last_dir+5)  # +- interval
-
-    # Functions for formating the output as CSV
-    def time_csv(i):
-        time = i * 0.1
-        # Limit number of decimals to 3, and convert int -> string
-        new_time_csv = (str("%.3f" % time) + ",")
-        return new_time_csv
-
-    def wind_csv():
-        new_wind = str("%.3f" % wind_rnd())
-        new_wind_csv = (new_wind + ",")
-        return new_wind_csv
-
-    def dir_csv():
-        new_dir = (str("%.3f" % dir_rnd()) + "\n")
-        return new_dir
-
-    main = open(filename+".csv", "w+")  # Create file and give R/W-privileges
-
-    # Write CSV-header
-    main.write("INCREMENTED.time,RANDOM.windSpeed,RANDOM.direction\n")
-
-    for i in range(num_data_points):  # Number of data-points
-        # Print data
-        main.write(time_csv(i))
-        main.write(wind_csv())
-        main.write(dir_csv())
-
-    main.close()  # End
+def generate_wind_data(filename, num_data_points, binary=False, **kwargs):
+    """
+    Generate a csv with num_data_points points
+
+    Args:
+        filename: Name of the file, without extension.
+        num_data_points: Number of data points.
+        binary: Write a .npy file with a structured array instead of csv.
+        kwargs: Passed on to wind_chunks, e.g. seed and rate.
+    """
+    if binary:
+        data = open_memmap(filename + ".npy", mode="w+", dtype=BINARY_DTYPE,
+                           shape=(num_data_points,))
+        first = 0
+        for chunk in wind_chunks(num_data_points, **kwargs):
+            size = len(chunk[0])
+            for i, column in enumerate(COLUMNS):
+                data[column][first:first + size] = chunk[i]
+            first += size
+        data.flush()
+        del data
+        return
+
+    # Create file and write the header, then one bulk write per chunk
+    with open(filename + ".csv", "wb") as main:
+        main.write((",".join(COLUMNS) + "\n").encode("ascii"))
+        for chunk in wind_chunks(num_data_points, **kwargs):
+            main.write(csv_bytes(chunk))